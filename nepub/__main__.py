@@ -1,23 +1,91 @@
 import argparse
+import dataclasses
 import datetime
-import json
 import os
+import shutil
+import sys
 import tempfile
-import time
 import zipfile
-from typing import List
+from collections import deque
+from contextlib import ExitStack
+from dataclasses import asdict
+from typing import Deque, Generator, Iterator, List, Tuple
 
-from nepub.epub import container, content, nav, style, text
-from nepub.http import get
-from nepub.parser.kakuyomu import KakuyomuEpisodeParser, KakuyomuIndexParser
-from nepub.parser.narou import NarouEpisodeParser, NarouIndexParser
-from nepub.type import Episode, Image, Metadata, MetadataImage
-from nepub.util import range_to_episode_nums
+from nepub import http
+from nepub.api import changed_novels
+from nepub.epub import (
+    DEFAULT_NAV_GROUP_SIZE,
+    DEFAULT_SPLIT_SIZE,
+    EpubWriter,
+    load_metadata,
+    load_raw_episode,
+    load_raw_index,
+)
+from nepub.events import JsonlReporter, emit, set_reporter
+from nepub.http import (
+    get_image,
+    image_buffer,
+    set_image_spool_threshold,
+    set_mirror_dir,
+    set_rate_limiter,
+)
+from nepub.image import IMAGE_PROFILES, resize_image
+from nepub.metrics import EPISODE_QUEUE_DEPTH, EPISODES, registry
+from nepub.novel import (
+    get_episode_page_url,
+    iter_episodes,
+    iter_index,
+    prefetch,
+    raw_image_srcs,
+    render_episode,
+    resolve_episode_images,
+)
+from nepub.parser.narou import NarouEpisodeParser
+from nepub.plan import (
+    IGNORE,
+    REUSE,
+    REVALIDATE,
+    SKIP,
+    Plan,
+    classify_episode,
+    format_plan,
+    make_plan,
+)
+from nepub.ratelimit import SharedRateLimiter
+from nepub.search import SearchIndex
+from nepub.type import (
+    Episode,
+    Image,
+    Index,
+    Metadata,
+    MetadataEpisode,
+    RawEpisode,
+)
+from nepub.util import EpisodeRange, episode_hash, parse_range
 
 
 def main():
+    if sys.argv[1:2] == ["serve"]:
+        # nepub serve はサーバーとして起動する
+        # nepub.server はこのモジュールを読み込むので、ここで読み込む
+        from nepub.server import main as serve
+
+        serve(sys.argv[2:])
+        return
+    if sys.argv[1:2] == ["search"]:
+        # nepub search は全文検索の索引から検索する
+        from nepub.search import main as search
+
+        search(sys.argv[2:])
+        return
+    if sys.argv[1:2] == ["rebuild"]:
+        # nepub rebuild は保存済みの本文から複数の EPUB を作り直す
+        from nepub.rebuild import main as rebuild
+
+        rebuild(sys.argv[2:])
+        return
     parser = argparse.ArgumentParser()
-    parser.add_argument("novel_id", help="novel id", type=str)
+    parser.add_argument("novel_id", help="novel id", type=str, nargs="+")
     parser.add_argument(
         "-i",
         "--illustration",
@@ -31,7 +99,7 @@ def main():
         "-r",
         "--range",
         metavar="<range>",
-        help='Specify the target episode number range using comma-separated values (e.g., "1,2,3") or a range notation (e.g., "10-20").',
+        help='Specify the target episode number range using comma-separated values (e.g., "1,2,3"), a range notation (e.g., "10-20", "100-"), the last N episodes (e.g., "last:50") or episodes updated since a date (e.g., "since:2026-10-01").',
         type=str,
     )
     parser.add_argument(
@@ -44,47 +112,200 @@ def main():
     parser.add_argument(
         "-k", "--kakuyomu", help="Use Kakuyomu as the source", action="store_true"
     )
-    args = parser.parse_args()
-    if args.output:
-        output = args.output
-    else:
-        output = f"{args.novel_id}.epub"
-    convert_narou_to_epub(
-        args.novel_id,
-        args.illustration,
-        not args.no_tcy,
-        args.range,
-        output,
-        args.kakuyomu,
+    parser.add_argument(
+        "--image-profile",
+        help='Illustration size profile (default: "original"). "medium" and "small" downscale images if Pillow is installed.',
+        choices=IMAGE_PROFILES.keys(),
+        default="original",
     )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        metavar="<n>",
+        help="Number of worker processes used to parse episodes (default: 1)",
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        "--shared-rate-limit",
+        metavar="<dir>",
+        help="Share the per-host request interval with other nepub processes through lock files in <dir>",
+        type=str,
+    )
+    parser.add_argument(
+        "--source-dir",
+        metavar="<dir>",
+        help="Read index and episode pages and illustrations from a local mirror in <dir> instead of the live site",
+        type=str,
+    )
+    parser.add_argument(
+        "--image-spool-threshold",
+        metavar="<kib>",
+        help="Keep illustrations up to this size in memory and spill larger ones to temporary files (default: 256)",
+        type=int,
+        default=256,
+    )
+    parser.add_argument(
+        "--split-size",
+        metavar="<chars>",
+        help=f"Split episodes longer than this many characters into several pages at paragraph boundaries. 0 disables splitting. (default: {DEFAULT_SPLIT_SIZE})",
+        type=int,
+        default=DEFAULT_SPLIT_SIZE,
+    )
+    parser.add_argument(
+        "--nav-group-size",
+        metavar="<n>",
+        help=f"Group more than this many episodes in the table of contents into nested blocks of <n> episodes. 0 keeps a flat list. (default: {DEFAULT_NAV_GROUP_SIZE})",
+        type=int,
+        default=DEFAULT_NAV_GROUP_SIZE,
+    )
+    parser.add_argument(
+        "--events",
+        help='Progress output format (default: "text"). "jsonl" emits one JSON event per line.',
+        choices=["text", "jsonl"],
+        default="text",
+    )
+    parser.add_argument(
+        "--revalidate",
+        help="Refetch up-to-date episodes and update only those whose content has changed",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--search-index",
+        metavar="<file>",
+        help="Add fetched episodes to the full-text search index in <file> (see nepub search)",
+        type=str,
+    )
+    parser.add_argument(
+        "--metrics-file",
+        metavar="<file>",
+        help="Write Prometheus metrics in the textfile collector format to <file> after each novel",
+        type=str,
+    )
+    parser.add_argument(
+        "--api-check",
+        help="Ask the Narou novel API which novels have new or updated episodes in one request and skip the others (Narou only)",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--plan",
+        help="Fetch only the index and report how many episodes and images would be fetched or reused, with an estimated time",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--rerender",
+        help="Rebuild an existing file with the given -i/--no-tcy options without downloading the episodes again",
+        action="store_true",
+    )
+    args = parser.parse_args()
+    if args.events == "jsonl":
+        set_reporter(JsonlReporter())
+    if args.shared_rate_limit:
+        set_rate_limiter(SharedRateLimiter(args.shared_rate_limit))
+    set_image_spool_threshold(args.image_spool_threshold * 1024)
+    if args.source_dir:
+        set_mirror_dir(args.source_dir)
+    if args.output and len(args.novel_id) > 1:
+        parser.error("-o/--output cannot be used with multiple novel ids")
+    if args.api_check and (
+        args.kakuyomu
+        or args.revalidate
+        or args.plan
+        or args.rerender
+        or args.source_dir
+    ):
+        parser.error(
+            "--api-check cannot be used with -k, --revalidate, --plan, --rerender or --source-dir"
+        )
+    if args.plan:
+        plan_novels(
+            args.novel_id,
+            args.illustration,
+            args.range,
+            args.output,
+            args.kakuyomu,
+            args.revalidate,
+        )
+        return
+    search_index = SearchIndex(args.search_index) if args.search_index else None
+    novel_ids = args.novel_id
+    if args.api_check:
+        # 更新のない小説は目次を取得せずに除く
+        novel_ids = changed_novels(
+            novel_ids,
+            {novel_id: args.output or f"{novel_id}.epub" for novel_id in novel_ids},
+        )
+    # 複数の novel_id が指定された場合は順に処理する
+    for novel_id in novel_ids:
+        output = args.output or f"{novel_id}.epub"
+        try:
+            if args.rerender:
+                rerender_epub(
+                    novel_id,
+                    args.illustration,
+                    not args.no_tcy,
+                    output,
+                    args.kakuyomu,
+                    args.image_profile,
+                    args.split_size,
+                    args.nav_group_size,
+                )
+                continue
+            convert_narou_to_epub(
+                novel_id,
+                args.illustration,
+                not args.no_tcy,
+                args.range,
+                output,
+                args.kakuyomu,
+                args.revalidate,
+                args.image_profile,
+                args.jobs,
+                split_size=args.split_size,
+                nav_group_size=args.nav_group_size,
+                search_index=search_index,
+            )
+        except Exception:
+            # 作成・更新に失敗した小説の索引の更新は取り消す
+            if search_index is not None:
+                search_index.rollback()
+            raise
+        finally:
+            # 途中で失敗した場合も、それまでのメトリクスを書き出す
+            if args.metrics_file:
+                registry.write_textfile(args.metrics_file)
 
 
-def get_index_parser(kakuyomu: bool):
-    if kakuyomu:
-        return KakuyomuIndexParser()
-    else:
-        return NarouIndexParser()
-
-
-def get_episode_parser(illustration: bool, tcy: bool, kakuyomu: bool):
-    if kakuyomu:
-        return KakuyomuEpisodeParser(tcy)
-    else:
-        return NarouEpisodeParser(illustration, tcy)
-
-
-def get_index_page_url(novel_id: str, page: int, kakuyomu: bool):
-    if kakuyomu:
-        return f"https://kakuyomu.jp/works/{novel_id}"
-    else:
-        return f"https://ncode.syosetu.com/{novel_id}/?p={page}"
-
-
-def get_episode_page_url(novel_id: str, episode_id: str, kakuyomu: bool):
-    if kakuyomu:
-        return f"https://kakuyomu.jp/works/{novel_id}/episodes/{episode_id}"
-    else:
-        return f"https://ncode.syosetu.com/{novel_id}/{episode_id}/"
+def plan_novels(
+    novel_ids: List[str],
+    illustration: bool,
+    my_range: str | None,
+    output: str | None,
+    kakuyomu: bool,
+    revalidate: bool = False,
+):
+    # 目次だけを取得して、取得・再利用するエピソードの数と所要時間の見積もりを出力する
+    total = Plan("total")
+    for novel_id in novel_ids:
+        plan = make_plan(
+            novel_id,
+            illustration,
+            my_range,
+            output or f"{novel_id}.epub",
+            kakuyomu,
+            revalidate,
+            # ミラーから読む場合は間隔を空けない
+            0.0 if http.mirror_dir is not None else http.rate_limiter.interval,
+        )
+        emit("plan", format_plan(plan, novel_id), **asdict(plan))
+        total.add(plan)
+    if len(novel_ids) > 1:
+        emit(
+            "plan_total",
+            format_plan(total, f"total ({len(novel_ids)} novels)"),
+            novels=len(novel_ids),
+            **asdict(total),
+        )
 
 
 def convert_narou_to_epub(
@@ -94,229 +315,550 @@ def convert_narou_to_epub(
     my_range: str,
     output: str,
     kakuyomu: bool,
-):
-    print(
-        f"novel_id: {novel_id}, illustration: {illustration}, tcy: {tcy}, output: {output}, kakuyomu: {kakuyomu}"
+    revalidate: bool = False,
+    image_profile: str = "original",
+    jobs: int = 1,
+    cached_index: Index | None = None,
+    split_size: int | None = DEFAULT_SPLIT_SIZE,
+    nav_group_size: int | None = DEFAULT_NAV_GROUP_SIZE,
+    search_index: SearchIndex | None = None,
+) -> Index | None:
+    # 作成・更新に使った目次を返す (処理を中止した場合は None)
+    # cached_index を指定した場合は目次を取得せずにそれを使う
+    emit(
+        "started",
+        f"novel_id: {novel_id}, illustration: {illustration}, tcy: {tcy}, output: {output}, kakuyomu: {kakuyomu}, revalidate: {revalidate}, image_profile: {image_profile}, jobs: {jobs}",
+        novel_id=novel_id,
+        output=output,
+        kakuyomu=kakuyomu,
     )
 
     # kakuyomu で illustration が指定されていたら処理を中止する
     if kakuyomu and illustration:
-        print("Process stopped as illustration option is not supported for Kakuyomu.")
-        return
+        emit(
+            "stopped",
+            "Process stopped as illustration option is not supported for Kakuyomu.",
+        )
+        return None
 
     # metadata
     metadata: Metadata | None = None
-    new_metadata: Metadata = {
-        "novel_id": novel_id,
-        "kakuyomu": kakuyomu,
-        "illustration": illustration,
-        "tcy": tcy,
-        "episodes": {},
-    }
     if os.path.exists(output):
-        print(f"{output} found. Loading metadata for update.")
-        with zipfile.ZipFile(output, "r") as zf_old:
-            with zf_old.open("src/metadata.json") as f:
-                metadata = json.load(f)
+        emit("metadata_loaded", f"{output} found. Loading metadata for update.")
+        metadata = load_metadata(output)
 
     # check novel_id
-    if metadata and metadata["novel_id"] != novel_id:
+    if metadata and metadata.novel_id != novel_id:
         # metadata の novel_id と値が異なる場合処理を中止する
-        print(
-            f"Process stopped as the novel_id differs from metadata: {metadata['novel_id']}"
+        emit(
+            "stopped",
+            f"Process stopped as the novel_id differs from metadata: {metadata.novel_id}",
         )
-        return
+        return None
 
     # check kakuyomu flag
-    if metadata and metadata.get("kakuyomu", False) != kakuyomu:
+    if metadata and metadata.kakuyomu != kakuyomu:
         # metadata の kakuyomu フラグと値が異なる場合処理を中止する
-        print(
-            f"Process stopped as the kakuyomu value differs from metadata: {metadata.get('kakuyomu', False)}"
+        emit(
+            "stopped",
+            f"Process stopped as the kakuyomu value differs from metadata: {metadata.kakuyomu}",
         )
-        return
+        return None
 
     # check illustration flag
-    if metadata and metadata.get("illustration", False) != illustration:
+    if metadata and metadata.illustration != illustration:
         # metadata の illustration フラグと値が異なる場合処理を中止する
-        print(
-            f"Process stopped as the illustration value differs from metadata: {metadata.get('illustration', False)}"
+        emit(
+            "stopped",
+            f"Process stopped as the illustration value differs from metadata: {metadata.illustration} (use --rerender to change it)",
         )
-        return
+        return None
 
     # check tcy flag
-    if metadata and metadata.get("tcy", False) != tcy:
+    if metadata and metadata.tcy != tcy:
         # metadata の tcy フラグと値が異なる場合処理を中止する
-        print(
-            f"Process stopped as the tcy value differs from metadata: {metadata.get('tcy', False)}"
+        emit(
+            "stopped",
+            f"Process stopped as the tcy value differs from metadata: {metadata.tcy} (use --rerender to change it)",
         )
-        return
+        return None
 
-    target_episode_nums: set[str] | None = None
+    # check image_profile
+    if metadata and illustration and metadata.image_profile != image_profile:
+        # 画像のサイズが異なる挿絵が混ざらないように、metadata の image_profile と値が異なる場合処理を中止する
+        emit(
+            "stopped",
+            f"Process stopped as the image_profile value differs from metadata: {metadata.image_profile}",
+        )
+        return None
+
+    target_range: EpisodeRange | None = None
     if my_range:
-        target_episode_nums = range_to_episode_nums(my_range)
+        target_range = parse_range(my_range)
 
     # index
-    index_parser = get_index_parser(kakuyomu)
-    index_parser.feed(get(get_index_page_url(novel_id, 1, kakuyomu)))
-    title = index_parser.title
-    author = index_parser.author
-    next_page = index_parser.next_page
+    # 目次は別スレッドで先読みし、見つかったエピソードから順に取得を始める
+    index_pages: Iterator[Tuple[Index, List[Episode]]]
+    prefetched: Generator[Tuple[Index, List[Episode]], None, None] | None = None
+    if cached_index is not None:
+        index_pages = iter(
+            [
+                (
+                    cached_index,
+                    [
+                        episode
+                        for chapter in cached_index.chapters
+                        for episode in chapter.episodes
+                    ],
+                )
+            ]
+        )
+    else:
+        index_pages = prefetched = prefetch(iter_index(novel_id, kakuyomu))
+    total: int | None = None
+    if target_range is not None and target_range.needs_total:
+        # 末尾からの範囲指定はエピソード数が分からないと決められないので目次をすべて取得しておく
+        pages = list(index_pages)
+        total = sum(len(new_episodes) for _, new_episodes in pages)
+        index_pages = iter(pages)
     timestamp = datetime.datetime.now().astimezone().isoformat(timespec="seconds")
-    chapters = index_parser.chapters
-    while next_page is not None:
-        index_parser.reset()
-        index_parser.chapters = chapters
-        index_parser.feed(get(get_index_page_url(novel_id, next_page, kakuyomu)))
-        chapters = index_parser.chapters
-        next_page = index_parser.next_page
-        # 負荷かけないようにちょっと待つ
-        time.sleep(1)
 
     # episode
     downloaded_count = 0
     skipped_count = 0
     episodes: List[Episode] = []
-    images: List[Image] = []
-    metadata_images: List[MetadataImage] = []
-    episode_parser = get_episode_parser(illustration, tcy, kakuyomu)
-    for chapter in chapters:
-        for episode in chapter["episodes"]:
-            episodes.append(episode)
-
-    print(f"title: {title}")
-    print(f"author: {author}")
-
-    print(f"{len(episodes)} episodes found.")
-    print("Start downloading...")
-
-    ignored_episode_ids: list[str] = []
-    for num, episode in enumerate(episodes):
-        if metadata:
-            if episode["id"] in metadata["episodes"]:
-                metadata_episode = metadata["episodes"][episode["id"]]
-                if metadata_episode["id"] == episode["id"]:
-                    if (
-                        target_episode_nums is not None
-                        and str(num + 1) not in target_episode_nums
-                    ):
-                        # 取得対象外で既存のファイルに存在しているエピソードはそのまま取り出す
-                        episode["title"] = metadata_episode["title"]
-                        new_metadata["episodes"][episode["id"]] = metadata_episode
-                        metadata_images += metadata_episode["images"]
-                        continue
-                    if not max(episode["created_at"], episode["updated_at"]) > max(
-                        metadata_episode["created_at"], metadata_episode["updated_at"]
+    index: Index | None = None
+
+    def position(num: int):
+        # 目次を取得し終わるまでエピソード数は分からない
+        return f"{num + 1}/{'?' if total is None else total}"
+
+    tmp_file_name: str | None = None
+
+    def open_tmp_file():
+        # 書き込むものがあると分かってから一時ファイルを作る
+        # (変更のない更新では一時ファイルを作らない)
+        nonlocal tmp_file_name
+        tmp_file = tmp_files.enter_context(
+            tempfile.NamedTemporaryFile(prefix=output, dir=os.getcwd(), delete=False)
+        )
+        tmp_file_name = tmp_file.name
+        return tmp_file
+
+    with ExitStack() as tmp_files:
+        with EpubWriter(
+            open_tmp_file,
+            novel_id,
+            kakuyomu,
+            illustration,
+            tcy,
+            image_profile,
+            split_size,
+            nav_group_size,
+        ) as writer, ExitStack() as stack:
+            zf_old = (
+                stack.enter_context(zipfile.ZipFile(output, "r")) if metadata else None
+            )
+            if prefetched is not None:
+                # 途中で失敗した場合は目次の先読みを止める
+                stack.callback(prefetched.close)
+
+            def index_reused(episode: Episode):
+                # 索引にないエピソード (索引を使い始める前に取得したものなど) は保存済みの本文から登録する
+                if (
+                    search_index is None
+                    or zf_old is None
+                    or search_index.has_episode(novel_id, kakuyomu, episode.id)
+                ):
+                    return
+                raw = load_raw_episode(zf_old, episode.id)
+                if raw is not None:
+                    search_index.replace_episode(novel_id, kakuyomu, episode.id, raw)
+
+            # 取得するエピソードの (num, revalidating) を取得する順に積む
+            planned: Deque[Tuple[int, bool]] = deque()
+            ignored_episode_ids: set[str] = set()
+
+            # 目次のページを取得するたびに新しいエピソードを既存のファイルと比較し、
+            # 取得が必要なエピソードを順に返す
+            def plan():
+                nonlocal index, total, skipped_count
+                for index, new_episodes in index_pages:
+                    if not episodes:
+                        emit(
+                            "novel_found",
+                            f"title: {index.title}\nauthor: {index.author}",
+                            title=index.title,
+                            author=index.author,
+                        )
+                        emit("download_started", "Start downloading...")
+                    for episode in new_episodes:
+                        num = len(episodes)
+                        episodes.append(episode)
+                        kind = classify_episode(
+                            episode,
+                            num,
+                            total or len(episodes),
+                            metadata,
+                            target_range,
+                            revalidate,
+                        )
+                        if kind == REUSE:
+                            # 取得対象外で既存のファイルに存在しているエピソードはそのまま取り出す
+                            assert metadata and zf_old
+                            writer.reuse_episode(
+                                episode,
+                                metadata.episodes[episode.id],
+                                zf_old,
+                                metadata.format_version,
+                            )
+                            index_reused(episode)
+                            continue
+                        if kind == SKIP:
+                            # 更新がないエピソードはダウンロードをスキップ
+                            assert metadata and zf_old
+                            writer.reuse_episode(
+                                episode,
+                                metadata.episodes[episode.id],
+                                zf_old,
+                                metadata.format_version,
+                            )
+                            index_reused(episode)
+                            skipped_count += 1
+                            EPISODES.inc(novel_id=novel_id, result="skipped")
+                            emit(
+                                "episode_skipped",
+                                f"Download skipped (already up to date) ({position(num)}): {get_episode_page_url(novel_id, episode.id, kakuyomu)}",
+                                episode_id=episode.id,
+                                num=num + 1,
+                                reason="up_to_date",
+                            )
+                            continue
+                        if kind == IGNORE:
+                            ignored_episode_ids.add(episode.id)
+                            continue
+                        revalidating = kind == REVALIDATE
+                        if revalidating:
+                            # 保存済みの検証子で条件付き GET を行う
+                            assert metadata
+                            episode.validators = dict(
+                                metadata.episodes[episode.id].validators
+                            )
+                        planned.append((num, revalidating))
+                        EPISODE_QUEUE_DEPTH.set(len(planned))
+                        emit("episode_queued", episode_id=episode.id, num=num + 1)
+                        if revalidating:
+                            message = f"Revalidating ({position(num)}): {get_episode_page_url(novel_id, episode.id, kakuyomu)}"
+                        else:
+                            message = f"Downloading ({position(num)}): {get_episode_page_url(novel_id, episode.id, kakuyomu)}"
+                        emit(
+                            "episode_requested",
+                            message,
+                            episode_id=episode.id,
+                            num=num + 1,
+                        )
+                        yield episode
+                total = len(episodes)
+                emit(
+                    "index_fetched",
+                    f"{len(episodes)} episodes found.",
+                    episodes=len(episodes),
+                )
+
+            for episode, images in iter_episodes(
+                novel_id,
+                plan(),
+                illustration,
+                tcy,
+                kakuyomu,
+                image_profile,
+                jobs,
+                # 内容に変更がないエピソードの挿絵を取得しないよう、比較してから取得する
+                defer_images=revalidate,
+            ):
+                num, revalidating = planned.popleft()
+                EPISODE_QUEUE_DEPTH.set(len(planned))
+                if metadata and zf_old and revalidating:
+                    metadata_episode = metadata.episodes[episode.id]
+                    if not episode.fetched or content_unchanged(
+                        episode, images, metadata_episode, zf_old, tcy
                     ):
-                        # 更新がないエピソードはダウンロードをスキップ
-                        episode["title"] = metadata_episode["title"]
-                        new_metadata["episodes"][episode["id"]] = metadata_episode
-                        metadata_images += metadata_episode["images"]
+                        # 内容に変更がないエピソードは既存のファイルをそのまま使う
+                        if episode.fetched and episode.validators is not None:
+                            # 次回の条件付き GET に使えるよう、受け取った検証子は記録する
+                            metadata_episode = dataclasses.replace(
+                                metadata_episode, validators=episode.validators
+                            )
+                        writer.reuse_episode(
+                            episode, metadata_episode, zf_old, metadata.format_version
+                        )
+                        index_reused(episode)
                         skipped_count += 1
-                        print(
-                            f"Download skipped (already up to date) ({num + 1}/{len(episodes)}): {get_episode_page_url(novel_id, episode['id'], kakuyomu)}"
+                        EPISODES.inc(novel_id=novel_id, result="skipped")
+                        emit(
+                            "episode_skipped",
+                            f"Download skipped (content unchanged) ({position(num)}): {get_episode_page_url(novel_id, episode.id, kakuyomu)}",
+                            episode_id=episode.id,
+                            num=num + 1,
+                            reason=(
+                                "content_unchanged"
+                                if episode.fetched
+                                else "not_modified"
+                            ),
                         )
                         continue
-        if target_episode_nums is not None and str(num + 1) not in target_episode_nums:
-            ignored_episode_ids.append(episode["id"])
-            continue
-        print(
-            f"Downloading ({num + 1}/{len(episodes)}): {get_episode_page_url(novel_id, episode['id'], kakuyomu)}"
+                    emit(
+                        "episode_changed",
+                        f"Content changed ({position(num)}): {get_episode_page_url(novel_id, episode.id, kakuyomu)}",
+                        episode_id=episode.id,
+                        num=num + 1,
+                    )
+                if images is None:
+                    images = resolve_episode_images(episode, tcy, image_profile)
+                if search_index is not None and episode.raw is not None:
+                    # 更新されたエピソードは索引の内容を置き換える
+                    search_index.replace_episode(
+                        novel_id, kakuyomu, episode.id, episode.raw
+                    )
+                writer.add_episode(episode, images)
+                downloaded_count += 1
+                EPISODES.inc(novel_id=novel_id, result="fetched")
+                emit("episode_written", episode_id=episode.id, num=num + 1)
+
+            assert index is not None
+            # 処理対象外かつ既存のファイルに存在しないエピソードを削除
+            for chapter in index.chapters:
+                chapter.episodes = [
+                    episode
+                    for episode in chapter.episodes
+                    if episode.id not in ignored_episode_ids
+                ]
+
+            if search_index is not None:
+                search_index.set_novel(novel_id, kakuyomu, index.title)
+                search_index.retain(
+                    novel_id,
+                    kakuyomu,
+                    [
+                        episode.id
+                        for chapter in index.chapters
+                        for episode in chapter.episodes
+                    ],
+                )
+
+            emit(
+                "download_complete",
+                f"Download is complete! (new: {downloaded_count}, skipped: {skipped_count})",
+                downloaded=downloaded_count,
+                skipped=skipped_count,
+            )
+
+            unchanged = (
+                downloaded_count == 0
+                and zf_old is not None
+                and writer.unchanged(zf_old, index.title, index.author, index.chapters)
+            )
+            if unchanged:
+                writer.close()
+            else:
+                writer.finish(index.title, index.author, timestamp, index.chapters)
+
+    if unchanged:
+        # 変更がない場合は既存のファイルを書き換えず、更新日時も変えない
+        assert tmp_file_name is None
+        emit(
+            "done",
+            f"No changes. {output} is left as it is.",
+            output=output,
+            created=False,
+            changed=False,
         )
-        episode_parser.feed(
-            get(get_episode_page_url(novel_id, episode["id"], kakuyomu))
+    elif os.path.exists(output):
+        assert tmp_file_name is not None
+        # 読み込み中のプロセスが古いファイルか新しいファイルのどちらかを必ず読めるように置き換える
+        os.replace(tmp_file_name, output)
+        emit("done", f"Updated {output}.", output=output, created=False)
+    else:
+        assert tmp_file_name is not None
+        os.rename(tmp_file_name, output)
+        emit("done", f"Created {output}.", output=output, created=True)
+    if search_index is not None:
+        # EPUB と同じ内容になった時点で索引の更新を確定する
+        search_index.commit()
+    return index
+
+
+def rerender_epub(
+    novel_id: str,
+    illustration: bool,
+    tcy: bool,
+    output: str,
+    kakuyomu: bool,
+    image_profile: str = "original",
+    split_size: int | None = DEFAULT_SPLIT_SIZE,
+    nav_group_size: int | None = DEFAULT_NAV_GROUP_SIZE,
+) -> bool:
+    # 作り直した場合は True を返す
+    emit(
+        "started",
+        f"novel_id: {novel_id}, illustration: {illustration}, tcy: {tcy}, output: {output}, kakuyomu: {kakuyomu}, image_profile: {image_profile}, rerender: True",
+        novel_id=novel_id,
+        output=output,
+        kakuyomu=kakuyomu,
+    )
+
+    # kakuyomu で illustration が指定されていたら処理を中止する
+    if kakuyomu and illustration:
+        emit(
+            "stopped",
+            "Process stopped as illustration option is not supported for Kakuyomu.",
+        )
+        return False
+
+    if not os.path.exists(output):
+        emit("stopped", f"Process stopped as {output} does not exist.")
+        return False
+    metadata = load_metadata(output)
+
+    # check novel_id, kakuyomu flag
+    if metadata.novel_id != novel_id:
+        emit(
+            "stopped",
+            f"Process stopped as the novel_id differs from metadata: {metadata.novel_id}",
+        )
+        return False
+    if metadata.kakuyomu != kakuyomu:
+        emit(
+            "stopped",
+            f"Process stopped as the kakuyomu value differs from metadata: {metadata.kakuyomu}",
         )
-        downloaded_count += 1
-        episode["title"] = episode_parser.title
-        episode["paragraphs"] = episode_parser.paragraphs
-        episode["fetched"] = True
-        images += episode_parser.images
-        new_metadata["episodes"][episode["id"]] = {
-            "id": episode["id"],
-            "title": episode["title"],
-            "created_at": episode["created_at"],
-            "updated_at": episode["updated_at"],
-            "images": [
-                {
-                    "id": image["id"],
-                    "name": image["name"],
-                    "type": image["type"],
-                }
-                for image in episode_parser.images
-            ],
-        }
-        episode_parser.reset()
-        # 負荷かけないようにちょっと待つ
-        time.sleep(1)
-    # 処理対象外かつ既存のファイルに存在しないエピソードを削除
-    episodes = [
-        episode for episode in episodes if episode["id"] not in ignored_episode_ids
-    ]
-    for chapter in chapters:
-        chapter["episodes"] = [
-            episode
-            for episode in chapter["episodes"]
-            if episode["id"] not in ignored_episode_ids
-        ]
-
-    print(f"Download is complete! (new: {downloaded_count}, skipped: {skipped_count})")
+        return False
+
+    # 画像のサイズを変えるには画像を取得し直す必要があるので対象外
+    if (
+        illustration
+        and metadata.illustration
+        and metadata.image_profile != image_profile
+    ):
+        emit(
+            "stopped",
+            f"Process stopped as the image_profile value differs from metadata: {metadata.image_profile}",
+        )
+        return False
+
+    timestamp = datetime.datetime.now().astimezone().isoformat(timespec="seconds")
 
     with tempfile.NamedTemporaryFile(
         prefix=output, dir=os.getcwd(), delete=False
     ) as tmp_file:
         tmp_file_name = tmp_file.name
-        with zipfile.ZipFile(
-            tmp_file, "w", compression=zipfile.ZIP_DEFLATED, compresslevel=9
-        ) as zf_new:
-            zf_new.writestr(
-                "mimetype", "application/epub+zip", compress_type=zipfile.ZIP_STORED
+        with zipfile.ZipFile(output, "r") as zf_old:
+            index = load_raw_index(zf_old)
+            episodes = (
+                [episode for chapter in index.chapters for episode in chapter.episodes]
+                if index
+                else []
             )
-            unique_images: List[MetadataImage] = []
-            image_md5s = set()
-            for image in images:
-                if image["id"] not in image_md5s:
-                    image_md5s.add(image["id"])
-                    unique_images.append(image)
-                    zf_new.writestr(f"src/image/{image['name']}", image["data"])
-            for episode in episodes:
-                if episode["fetched"]:
-                    zf_new.writestr(
-                        f"src/text/{episode['id']}.xhtml",
-                        text(episode["title"], episode["paragraphs"]),
+            # 中間形式を保存していない古いファイルは作り直せない
+            if index is None or any(
+                f"src/raw/{episode.id}.json" not in zf_old.NameToInfo
+                for episode in episodes
+            ):
+                emit(
+                    "stopped",
+                    f"Process stopped as {output} does not contain the data required for rerendering. Download it again without --rerender.",
+                )
+                os.remove(tmp_file_name)
+                return False
+
+            with EpubWriter(
+                tmp_file,
+                novel_id,
+                kakuyomu,
+                illustration,
+                tcy,
+                image_profile,
+                split_size,
+                nav_group_size,
+            ) as writer:
+                for num, episode in enumerate(episodes):
+                    metadata_episode = metadata.episodes[episode.id]
+                    raw = load_raw_episode(zf_old, episode.id)
+                    assert raw is not None
+                    episode.created_at = metadata_episode.created_at
+                    episode.updated_at = metadata_episode.updated_at
+                    # 取得し直していないので、条件付き GET の検証子もそのまま引き継ぐ
+                    episode.validators = metadata_episode.validators
+                    images = (
+                        rerender_images(raw, metadata_episode, zf_old, image_profile)
+                        if illustration
+                        else []
                     )
-            if metadata:
-                with zipfile.ZipFile(output, "r") as zf_old:
-                    for metadata_image in metadata_images:
-                        if metadata_image["id"] not in image_md5s:
-                            image_md5s.add(metadata_image["id"])
-                            unique_images.append(metadata_image)
-                            with zf_old.open(
-                                f"src/image/{metadata_image['name']}"
-                            ) as f:
-                                zf_new.writestr(
-                                    f"src/image/{metadata_image['name']}", f.read()
-                                )
-                    for episode in episodes:
-                        if not episode["fetched"]:
-                            with zf_old.open(f"src/text/{episode['id']}.xhtml") as f:
-                                zf_new.writestr(
-                                    f"src/text/{episode['id']}.xhtml", f.read()
-                                )
-            zf_new.writestr("META-INF/container.xml", container())
-            zf_new.writestr("src/style.css", style())
-            zf_new.writestr(
-                "src/content.opf",
-                content(title, author, timestamp, episodes, unique_images),
-            )
-            zf_new.writestr("src/navigation.xhtml", nav(chapters))
-            zf_new.writestr("src/metadata.json", json.dumps(new_metadata))
+                    render_episode(episode, raw, tcy, illustration)
+                    writer.add_episode(episode, images)
+                    emit(
+                        "episode_written",
+                        f"Rerendered ({num + 1}/{len(episodes)}): {get_episode_page_url(novel_id, episode.id, kakuyomu)}",
+                        episode_id=episode.id,
+                        num=num + 1,
+                    )
+                writer.finish(index.title, index.author, timestamp, index.chapters)
 
-    if os.path.exists(output):
-        os.remove(output)
-        os.rename(tmp_file_name, output)
-        print(f"Updated {output}.")
-    else:
-        os.rename(tmp_file_name, output)
-        print(f"Created {output}.")
+    # nepub serve が配信中のファイルを作り直す場合もあるので、読み込み中のプロセスが
+    # 古いファイルか新しいファイルのどちらかを必ず読めるように置き換える
+    os.replace(tmp_file_name, output)
+    emit("done", f"Updated {output}.", output=output, created=False)
+    return True
+
+
+def content_unchanged(
+    episode: Episode,
+    images: List[Image] | None,
+    metadata_episode: MetadataEpisode,
+    zf_old: zipfile.ZipFile,
+    tcy: bool,
+):
+    # 取得し直したエピソードの内容が既存のファイルと同じかをハッシュ値で比較する
+    if images is not None:
+        return episode_hash(episode.title, episode.paragraphs) == metadata_episode.hash
+    # 挿絵の取得を後回しにした場合は、既存のファイルの挿絵のファイル名で変換して比較する
+    # 既存のファイルにない挿絵がある場合は内容が変わっている
+    assert episode.raw is not None
+    old_raw = load_raw_episode(zf_old, episode.id)
+    image_names = old_raw.images if old_raw is not None else {}
+    if any(src not in image_names for src in raw_image_srcs(episode.raw)):
+        return False
+    paragraphs = NarouEpisodeParser.render_paragraphs(
+        episode.raw.paragraphs, tcy, image_names
+    )
+    return episode_hash(episode.title, paragraphs) == metadata_episode.hash
+
+
+def rerender_images(
+    raw: RawEpisode,
+    metadata_episode: MetadataEpisode,
+    zf_old: zipfile.ZipFile,
+    image_profile: str,
+) -> List[Image]:
+    # 既存のファイルにある挿絵はそのまま使い、ない挿絵 (挿絵なしで作成していた場合など) だけを取得する
+    old_images = {image.name: image for image in metadata_episode.images}
+    images: List[Image] = []
+    for img_src in raw_image_srcs(raw):
+        name = raw.images.get(img_src)
+        if name is not None and name in old_images:
+            old_image = old_images[name]
+            data = image_buffer()
+            with zf_old.open(f"src/image/{old_image.name}") as f:
+                shutil.copyfileobj(f, data)
+            images.append(Image(old_image.id, old_image.name, old_image.type, data))
+        else:
+            image = resize_image(
+                get_image(NarouEpisodeParser.image_url(img_src, image_profile)),
+                image_profile,
+            )
+            raw.images[img_src] = image.name
+            images.append(image)
+    return images
 
 
 if __name__ == "__main__":
@@ -0,0 +1,99 @@
+import json
+import os
+import urllib.parse
+from typing import Dict, List, Sequence
+
+from nepub.epub import load_metadata
+from nepub.events import emit
+from nepub.http import get
+from nepub.type import Metadata, NovelStatus
+
+# なろう小説 API
+# 目次をすべて取得しなくても、複数の小説の最終掲載日・最終更新日・エピソード数をまとめて取得できる
+NAROU_API_URL = "https://api.syosetu.com/novelapi/api/"
+
+# 1 回のリクエストで問い合わせる小説の数 (API の上限)
+NAROU_API_LIMIT = 500
+
+narou_api_url = NAROU_API_URL
+
+
+def set_narou_api_url(url: str):
+    global narou_api_url
+    narou_api_url = url
+
+
+def api_date(value: str):
+    # API は "2000-01-02 00:00:00" の形式なので、目次と同じ "2000/01/02 00:00" の形式にそろえる
+    return value[:16].replace("-", "/")
+
+
+def fetch_novel_status(novel_ids: Sequence[str]) -> Dict[str, NovelStatus]:
+    # novel_id -> 更新状況 (API が返さなかった小説は含まれない)
+    statuses: Dict[str, NovelStatus] = {}
+    for i in range(0, len(novel_ids), NAROU_API_LIMIT):
+        query = urllib.parse.urlencode(
+            {
+                "out": "json",
+                # ncode, general_lastup, novelupdated_at, general_all_no
+                "of": "n-gl-nu-ga",
+                "lim": NAROU_API_LIMIT,
+                "ncode": "-".join(novel_ids[i : i + NAROU_API_LIMIT]),
+            }
+        )
+        # 先頭の要素は件数 ({"allcount": n}) なので除く
+        for item in json.loads(get(f"{narou_api_url}?{query}"))[1:]:
+            status = NovelStatus(
+                item["ncode"].lower(),
+                api_date(item["general_lastup"]),
+                api_date(item["novelupdated_at"]),
+                item["general_all_no"],
+            )
+            statuses[status.novel_id] = status
+    return statuses
+
+
+def novel_changed(status: NovelStatus | None, metadata: Metadata | None):
+    # 既存のファイルを作成した後に掲載・更新されたエピソードがあるかどうか
+    # 判断できない場合は変更ありとして、目次とエピソードを取得する
+    if status is None or metadata is None or not metadata.episodes:
+        return True
+    if status.episodes != len(metadata.episodes):
+        # エピソードの追加・削除 (範囲指定で作成したファイルの場合も目次を取得する)
+        return True
+    episodes = metadata.episodes.values()
+    if status.general_lastup > max(episode.created_at for episode in episodes):
+        return True
+    # 最終更新日はあらすじの変更などでも変わるので、目次を取得しても変更がない場合がある
+    return status.novelupdated_at > max(
+        max(episode.created_at, episode.updated_at) for episode in episodes
+    )
+
+
+def changed_novels(novel_ids: Sequence[str], outputs: Dict[str, str]) -> List[str]:
+    # なろう小説 API で更新状況をまとめて取得し、目次とエピソードの取得が必要な小説だけを返す
+    # outputs は novel_id -> 出力ファイル名
+    metadata: Dict[str, Metadata] = {
+        novel_id: load_metadata(outputs[novel_id])
+        for novel_id in novel_ids
+        if os.path.exists(outputs[novel_id])
+    }
+    statuses = fetch_novel_status(list(metadata)) if metadata else {}
+    changed: List[str] = []
+    for novel_id in novel_ids:
+        if novel_changed(statuses.get(novel_id.lower()), metadata.get(novel_id)):
+            changed.append(novel_id)
+        else:
+            emit(
+                "novel_unchanged",
+                f"No updates according to the Narou API. {outputs[novel_id]} is left as it is.",
+                novel_id=novel_id,
+                output=outputs[novel_id],
+            )
+    emit(
+        "api_checked",
+        f"{len(changed)} of {len(novel_ids)} novels need updating.",
+        novels=len(novel_ids),
+        changed=len(changed),
+    )
+    return changed
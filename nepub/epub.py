@@ -1,9 +1,28 @@
+import codecs
+import json
+import os
+import shutil
+import struct
+import time
+import zipfile
 from importlib import resources
-from typing import List
+from typing import IO, Callable, Collection, Iterable, Iterator, List, Sequence, Tuple
 
 from jinja2 import Environment, PackageLoader
 
-from nepub.type import Chapter, Episode, MetadataImage
+from nepub.metrics import ARCHIVE_BUILD_SECONDS
+from nepub.type import (
+    Chapter,
+    Episode,
+    Image,
+    Index,
+    Metadata,
+    MetadataEpisode,
+    MetadataImage,
+    NavItem,
+    RawEpisode,
+)
+from nepub.util import episode_hash
 
 env = Environment(
     loader=PackageLoader("nepub"),
@@ -15,31 +34,121 @@ template_content = env.get_template("content.opf")
 template_navigation = env.get_template("navigation.xhtml")
 template_text = env.get_template("text.xhtml")
 
+# 目次でエピソードをまとめる数の既定値
+DEFAULT_NAV_GROUP_SIZE = 100
 
-def content(
+
+def iter_content(
     title: str,
     author: str,
     timestamp: str,
     episodes: List[Episode],
     images: List[MetadataImage],
-):
-    return template_content.render(
+    raw_ids: Collection[str] = (),
+) -> Iterator[str]:
+    # raw_ids は中間形式の本文を保存したエピソードの ID
+    return template_content.generate(
         {
             "title": title,
             "author": author,
             "timestamp": timestamp,
             "episodes": episodes,
             "images": images,
+            "raw_ids": raw_ids,
         }
     )
 
 
-def nav(chapters: List[Chapter]):
-    return template_navigation.render({"chapters": chapters})
+def content(
+    title: str,
+    author: str,
+    timestamp: str,
+    episodes: List[Episode],
+    images: List[MetadataImage],
+    raw_ids: Collection[str] = (),
+):
+    return "".join(iter_content(title, author, timestamp, episodes, images, raw_ids))
+
+
+def nav_items(
+    chapters: List[Chapter], group_size: int | None = DEFAULT_NAV_GROUP_SIZE
+) -> List[NavItem]:
+    # 章のないエピソードは目次の最上位に、章のあるエピソードは章の下に並べる
+    # group_size を超える数のエピソードは group_size 話ずつのまとまりに分け、1 段深くする
+    # 電子書籍リーダーは下の階層を畳んで表示するので、数千話あっても目次をすぐに開ける
+    items: List[NavItem] = []
+    num = 0
+    for chapter in chapters:
+        if not chapter.episodes:
+            continue
+        episodes = [NavItem(episode.id, episode.title) for episode in chapter.episodes]
+        if group_size and len(episodes) > group_size:
+            # まとまりの見出しは作品全体での通し番号にする
+            groups: List[NavItem] = []
+            for i in range(0, len(episodes), group_size):
+                first = num + i + 1
+                last = num + min(i + group_size, len(episodes))
+                groups.append(
+                    NavItem(
+                        episodes[i].id,
+                        f"{first}〜{last}" if first < last else str(first),
+                        episodes[i : i + group_size],
+                    )
+                )
+            episodes = groups
+        num += len(chapter.episodes)
+        if chapter.name == "default":
+            items.extend(episodes)
+        else:
+            items.append(NavItem(chapter.episodes[0].id, chapter.name, episodes))
+    return items
+
+
+def iter_nav(
+    chapters: List[Chapter], group_size: int | None = DEFAULT_NAV_GROUP_SIZE
+) -> Iterator[str]:
+    return template_navigation.generate({"items": nav_items(chapters, group_size)})
 
 
-def text(title: str, paragraphs: List[str]):
-    return template_text.render({"title": title, "paragraphs": paragraphs})
+def nav(chapters: List[Chapter], group_size: int | None = DEFAULT_NAV_GROUP_SIZE):
+    return "".join(iter_nav(chapters, group_size))
+
+
+def iter_text(
+    title: str, paragraphs: Sequence[str], heading: bool = True
+) -> Iterator[str]:
+    return template_text.generate(
+        {"title": title, "paragraphs": paragraphs, "heading": heading}
+    )
+
+
+def text(title: str, paragraphs: Sequence[str], heading: bool = True):
+    return "".join(iter_text(title, paragraphs, heading))
+
+
+def text_file_name(episode_id: str, part: int = 1):
+    # 分割した 2 つ目以降の XHTML は {id}-{part}.xhtml にする
+    if part == 1:
+        return f"src/text/{episode_id}.xhtml"
+    return f"src/text/{episode_id}-{part}.xhtml"
+
+
+def split_paragraphs(paragraphs: Sequence[str], split_size: int | None):
+    # 段落の区切りで、1 つあたり split_size 文字程度になるように分割する
+    # 1 つの段落が split_size を超える場合はその段落だけで 1 つにする
+    if not split_size:
+        return [paragraphs]
+    parts: List[Sequence[str]] = []
+    start = 0
+    size = 0
+    for i, paragraph in enumerate(paragraphs):
+        if size and size + len(paragraph) > split_size:
+            parts.append(paragraphs[start:i])
+            start = i
+            size = 0
+        size += len(paragraph)
+    parts.append(paragraphs[start:])
+    return parts
 
 
 def container():
@@ -48,3 +157,317 @@ def container():
 
 def style():
     return resources.read_text("nepub.files", "style.css")
+
+
+def load_metadata(file: str | IO[bytes]) -> Metadata:
+    with zipfile.ZipFile(file, "r") as zf:
+        with zf.open("src/metadata.json") as f:
+            return Metadata.from_dict(json.load(f))
+
+
+def load_raw_episode(zf: zipfile.ZipFile, episode_id: str) -> RawEpisode | None:
+    # 中間形式を保存していない古いファイルの場合は None を返す
+    try:
+        with zf.open(f"src/raw/{episode_id}.json") as f:
+            return RawEpisode.from_dict(json.load(f))
+    except KeyError:
+        return None
+
+
+def load_raw_index(zf: zipfile.ZipFile) -> Index | None:
+    try:
+        with zf.open("src/raw/index.json") as f:
+            d = json.load(f)
+    except KeyError:
+        return None
+    return Index(
+        d["title"],
+        d["author"],
+        [
+            Chapter(
+                chapter["name"],
+                [Episode(episode_id) for episode_id in chapter["episodes"]],
+            )
+            for chapter in d["chapters"]
+        ],
+    )
+
+
+# ZIP のエントリの更新日時は固定し、同じ内容のエントリが常に同じバイト列になるようにする
+# (rsync などの差分転送で変更のないエントリを転送しないで済むように)
+ZIP_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+ZIP_COMPRESS_LEVEL = 9
+# ZIP のローカルファイルヘッダーの固定長部分のサイズ
+LOCAL_FILE_HEADER_SIZE = 30
+
+
+def zip_info(name: str, compress_type: int = zipfile.ZIP_DEFLATED):
+    info = zipfile.ZipInfo(name, ZIP_DATE_TIME)
+    info.compress_type = compress_type
+    # ZipInfo を渡した場合は ZipFile の compresslevel が使われないので個別に指定する
+    info._compresslevel = ZIP_COMPRESS_LEVEL  # type: ignore[attr-defined]
+    info.external_attr = 0o644 << 16
+    return info
+
+
+# 出力形式のバージョン
+# テンプレートやスタイルシートなど、保存済みの本文から作る部分を変更したら上げる
+# nepub rebuild はこれより古いファイルを作り直す
+FORMAT_VERSION = 2
+
+# 分割する文字数の既定値
+DEFAULT_SPLIT_SIZE = 30000
+
+
+class EpubWriter:
+    # エピソードを受け取った順に ZIP に書き込んでいく
+    # 書き込んだエピソードの本文は保持しないので、エピソード数によらずメモリ使用量は一定になる
+    def __init__(
+        self,
+        file: str | IO[bytes] | Callable[[], IO[bytes]],
+        novel_id: str,
+        kakuyomu: bool,
+        illustration: bool,
+        tcy: bool,
+        image_profile: str = "original",
+        split_size: int | None = DEFAULT_SPLIT_SIZE,
+        nav_group_size: int | None = DEFAULT_NAV_GROUP_SIZE,
+    ):
+        self.metadata = Metadata(
+            novel_id,
+            kakuyomu,
+            illustration,
+            tcy,
+            image_profile,
+            format_version=FORMAT_VERSION,
+        )
+        # エピソードの本文がこの文字数を超える場合は複数の XHTML に分割する (None の場合は分割しない)
+        # 電子書籍リーダーは XHTML ごとにレイアウトするので、長すぎるエピソードは開くのに時間がかかる
+        self.split_size = split_size
+        # 目次でエピソードをまとめる数 (None の場合はまとめない)
+        self.nav_group_size = nav_group_size
+        # unchanged で作った目次を finish で作り直さないように保持する
+        self._nav: Tuple[List[Chapter], str] | None = None
+        self._started_at = time.monotonic()
+        self.images: List[MetadataImage] = []
+        self._image_ids: set[str] = set()
+        # 中間形式の本文を書き込んだエピソードの ID
+        self._raw_ids: set[str] = set()
+        # ZIP は最初に書き込むときに開く (file に関数を渡した場合は開くときに呼び出す)
+        # 既存のファイルから取り出すだけのエントリは開くまで積んでおき、
+        # 変更のない更新では出力先を作らずに済むようにする
+        self._file = file
+        self._zf_instance: zipfile.ZipFile | None = None
+        self._pending_copies: List[Tuple[zipfile.ZipFile, str]] = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def add_episode(self, episode: Episode, images: List[Image]):
+        for image in images:
+            if image.id not in self._image_ids:
+                self._image_ids.add(image.id)
+                self.images.append(MetadataImage(image.id, image.name, image.type))
+                # 一時ファイルに書き出された画像もメモリに読み込まずに書き込む
+                with self._zf.open(zip_info(f"src/image/{image.name}"), "w") as f:
+                    shutil.copyfileobj(image.open(), f)
+        parts = split_paragraphs(episode.paragraphs, self.split_size)
+        for part, paragraphs in enumerate(parts, 1):
+            # 見出しは最初の XHTML にだけ付ける
+            self._write_stream(
+                text_file_name(episode.id, part),
+                iter_text(episode.title, paragraphs, part == 1),
+            )
+        episode.parts = len(parts)
+        if episode.raw is not None:
+            self._raw_ids.add(episode.id)
+            self._zf.writestr(
+                zip_info(f"src/raw/{episode.id}.json"),
+                json.dumps(episode.raw.to_dict(), ensure_ascii=False),
+            )
+        self.metadata.episodes[episode.id] = MetadataEpisode(
+            episode.id,
+            episode.title,
+            episode.created_at,
+            episode.updated_at,
+            episode_hash(episode.title, episode.paragraphs),
+            tuple(MetadataImage(image.id, image.name, image.type) for image in images),
+            episode.parts,
+            episode.validators or {},
+        )
+        # 書き込んだ本文はもう使わないので解放する
+        episode.paragraphs = ()
+        episode.raw = None
+
+    def add_episodes(self, episodes: Iterable[Tuple[Episode, List[Image]]]):
+        for episode, images in episodes:
+            self.add_episode(episode, images)
+
+    def reuse_episode(
+        self,
+        episode: Episode,
+        metadata_episode: MetadataEpisode,
+        zf_old: zipfile.ZipFile,
+        format_version: int = 0,
+    ):
+        # 既存のファイルからエピソードと挿絵をそのまま取り出す
+        # 取り出した XHTML は既存のファイルの出力形式のままなので、
+        # nepub rebuild が作り直せるよう記録する出力形式のバージョンは既存のファイルのものを超えないようにする
+        self.metadata.format_version = min(self.metadata.format_version, format_version)
+        for image in metadata_episode.images:
+            if image.id not in self._image_ids:
+                self._image_ids.add(image.id)
+                self.images.append(image)
+                self._copy(zf_old, f"src/image/{image.name}")
+        for part in range(1, metadata_episode.parts + 1):
+            self._copy(zf_old, text_file_name(episode.id, part))
+        if f"src/raw/{episode.id}.json" in zf_old.NameToInfo:
+            self._raw_ids.add(episode.id)
+            self._copy(zf_old, f"src/raw/{episode.id}.json")
+        episode.title = metadata_episode.title
+        episode.parts = metadata_episode.parts
+        episode.paragraphs = ()
+        episode.fetched = False
+        self.metadata.episodes[episode.id] = metadata_episode
+
+    def finish(self, title: str, author: str, timestamp: str, chapters: List[Chapter]):
+        episodes = [episode for chapter in chapters for episode in chapter.episodes]
+        self._zf.writestr(zip_info("META-INF/container.xml"), container())
+        self._zf.writestr(zip_info("src/style.css"), style())
+        self._write_stream(
+            "src/content.opf",
+            iter_content(
+                title, author, timestamp, episodes, self.images, self._raw_ids
+            ),
+        )
+        if self._nav is not None and self._nav[0] is chapters:
+            self._zf.writestr(zip_info("src/navigation.xhtml"), self._nav[1])
+        else:
+            self._write_stream(
+                "src/navigation.xhtml", iter_nav(chapters, self.nav_group_size)
+            )
+        self._zf.writestr(zip_info("src/metadata.json"), self._metadata_json())
+        # --rerender で目次を取得し直さずに済むよう、章とエピソードの並びを保存する
+        self._zf.writestr(
+            zip_info("src/raw/index.json"), self._index_json(title, author, chapters)
+        )
+        self.close()
+        ARCHIVE_BUILD_SECONDS.observe(time.monotonic() - self._started_at)
+
+    def unchanged(
+        self, zf_old: zipfile.ZipFile, title: str, author: str, chapters: List[Chapter]
+    ):
+        # 本文を新たに書き込んでいない場合、目次と metadata.json などが既存のファイルと同じなら
+        # 更新日時以外は既存のファイルと同じ内容になる
+        self._nav = (chapters, nav(chapters, self.nav_group_size))
+        expected = {
+            "META-INF/container.xml": container(),
+            "src/style.css": style(),
+            "src/navigation.xhtml": self._nav[1],
+            "src/metadata.json": self._metadata_json(),
+            "src/raw/index.json": self._index_json(title, author, chapters),
+        }
+        for name, data in expected.items():
+            try:
+                if zf_old.read(name).decode("utf-8") != data:
+                    return False
+            except KeyError:
+                return False
+        return True
+
+    def close(self):
+        if self._zf_instance is not None:
+            self._zf_instance.close()
+
+    @property
+    def _zf(self) -> zipfile.ZipFile:
+        if self._zf_instance is None:
+            file = self._file() if callable(self._file) else self._file
+            self._zf_instance = zipfile.ZipFile(
+                file, "w", compression=zipfile.ZIP_DEFLATED, compresslevel=9
+            )
+            self._zf_instance.writestr(
+                zip_info("mimetype", zipfile.ZIP_STORED), "application/epub+zip"
+            )
+            # 積んでおいたエントリを受け取った順に書き込む
+            for zf_old, name in self._pending_copies:
+                self._write_copy(zf_old, name)
+            self._pending_copies = []
+        return self._zf_instance
+
+    def _metadata_json(self):
+        return json.dumps(self.metadata.to_dict())
+
+    def _index_json(self, title: str, author: str, chapters: List[Chapter]):
+        return json.dumps(
+            {
+                "title": title,
+                "author": author,
+                "chapters": [
+                    {
+                        "name": chapter.name,
+                        "episodes": [episode.id for episode in chapter.episodes],
+                    }
+                    for chapter in chapters
+                ],
+            },
+            ensure_ascii=False,
+        )
+
+    def _write_stream(self, name: str, chunks: Iterable[str]):
+        # テンプレートの出力を少しずつエンコードして書き込み、文書全体の文字列を作らないようにする
+        encoder = codecs.getincrementalencoder("utf-8")()
+        with self._zf.open(zip_info(name), "w") as f:
+            for chunk in chunks:
+                f.write(encoder.encode(chunk))
+            f.write(encoder.encode("", final=True))
+
+    def _copy(self, zf_old: zipfile.ZipFile, name: str):
+        if self._zf_instance is None:
+            self._pending_copies.append((zf_old, name))
+        else:
+            self._write_copy(zf_old, name)
+
+    def _write_copy(self, zf_old: zipfile.ZipFile, name: str):
+        # 展開して圧縮し直すと挿絵の多い小説の更新に時間がかかるので、圧縮されたデータをそのまま書き込む
+        # zipfile には圧縮済みのデータを書き込む公開 API がないため、ZipFile.open(..., "w") と同じ手順を
+        # 内部の属性を使って行う (圧縮方式と CRC は元のエントリのものを使う)
+        zf = self._zf_instance
+        assert zf is not None and zf.fp is not None
+        old = zf_old.getinfo(name)
+        info = zip_info(name, old.compress_type)
+        info.CRC = old.CRC
+        info.compress_size = old.compress_size
+        info.file_size = old.file_size
+        zip64 = max(info.file_size, info.compress_size) > zipfile.ZIP64_LIMIT
+        zf._writecheck(info)  # type: ignore[attr-defined]
+        info.header_offset = zf.fp.tell()
+        zf._didModify = True  # type: ignore[attr-defined]
+        zf.fp.write(info.FileHeader(zip64))
+        for chunk in iter_raw_data(zf_old, old):
+            zf.fp.write(chunk)
+        zf.start_dir = zf.fp.tell()
+        zf.filelist.append(info)
+        zf.NameToInfo[name] = info
+
+
+def iter_raw_data(zf: zipfile.ZipFile, info: zipfile.ZipInfo, chunk_size=1 << 16):
+    # エントリの圧縮されたデータを展開せずに返す
+    # ローカルファイルヘッダーはファイル名と拡張フィールドの長さが中央ディレクトリと異なることがあるので読み直す
+    assert zf.fp is not None
+    zf.fp.seek(info.header_offset)
+    header = zf.fp.read(LOCAL_FILE_HEADER_SIZE)
+    if len(header) != LOCAL_FILE_HEADER_SIZE or header[:4] != b"PK\x03\x04":
+        raise zipfile.BadZipFile(f"Bad local file header: {info.filename}")
+    name_length, extra_length = struct.unpack("<HH", header[26:30])
+    zf.fp.seek(name_length + extra_length, os.SEEK_CUR)
+    remaining = info.compress_size
+    while remaining > 0:
+        chunk = zf.fp.read(min(remaining, chunk_size))
+        if not chunk:
+            raise zipfile.BadZipFile(f"Truncated file data: {info.filename}")
+        remaining -= len(chunk)
+        yield chunk
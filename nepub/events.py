@@ -0,0 +1,91 @@
+import datetime
+import json
+import sys
+import threading
+import time
+from collections import deque
+from typing import IO, Any, Deque, Set, Tuple
+
+
+class TextReporter:
+    # 人が読むためのメッセージだけを出力する
+    def emit(self, event: str, message: str | None = None, **fields: Any):
+        if message is not None:
+            print(message)
+
+
+class JsonlReporter:
+    # すべてのイベントを 1 行 1 JSON で出力する
+    # 各イベントには時刻、受信バイト数の累計、直近の処理速度と残り時間の推定値を付ける
+    WINDOW = 20
+
+    def __init__(self, out: IO[str] | None = None):
+        self.out = out if out is not None else sys.stdout
+        self._lock = threading.Lock()
+        self._started_at = time.monotonic()
+        self._bytes_total = 0
+        self._queued: Set[str] = set()
+        self._queued_count = 0
+        self._done_count = 0
+        # (時刻, 完了したエピソード数, 受信バイト数の累計)
+        self._window: Deque[Tuple[float, int, int]] = deque(maxlen=self.WINDOW)
+
+    def emit(self, event: str, message: str | None = None, **fields: Any):
+        with self._lock:
+            now = time.monotonic()
+            if event in ("page_fetched", "image_fetched"):
+                self._bytes_total += fields.get("bytes", 0)
+            if event == "episode_queued":
+                self._queued.add(fields["episode_id"])
+                self._queued_count += 1
+            elif event in ("episode_written", "episode_skipped"):
+                # 取得対象のエピソードの処理が終わったら完了数に数える
+                if fields.get("episode_id") in self._queued:
+                    self._queued.remove(fields["episode_id"])
+                    self._done_count += 1
+                    self._window.append((now, self._done_count, self._bytes_total))
+            record = {
+                "time": datetime.datetime.now()
+                .astimezone()
+                .isoformat(timespec="milliseconds"),
+                "elapsed": round(now - self._started_at, 3),
+                "event": event,
+                **fields,
+                "bytes_total": self._bytes_total,
+                "queued": self._queued_count,
+                "done": self._done_count,
+                **self._estimate(),
+            }
+            if message is not None:
+                record["message"] = message
+            self.out.write(json.dumps(record, ensure_ascii=False) + "\n")
+            self.out.flush()
+
+    def _estimate(self):
+        # 直近 WINDOW 件の完了から処理速度を求め、残りのエピソードにかかる時間を推定する
+        if len(self._window) < 2:
+            return {"episodes_per_sec": None, "bytes_per_sec": None, "eta": None}
+        start_at, start_done, start_bytes = self._window[0]
+        end_at, end_done, end_bytes = self._window[-1]
+        if end_at <= start_at:
+            return {"episodes_per_sec": None, "bytes_per_sec": None, "eta": None}
+        episodes_per_sec = (end_done - start_done) / (end_at - start_at)
+        bytes_per_sec = (end_bytes - start_bytes) / (end_at - start_at)
+        remaining = self._queued_count - self._done_count
+        return {
+            "episodes_per_sec": round(episodes_per_sec, 3),
+            "bytes_per_sec": round(bytes_per_sec, 1),
+            "eta": round(remaining / episodes_per_sec, 1),
+        }
+
+
+reporter: TextReporter | JsonlReporter = TextReporter()
+
+
+def set_reporter(r: TextReporter | JsonlReporter):
+    global reporter
+    reporter = r
+
+
+def emit(event: str, message: str | None = None, **fields: Any):
+    reporter.emit(event, message, **fields)
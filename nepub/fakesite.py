@@ -0,0 +1,417 @@
+import argparse
+import hashlib
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict
+
+try:
+    import resource
+except ImportError:
+    # Windows ではメモリ使用量を計測しない
+    resource = None  # type: ignore[assignment]
+
+from nepub import events, http
+from nepub.__main__ import convert_narou_to_epub
+from nepub.events import TextReporter, emit, set_reporter
+from nepub.ratelimit import RateLimiter
+
+# なろう・カクヨムの代わりに、指定した規模の小説のページを生成して返すサーバー
+# http.set_host_overrides でサイトへのリクエストをこのサーバーに向けて、
+# 実際のサイトにアクセスせずに並行処理・再試行・大量のエピソードの処理を試す
+
+# 挿絵として返す 1x1 の GIF
+GIF = (
+    b"GIF89a\x01\x00\x01\x00\x80\x00\x00\x00\x00\x00\xff\xff\xff"
+    b"!\xf9\x04\x01\x00\x00\x00\x00,\x00\x00\x00\x00\x01\x00\x01\x00\x00\x02\x02D\x01\x00;"
+)
+
+
+@dataclass(slots=True)
+class FakeSite:
+    # 小説の規模
+    episodes: int = 100
+    # 目次 1 ページあたりのエピソード数 (なろう)
+    per_page: int = 100
+    # この数のエピソードごとに章を区切る (0 の場合は章なし)
+    chapter_size: int = 10
+    # エピソードあたりの段落数と段落の文字数
+    paragraphs: int = 50
+    paragraph_length: int = 40
+    # このエピソード数ごとに挿絵を 1 つ入れる (0 の場合は挿絵なし)
+    images_every: int = 0
+    # 挿絵のバイト数
+    image_size: int = 1024
+    # リクエストごとの遅延 (秒)
+    latency: float = 0.0
+    # 500 を返す割合と 429 を返す割合
+    error_rate: float = 0.0
+    throttle_rate: float = 0.0
+    # 429 の Retry-After (秒)
+    retry_after: int = 0
+    # ページに ETag を付け、If-None-Match が一致すれば 304 を返す
+    etags: bool = True
+    seed: int = 0
+    # ステータスコード -> 返した回数
+    statuses: Dict[int, int] = field(default_factory=dict)
+    _random: random.Random = field(init=False)
+    _lock: threading.Lock = field(default_factory=threading.Lock)
+
+    def __post_init__(self):
+        self._random = random.Random(self.seed)
+
+    @property
+    def requests(self):
+        return sum(self.statuses.values())
+
+    @staticmethod
+    def overrides(base_url: str):
+        # http.set_host_overrides に渡すホスト名 -> ベース URL
+        return {
+            "ncode.syosetu.com": f"{base_url}/ncode.syosetu.com",
+            "*.mitemin.net": f"{base_url}/mitemin.net",
+            "kakuyomu.jp": f"{base_url}/kakuyomu.jp",
+        }
+
+    def respond(
+        self, path: str, query: Dict[str, str], if_none_match: str | None = None
+    ):
+        # (ステータスコード, ヘッダー, 本文) を返す
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            r = self._random.random()
+        if r < self.throttle_rate:
+            return 429, {"Retry-After": str(self.retry_after)}, b""
+        if r < self.throttle_rate + self.error_rate:
+            return 500, {}, b""
+        segments = path.strip("/").split("/")
+        page: str | bytes | None = None
+        content_type = "text/html; charset=utf-8"
+        if segments[0] == "ncode.syosetu.com" and len(segments) == 2:
+            page = self.narou_index(segments[1], int(query.get("p", "1")))
+        elif segments[0] == "ncode.syosetu.com" and len(segments) == 3:
+            page = self.narou_episode(int(segments[2]))
+        elif segments[0] == "mitemin.net" and len(segments) == 5:
+            page = self.image(int(segments[4].removeprefix("i")))
+            content_type = "image/gif"
+        elif segments[0] == "kakuyomu.jp" and len(segments) == 3:
+            page = self.kakuyomu_index(segments[2])
+        elif segments[0] == "kakuyomu.jp" and len(segments) == 5:
+            page = self.kakuyomu_episode(int(segments[4]))
+        if page is None:
+            return 404, {}, b""
+        data = page.encode("utf-8") if isinstance(page, str) else page
+        headers = {"Content-Type": content_type}
+        if self.etags:
+            etag = f'"{hashlib.md5(data).hexdigest()}"'
+            if if_none_match == etag:
+                return 304, {"ETag": etag}, b""
+            headers["ETag"] = etag
+        return 200, headers, data
+
+    def count(self, status: int):
+        with self._lock:
+            self.statuses[status] = self.statuses.get(status, 0) + 1
+
+    def date(self, num: int):
+        # エピソードごとに 1 分ずつずらした掲載日時
+        minutes = num - 1
+        return f"2000/01/{minutes // 1440 % 28 + 1:02d} {minutes // 60 % 24:02d}:{minutes % 60:02d}"
+
+    def narou_index(self, novel_id: str, page: int):
+        first = (page - 1) * self.per_page + 1
+        last = min(page * self.per_page, self.episodes)
+        if first > last and page != 1:
+            return None
+        rows = [
+            '<h1 class="p-novel__title">タイトル</h1>',
+            '<div class="p-novel__author">作者：<a href="/">著者</a></div>',
+        ]
+        if last < self.episodes:
+            rows.append(
+                f'<a href="/{novel_id}/?p={page + 1}" class="c-pager__item c-pager__item--next">次へ</a>'
+            )
+        for num in range(first, last + 1):
+            if self.chapter_size and (num - 1) % self.chapter_size == 0:
+                rows.append(
+                    f'<div class="p-eplist__chapter-title">第{(num - 1) // self.chapter_size + 1}章</div>'
+                )
+            rows.append(
+                f'<div class="p-eplist__sublist"><a href="/{novel_id}/{num}/" class="p-eplist__subtitle">エピソード{num}</a>'
+                f'<div class="p-eplist__update">{self.date(num)}</div></div>'
+            )
+        return "\n".join(rows)
+
+    def paragraph_text(self, num: int, i: int):
+        text = f"エピソード{num}の段落{i}。"
+        return (text * (self.paragraph_length // len(text) + 1))[
+            : self.paragraph_length
+        ]
+
+    def narou_episode(self, num: int):
+        if not 1 <= num <= self.episodes:
+            return None
+        rows = [
+            f'<h1 class="p-novel__title p-novel__title--rensai">エピソード{num}</h1>'
+        ]
+        for i in range(1, self.paragraphs + 1):
+            text = self.paragraph_text(num, i)
+            if i % 10 == 0:
+                # ルビ
+                text = f"<ruby>漢字<rp>(</rp><rt>かんじ</rt><rp>)</rp></ruby>{text}"
+            rows.append(f'<p id="L{i}">{text}</p>')
+        if self.images_every and num % self.images_every == 0:
+            # みてみんの挿絵
+            rows.append(
+                f'<p id="L{self.paragraphs + 1}"><a href="//{num}.mitemin.net/i{num}/" target="_blank">'
+                f'<img src="//{num}.mitemin.net/userpageimage/viewimagebig/icode/i{num}/" alt="挿絵" border="0" /></a></p>'
+            )
+        return "\n".join(rows)
+
+    def image(self, num: int):
+        # 挿絵ごとに内容 (MD5 ハッシュ値) が変わるように番号を付け、image_size まで埋める
+        data = GIF + str(num).encode("ascii")
+        return data + b"\x00" * max(0, self.image_size - len(data))
+
+    def kakuyomu_index(self, work_id: str):
+        state: Dict[str, dict] = {
+            "UserAccount:user": {"activityName": "著者"},
+        }
+        tocs = []
+        chapter_size = self.chapter_size or self.episodes
+        for start in range(1, self.episodes + 1, chapter_size):
+            chapter = (start - 1) // chapter_size + 1
+            tocs.append({"__ref": f"TableOfContentsChapter:{chapter}"})
+            state[f"TableOfContentsChapter:{chapter}"] = {
+                "episodeUnions": [
+                    {"__ref": f"Episode:{num}"}
+                    for num in range(
+                        start, min(start + chapter_size, self.episodes + 1)
+                    )
+                ],
+                "chapter": (
+                    {"__ref": f"Chapter:{chapter}"} if self.chapter_size else None
+                ),
+            }
+            state[f"Chapter:{chapter}"] = {"title": f"第{chapter}章"}
+        for num in range(1, self.episodes + 1):
+            date = self.date(num).replace("/", "-").replace(" ", "T")
+            state[f"Episode:{num}"] = {
+                "id": str(num),
+                "title": f"エピソード{num}",
+                "publishedAt": f"{date}:00Z",
+            }
+        state[f"Work:{work_id}"] = {
+            "title": "タイトル",
+            "author": {"__ref": "UserAccount:user"},
+            "tableOfContents": tocs,
+        }
+        data = {
+            "query": {"workId": work_id},
+            "props": {"pageProps": {"__APOLLO_STATE__": state}},
+        }
+        return f'<script id="__NEXT_DATA__" type="application/json">{json.dumps(data, ensure_ascii=False)}</script>'
+
+    def kakuyomu_episode(self, num: int):
+        if not 1 <= num <= self.episodes:
+            return None
+        rows = [
+            f'<p class="widget-episodeTitle js-vertical-composition-item">エピソード{num}</p>'
+        ]
+        for i in range(1, self.paragraphs + 1):
+            rows.append(f'<p id="p{i}">{self.paragraph_text(num, i)}</p>')
+        return "\n".join(rows)
+
+
+class FakeSiteHandler(BaseHTTPRequestHandler):
+    site: FakeSite
+
+    def do_GET(self):
+        parts = urllib.parse.urlsplit(self.path)
+        status, headers, data = self.site.respond(
+            parts.path,
+            dict(urllib.parse.parse_qsl(parts.query)),
+            self.headers.get("If-None-Match"),
+        )
+        self.site.count(status)
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def make_fake_site_server(site: FakeSite, host: str = "127.0.0.1", port: int = 0):
+    handler = type("Handler", (FakeSiteHandler,), {"site": site})
+    return ThreadingHTTPServer((host, port), handler)
+
+
+class QuietReporter(TextReporter):
+    # 負荷試験中は進捗を出力しない
+    def emit(self, event, message=None, **fields):
+        pass
+
+
+@dataclass(slots=True)
+class HarnessResult:
+    episodes: int
+    seconds: float
+    episodes_per_sec: float
+    requests: int
+    statuses: Dict[int, int]
+    output_bytes: int
+    # プロセスの最大 RSS (バイト、計測できない場合は None)
+    peak_rss: int | None
+    error: str | None = None
+
+
+def peak_rss():
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux は KiB、macOS はバイト
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+@contextmanager
+def serve_fake_site(site: FakeSite, interval: float = 0.0):
+    # FakeSite を起動し、その間だけサイトへのリクエストをこのサーバーに向ける
+    server = make_fake_site_server(site)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    saved = (http.host_overrides, http.rate_limiter, events.reporter)
+    http.set_host_overrides(
+        FakeSite.overrides(f"http://127.0.0.1:{server.server_port}")
+    )
+    http.set_rate_limiter(RateLimiter(interval))
+    set_reporter(QuietReporter())
+    try:
+        yield server
+    finally:
+        server.shutdown()
+        server.server_close()
+        http.set_host_overrides(saved[0])
+        http.set_rate_limiter(saved[1])
+        set_reporter(saved[2])
+
+
+def run_harness(
+    site: FakeSite,
+    novel_id: str = "n0000aa",
+    kakuyomu: bool = False,
+    illustration: bool = False,
+    jobs: int = 1,
+    interval: float = 0.0,
+    output: str | None = None,
+) -> HarnessResult:
+    # FakeSite を起動して convert_narou_to_epub で EPUB を作成し、処理速度とメモリ使用量を返す
+    error: str | None = None
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = output or os.path.join(tmp_dir, f"{novel_id}.epub")
+        with serve_fake_site(site, interval):
+            started_at = time.monotonic()
+            try:
+                convert_narou_to_epub(
+                    novel_id, illustration, True, "", path, kakuyomu, jobs=jobs
+                )
+            except Exception as e:
+                error = str(e)
+            finally:
+                seconds = time.monotonic() - started_at
+        output_bytes = os.path.getsize(path) if os.path.exists(path) else 0
+    return HarnessResult(
+        site.episodes,
+        round(seconds, 3),
+        round(site.episodes / seconds, 1) if seconds > 0 else 0.0,
+        site.requests,
+        dict(site.statuses),
+        output_bytes,
+        peak_rss(),
+        error,
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m nepub.fakesite",
+        description="Build an EPUB from a generated local stand-in for Narou or Kakuyomu and report throughput and memory",
+    )
+    parser.add_argument("--episodes", type=int, default=1000)
+    parser.add_argument("--per-page", type=int, default=100)
+    parser.add_argument("--chapter-size", type=int, default=10)
+    parser.add_argument("--paragraphs", type=int, default=50)
+    parser.add_argument("--paragraph-length", type=int, default=40)
+    parser.add_argument("--images-every", type=int, default=0)
+    parser.add_argument("--image-size", type=int, default=1024)
+    parser.add_argument("--latency", metavar="<seconds>", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--throttle-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("-k", "--kakuyomu", action="store_true")
+    parser.add_argument("-i", "--illustration", action="store_true")
+    parser.add_argument("-j", "--jobs", type=int, default=1)
+    parser.add_argument(
+        "--interval",
+        metavar="<seconds>",
+        help="Per-host request interval (default: 0)",
+        type=float,
+        default=0.0,
+    )
+    parser.add_argument(
+        "--serve",
+        metavar="<port>",
+        help="Only run the fake site on <port> until interrupted",
+        type=int,
+    )
+    args = parser.parse_args(argv)
+    site = FakeSite(
+        episodes=args.episodes,
+        per_page=args.per_page,
+        chapter_size=args.chapter_size,
+        paragraphs=args.paragraphs,
+        paragraph_length=args.paragraph_length,
+        images_every=args.images_every,
+        image_size=args.image_size,
+        latency=args.latency,
+        error_rate=args.error_rate,
+        throttle_rate=args.throttle_rate,
+        seed=args.seed,
+    )
+    if args.serve is not None:
+        server = make_fake_site_server(site, port=args.serve)
+        emit(
+            "serving",
+            f"Serving a fake site on http://127.0.0.1:{server.server_port}/",
+            port=server.server_port,
+        )
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+        return
+    result = run_harness(
+        site,
+        kakuyomu=args.kakuyomu,
+        illustration=args.illustration,
+        jobs=args.jobs,
+        interval=args.interval,
+    )
+    emit("harness_result", json.dumps(asdict(result)), **asdict(result))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,25 +1,215 @@
+import codecs
+import email.message
 import hashlib
+import os
+import tempfile
+import time
+import urllib.error
+import urllib.parse
 import urllib.request
+import urllib.response
 from importlib.metadata import version
+from typing import IO, Dict, Iterator
 
+from nepub.events import emit
+from nepub.metrics import HTTP_BYTES, HTTP_REQUEST_SECONDS, HTTP_RESPONSES, HTTP_RETRIES
+from nepub.ratelimit import RateLimiter
 from nepub.type import Image
 
 __version__ = version("nepub")
 
+# 429 や 503 が返ってきた場合に再試行する回数
+MAX_RETRIES = 3
 
-def get(url: str):
+# 負荷かけないように、同じホストへのリクエストは間隔を空ける
+rate_limiter: RateLimiter = RateLimiter()
+
+
+def set_rate_limiter(limiter: RateLimiter):
+    global rate_limiter
+    rate_limiter = limiter
+
+
+# 画像はこのサイズ (バイト) まではメモリ上に持ち、超えた分はディスクの一時ファイルに書き出す
+image_spool_threshold = 256 * 1024
+
+# 画像を読み込む単位
+CHUNK_SIZE = 64 * 1024
+
+
+def set_image_spool_threshold(threshold: int):
+    global image_spool_threshold
+    image_spool_threshold = threshold
+
+
+def image_buffer() -> IO[bytes]:
+    return tempfile.SpooledTemporaryFile(max_size=image_spool_threshold)
+
+
+# 指定されている場合はサイトにアクセスせず、保存済みのページをこのディレクトリから読み込む
+mirror_dir: str | None = None
+
+# 保存済みの画像の形式はファイルの先頭のバイト列から判定する
+IMAGE_SIGNATURES = [
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+]
+
+
+def set_mirror_dir(directory: str | None):
+    global mirror_dir
+    mirror_dir = directory
+
+
+def mirror_path(directory: str, url: str):
+    # URL をミラーのパスに対応させる (wget -r で保存した場合と同じ配置)
+    # https://ncode.syosetu.com/xxxx/?p=2 -> {directory}/ncode.syosetu.com/xxxx/index.html?p=2
+    # https://kakuyomu.jp/works/xxxx -> {directory}/kakuyomu.jp/works/xxxx
+    #   (同じ名前のディレクトリがある場合は {directory}/kakuyomu.jp/works/xxxx/index.html)
+    parts = urllib.parse.urlsplit(url)
+    path = os.path.join(directory, parts.netloc, *parts.path.split("/"))
+    if parts.path.endswith("/") or os.path.isdir(path):
+        path = os.path.join(path, "index.html")
+    if parts.query:
+        path += f"?{parts.query}"
+    return path
+
+
+def _open_mirror(directory: str, url: str):
+    path = mirror_path(directory, url)
+    if not os.path.isfile(path):
+        raise Exception(f"ミラーにページが見つかりません: {url} ({path})")
+    f = open(path, "rb")
+    head = f.read(8)
+    f.seek(0)
+    headers = email.message.Message()
+    headers["Content-Type"] = next(
+        (
+            content_type
+            for signature, content_type in IMAGE_SIGNATURES
+            if head.startswith(signature)
+        ),
+        "text/html; charset=utf-8",
+    )
+    return urllib.response.addinfourl(f, headers, url, 200)
+
+
+# ホスト名 -> 代わりにアクセスするベース URL
+# テストや負荷試験で、サイトの代わりにローカルのサーバーにアクセスするために使う
+# "*.mitemin.net" のように先頭を * にするとサブドメインにも適用する
+host_overrides: Dict[str, str] = {}
+
+
+def set_host_overrides(overrides: Dict[str, str]):
+    global host_overrides
+    host_overrides = overrides
+
+
+def override_url(url: str):
+    # https://ncode.syosetu.com/xxxx/?p=2 -> {ベース URL}/xxxx/?p=2
+    parts = urllib.parse.urlsplit(url)
+    for host, base_url in host_overrides.items():
+        if parts.netloc == host or (
+            host.startswith("*.") and parts.netloc.endswith(host[1:])
+        ):
+            query = f"?{parts.query}" if parts.query else ""
+            return f"{base_url.rstrip('/')}{parts.path}{query}"
+    return url
+
+
+class NotModified(Exception):
+    # 条件付き GET で 304 が返ってきた場合に送出する
+    pass
+
+
+# 検証子のヘッダー -> 条件付き GET で送るヘッダー
+CONDITIONAL_HEADERS = {"ETag": "If-None-Match", "Last-Modified": "If-Modified-Since"}
+
+
+def urlopen(url: str, validators: Dict[str, str] | None = None):
+    # validators を指定した場合は、その検証子で条件付き GET を行い、レスポンスの検証子で置き換える
+    # 内容が変わっていなければ NotModified を送出する
+    if mirror_dir is not None:
+        # ローカルのファイルを読むだけなので間隔は空けない
+        return _open_mirror(mirror_dir, url)
     headers = {"User-agent": f"nepub/{__version__}"}
-    req = urllib.request.Request(url, headers=headers)
-    with urllib.request.urlopen(req, timeout=10) as res:
-        return res.read().decode("utf-8")
+    for name, value in (validators or {}).items():
+        if name in CONDITIONAL_HEADERS:
+            headers[CONDITIONAL_HEADERS[name]] = value
+    req = urllib.request.Request(override_url(url), headers=headers)
+    # 間隔やメトリクスは元のホストごとに扱う
+    host = urllib.parse.urlsplit(url).netloc
+    retry = 0
+    while True:
+        rate_limiter.wait(host)
+        started_at = time.monotonic()
+        try:
+            res = urllib.request.urlopen(req, timeout=10)
+        except urllib.error.HTTPError as e:
+            HTTP_REQUEST_SECONDS.observe(time.monotonic() - started_at, host=host)
+            HTTP_RESPONSES.inc(host=host, code=str(e.code))
+            if e.code == 304:
+                raise NotModified(url) from e
+            if e.code not in (429, 503) or retry >= MAX_RETRIES:
+                raise
+            # Retry-After が指定されていればそれに従い、なければ徐々に間隔を延ばす
+            retry_after = e.headers.get("Retry-After", "")
+            delay = int(retry_after) if retry_after.isdigit() else 2**retry * 5
+            emit(
+                "retry",
+                f"Retrying in {delay}s (HTTP {e.code}): {url}",
+                url=url,
+                status=e.code,
+                delay=delay,
+            )
+            HTTP_RETRIES.inc(host=host, code=str(e.code))
+            time.sleep(delay)
+            retry += 1
+        except OSError:
+            # タイムアウトや接続できなかった場合
+            HTTP_RESPONSES.inc(host=host, code="error")
+            raise
+        else:
+            HTTP_REQUEST_SECONDS.observe(time.monotonic() - started_at, host=host)
+            HTTP_RESPONSES.inc(host=host, code=str(res.status))
+            if validators is not None:
+                validators.clear()
+                for name in CONDITIONAL_HEADERS:
+                    if value := res.headers.get(name):
+                        validators[name] = value
+            return res
+
+
+def get(url: str, validators: Dict[str, str] | None = None):
+    with urlopen(url, validators) as res:
+        data = res.read()
+        HTTP_BYTES.inc(len(data), host=urllib.parse.urlsplit(url).netloc)
+        emit("page_fetched", url=url, status=res.status, bytes=len(data))
+        return data.decode("utf-8")
+
+
+def stream(url: str, validators: Dict[str, str] | None = None) -> Iterator[str]:
+    # 受信したデータをそのつど UTF-8 としてデコードして返し、受信とパースを重ねられるようにする
+    # マルチバイト文字がチャンクの境界で分かれた場合は、次のチャンクとつなげてデコードする
+    with urlopen(url, validators) as res:
+        decoder = codecs.getincrementaldecoder("utf-8")()
+        size = 0
+        # read1 は受信済みのデータだけを返すので、CHUNK_SIZE 分が揃うのを待たない
+        while chunk := res.read1(CHUNK_SIZE):
+            size += len(chunk)
+            if text := decoder.decode(chunk):
+                yield text
+        if text := decoder.decode(b"", final=True):
+            yield text
+        HTTP_BYTES.inc(size, host=urllib.parse.urlsplit(url).netloc)
+        emit("page_fetched", url=url, status=res.status, bytes=size)
 
 
 def get_image(url: str) -> Image:
-    headers = {"User-agent": f"nepub/{__version__}"}
-    req = urllib.request.Request(url, headers=headers)
-    with urllib.request.urlopen(req, timeout=10) as res:
+    with urlopen(url) as res:
         content_type = res.headers["Content-Type"]
-        img_data = res.read()
         if content_type == "image/jpeg":
             img_ext = "jpg"
         elif content_type == "image/png":
@@ -28,12 +218,17 @@ def get_image(url: str) -> Image:
             img_ext = "gif"
         else:
             raise Exception(f"対応していない画像の形式です: {content_type}")
-        img_md5 = hashlib.md5(img_data).hexdigest()
+        # 受信しながら MD5 ハッシュ値を計算し、画像全体を bytes として持たないようにする
+        img_hash = hashlib.md5()
+        img_data = image_buffer()
+        size = 0
+        while chunk := res.read(CHUNK_SIZE):
+            img_hash.update(chunk)
+            img_data.write(chunk)
+            size += len(chunk)
+        img_md5 = img_hash.hexdigest()
         # MD5 ハッシュ値をファイル名にする
         img_name = f"{img_md5}.{img_ext}"
-        return {
-            "type": content_type,
-            "id": img_md5,
-            "name": img_name,
-            "data": img_data,
-        }
+        HTTP_BYTES.inc(size, host=urllib.parse.urlsplit(url).netloc)
+        emit("image_fetched", url=url, status=res.status, bytes=size)
+        return Image(img_md5, img_name, content_type, img_data)
@@ -0,0 +1,75 @@
+import shutil
+import threading
+from collections import OrderedDict
+from typing import Dict, Tuple
+
+from nepub.http import image_buffer
+from nepub.type import Image, ImageProfile
+
+try:
+    from PIL import Image as PILImage
+except ImportError:
+    # Pillow がない場合は縮小・再エンコードせず元の画像をそのまま使う
+    PILImage = None  # type: ignore[assignment]
+
+IMAGE_PROFILES: Dict[str, ImageProfile] = {
+    # 元の画像をそのまま使う
+    "original": ImageProfile("viewimagebig", None, None),
+    # 元の画像を使い、大きすぎる場合は縮小する
+    "medium": ImageProfile("viewimagebig", 1600, 85),
+    # 小さいサイズの画像を取得し、さらに縮小する
+    "small": ImageProfile("viewimage", 1000, 75),
+}
+
+# (元画像の MD5, プロファイル名) ごとに変換結果をキャッシュする
+# 挿絵の数だけ画像を持ち続けないように、直近のものだけを残す
+CACHE_SIZE = 16
+_cache: "OrderedDict[Tuple[str, str], Image]" = OrderedDict()
+# 複数のワーカーから並列に呼ばれるので、キャッシュの参照と変換はロックを取得して行う
+_cache_lock = threading.Lock()
+
+
+def resize_image(image: Image, profile_name: str) -> Image:
+    profile = IMAGE_PROFILES[profile_name]
+    if PILImage is None or profile.max_size is None:
+        return image
+    # アニメーションが崩れないように GIF はそのまま使う
+    if image.type == "image/gif":
+        return image
+    key = (image.id, profile_name)
+    with _cache_lock:
+        cached = _cache.get(key)
+        if cached is None:
+            cached = _resize_image(image, profile.max_size, profile.quality)
+            _cache[key] = cached
+            if len(_cache) > CACHE_SIZE:
+                _cache.popitem(last=False)
+        else:
+            _cache.move_to_end(key)
+        # キャッシュした画像の一時ファイルを複数のスレッドが同時に読まないよう、複製を返す
+        return _copy_image(cached)
+
+
+def _copy_image(image: Image) -> Image:
+    if isinstance(image.data, bytes):
+        return image
+    data = image_buffer()
+    shutil.copyfileobj(image.open(), data)
+    return Image(image.id, image.name, image.type, data)
+
+
+def _resize_image(image: Image, max_size: int, quality: int | None) -> Image:
+    with PILImage.open(image.open()) as img:
+        img.thumbnail((max_size, max_size), PILImage.Resampling.LANCZOS)
+        data = image_buffer()
+        if image.type == "image/jpeg":
+            img.save(data, format="JPEG", quality=quality or 85, optimize=True)
+        else:
+            img.save(data, format="PNG", optimize=True)
+    if data.tell() >= image.size:
+        # 小さくならなかった場合は元の画像を使う
+        data.close()
+        return image
+    # ファイル名と ID は元画像の MD5 のままにして、更新時に同じ画像として扱えるようにする
+    # 1 つの EPUB の image_profile は作成時から変えられないので、同じ名前の画像の内容は常に同じになる
+    return Image(image.id, image.name, image.type, data)
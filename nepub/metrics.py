@@ -0,0 +1,210 @@
+import math
+import os
+import tempfile
+import threading
+from abc import ABC, abstractmethod
+from typing import Dict, List, Sequence, Tuple, TypeVar
+
+# Prometheus のテキスト形式で出力できる簡単なメトリクス
+# --metrics-file で node_exporter の textfile collector 向けのファイルに書き出すか、
+# nepub serve の /metrics で公開する
+
+
+def _escape(value: str):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]):
+    if not names:
+        return ""
+    pairs = ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values))
+    return f"{{{pairs}}}"
+
+
+def _format_value(value: float):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class Metric(ABC):
+    type = ""
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        if set(labels) != set(self.labels):
+            raise ValueError(f"{self.name} のラベルが正しくありません: {labels}")
+        return tuple(str(labels[name]) for name in self.labels)
+
+    @abstractmethod
+    def samples(self) -> List[Tuple[str, str, float]]:
+        # (名前, ラベル, 値) の並び
+        ...
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        for name, labels, value in self.samples():
+            lines.append(f"{name}{labels} {_format_value(value)}")
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        super().__init__(name, help, labels)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1.0, **labels: str):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def get(self, **labels: str):
+        with self._lock:
+            return self._values.get(self._key(labels), 0.0)
+
+    def samples(self):
+        with self._lock:
+            return [
+                (self.name, _format_labels(self.labels, key), value)
+                for key, value in self._values.items()
+            ]
+
+
+class Gauge(Counter):
+    type = "gauge"
+
+    def set(self, value: float, **labels: str):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labels: Sequence[str] = (),
+        buckets: Sequence[float] = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+    ):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        # ラベル -> (バケットごとの件数, 合計)
+        self._values: Dict[Tuple[str, ...], Tuple[List[int], float]] = {}
+
+    def observe(self, value: float, **labels: str):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * len(self.buckets), 0.0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self._values[key] = (counts, total + value)
+
+    def count(self, **labels: str):
+        with self._lock:
+            entry = self._values.get(self._key(labels))
+            return entry[0][-1] if entry else 0
+
+    def samples(self):
+        samples: List[Tuple[str, str, float]] = []
+        with self._lock:
+            for key, (counts, total) in self._values.items():
+                for bound, count in zip(self.buckets, counts):
+                    labels = _format_labels(
+                        self.labels + ("le",), key + (_format_value(bound),)
+                    )
+                    samples.append((f"{self.name}_bucket", labels, count))
+                labels = _format_labels(self.labels, key)
+                samples.append((f"{self.name}_sum", labels, total))
+                samples.append((f"{self.name}_count", labels, counts[-1]))
+        return samples
+
+
+# register に渡したメトリクスの型のまま返す
+MetricT = TypeVar("MetricT", bound=Metric)
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: Dict[str, Metric] = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric: MetricT) -> MetricT:
+        with self._lock:
+            self._metrics[metric.name] = metric
+        return metric
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return "".join(metric.render() + "\n" for metric in metrics)
+
+    def write_textfile(self, path: str):
+        # textfile collector が書き込み途中のファイルを読まないように置き換える
+        directory = os.path.dirname(os.path.abspath(path))
+        with tempfile.NamedTemporaryFile(
+            "w", dir=directory, prefix=".nepub-metrics", delete=False
+        ) as f:
+            f.write(self.render())
+        os.replace(f.name, path)
+
+
+registry = Registry()
+
+HTTP_REQUEST_SECONDS = registry.register(
+    Histogram(
+        "nepub_http_request_duration_seconds",
+        "Time until the response headers are received, per host",
+        ["host"],
+    )
+)
+HTTP_RESPONSES = registry.register(
+    Counter(
+        "nepub_http_responses_total",
+        'HTTP responses per host and status code ("error" for network errors)',
+        ["host", "code"],
+    )
+)
+HTTP_RETRIES = registry.register(
+    Counter(
+        "nepub_http_retries_total",
+        "Requests retried after 429 or 503, per host and status code",
+        ["host", "code"],
+    )
+)
+HTTP_BYTES = registry.register(
+    Counter("nepub_http_bytes_total", "Bytes received per host", ["host"])
+)
+EPISODES = registry.register(
+    Counter(
+        "nepub_episodes_total",
+        'Episodes per novel and result ("fetched" or "skipped")',
+        ["novel_id", "result"],
+    )
+)
+EPISODE_QUEUE_DEPTH = registry.register(
+    Gauge(
+        "nepub_episode_queue_depth",
+        "Episodes queued for download but not yet written",
+    )
+)
+ARCHIVE_BUILD_SECONDS = registry.register(
+    Histogram(
+        "nepub_archive_build_duration_seconds",
+        "Time from opening to finishing an EPUB archive",
+        buckets=(1, 5, 10, 30, 60, 300, 600, 1800),
+    )
+)
+JOBS = registry.register(
+    Gauge("nepub_jobs", "Build jobs of nepub serve per status", ["status"])
+)
@@ -0,0 +1,342 @@
+import queue
+import sys
+import threading
+from collections import deque
+from concurrent.futures import (
+    Executor,
+    Future,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+)
+from html.parser import HTMLParser
+from typing import (
+    Any,
+    Deque,
+    Dict,
+    Generator,
+    Iterable,
+    Iterator,
+    List,
+    Tuple,
+    TypeVar,
+)
+
+from nepub.events import emit
+from nepub.http import NotModified, get, stream
+from nepub.parser.kakuyomu import KakuyomuEpisodeParser, KakuyomuIndexParser
+from nepub.parser.narou import NarouEpisodeParser, NarouIndexParser
+from nepub.type import Episode, Image, Index, RawEpisode
+
+T = TypeVar("T")
+
+
+def get_index_parser(kakuyomu: bool):
+    if kakuyomu:
+        return KakuyomuIndexParser()
+    else:
+        return NarouIndexParser()
+
+
+def get_episode_parser(
+    illustration: bool, tcy: bool, kakuyomu: bool, image_profile: str = "original"
+):
+    if kakuyomu:
+        return KakuyomuEpisodeParser(tcy)
+    else:
+        return NarouEpisodeParser(illustration, tcy, image_profile)
+
+
+# ページを受信しながらパーサーに渡し、ページ全体を文字列として持たないようにする
+def fetch_into(parser: HTMLParser, url: str, validators: Dict[str, str] | None = None):
+    for text in stream(url, validators):
+        parser.feed(text)
+
+
+def get_index_page_url(novel_id: str, page: int, kakuyomu: bool):
+    if kakuyomu:
+        return f"https://kakuyomu.jp/works/{novel_id}"
+    else:
+        return f"https://ncode.syosetu.com/{novel_id}/?p={page}"
+
+
+def get_episode_page_url(novel_id: str, episode_id: str, kakuyomu: bool):
+    if kakuyomu:
+        return f"https://kakuyomu.jp/works/{novel_id}/episodes/{episode_id}"
+    else:
+        return f"https://ncode.syosetu.com/{novel_id}/{episode_id}/"
+
+
+# 目次ページを 1 ページずつ取得し、その時点の目次とそのページで新たに見つかったエピソードを返す
+# 返す目次は同じオブジェクトで、ページを取得するたびにエピソードが追加されていく
+def iter_index(novel_id: str, kakuyomu: bool) -> Iterator[Tuple[Index, List[Episode]]]:
+    index_parser = get_index_parser(kakuyomu)
+    fetch_into(index_parser, get_index_page_url(novel_id, 1, kakuyomu))
+    emit("index_page_fetched", page=1, url=get_index_page_url(novel_id, 1, kakuyomu))
+    index = Index(index_parser.title, index_parser.author, index_parser.chapters)
+    # 前回までに返した位置 (章の番号, 章の中のエピソードの番号)
+    # 目次全体を毎回たどるとページ数 x エピソード数の処理になるので、続きからだけ見る
+    position = [0, 0]
+
+    def new_episodes() -> List[Episode]:
+        # エピソードは目次の末尾にしか追加されないので、前回の位置より後ろが新しいもの
+        episodes: List[Episode] = []
+        chapter_pos, episode_pos = position
+        for chapter in index.chapters[chapter_pos:]:
+            episodes.extend(chapter.episodes[episode_pos:])
+            episode_pos = 0
+        last = len(index.chapters) - 1
+        position[:] = [last, len(index.chapters[last].episodes)]
+        return episodes
+
+    yield index, new_episodes()
+    next_page = index_parser.next_page
+    while next_page is not None:
+        index_parser.reset()
+        index_parser.chapters = index.chapters
+        fetch_into(index_parser, get_index_page_url(novel_id, next_page, kakuyomu))
+        emit(
+            "index_page_fetched",
+            page=int(next_page),
+            url=get_index_page_url(novel_id, next_page, kakuyomu),
+        )
+        index.chapters = index_parser.chapters
+        next_page = index_parser.next_page
+        yield index, new_episodes()
+
+
+# 目次ページをすべて取得してタイトル、作者、章ごとのエピソード一覧を返す
+def fetch_index(novel_id: str, kakuyomu: bool) -> Index:
+    index: Index | None = None
+    for index, _ in iter_index(novel_id, kakuyomu):
+        pass
+    assert index is not None
+    return index
+
+
+# iterable を別スレッドで先に進め、取得済みの要素を順に返す
+# 別スレッドで発生した例外は呼び出し側で送出する
+# 先に進めるのは size 個までで、返したジェネレーターを閉じると別スレッドも止まる
+# (呼び出し側が途中で失敗した場合に、残りの目次ページを取得し続けないように)
+def prefetch(iterable: Iterable[T], size: int = 4) -> Generator[T, None, None]:
+    items: "queue.Queue[Tuple[bool, Any]]" = queue.Queue(size)
+    stop = threading.Event()
+
+    def put(item: Tuple[bool, Any]):
+        # 空きができるまで待つ (中止された場合は False を返す)
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def run():
+        try:
+            for item in iterable:
+                if not put((True, item)):
+                    return
+        except BaseException as e:
+            put((False, e))
+        else:
+            put((False, None))
+
+    threading.Thread(target=run, daemon=True).start()
+    try:
+        while True:
+            ok, item = items.get()
+            if not ok:
+                if item is not None:
+                    raise item
+                return
+            yield item
+    finally:
+        stop.set()
+
+
+# エピソードを順に取得し、本文を埋めたエピソードとその挿絵を取得した順に返す
+# jobs が 1 の場合、次のエピソードは前のエピソードが消費されてから取得する
+# jobs が 2 以上の場合、取得した HTML のパースを jobs 個のワーカーで並列に行う
+# エピソードが検証子を持つ場合は条件付き GET を行い、変更がなければ取得せずに fetched を False のまま返す
+# defer_images の場合は挿絵を取得しない
+# 挿絵のあるエピソードは本文を変換せずに images を None にして返すので、呼び出し側で resolve_episode_images を呼ぶ
+def iter_episodes(
+    novel_id: str,
+    episodes: Iterable[Episode],
+    illustration: bool,
+    tcy: bool,
+    kakuyomu: bool,
+    image_profile: str = "original",
+    jobs: int = 1,
+    defer_images: bool = False,
+) -> Iterator[Tuple[Episode, List[Image] | None]]:
+    if jobs > 1:
+        yield from _iter_episodes_parallel(
+            novel_id,
+            episodes,
+            illustration,
+            tcy,
+            kakuyomu,
+            image_profile,
+            jobs,
+            defer_images,
+        )
+        return
+    episode_parser = get_episode_parser(illustration, tcy, kakuyomu, image_profile)
+    episode_parser.defer_images = defer_images
+    for episode in episodes:
+        if episode.validators is None:
+            episode.validators = {}
+        try:
+            fetch_into(
+                episode_parser,
+                get_episode_page_url(novel_id, episode.id, kakuyomu),
+                episode.validators,
+            )
+        except NotModified:
+            emit("episode_not_modified", episode_id=episode.id)
+            yield episode, []
+            continue
+        emit("episode_fetched", episode_id=episode.id)
+        emit("episode_parsed", episode_id=episode.id)
+        episode.title = episode_parser.title
+        episode.raw = episode_parser.raw
+        episode.fetched = True
+        images: List[Image] | None
+        if episode_parser.image_srcs:
+            images = None
+        else:
+            episode.paragraphs = episode_parser.paragraphs
+            images = episode_parser.images
+        episode_parser.reset()
+        yield episode, images
+
+
+def raw_image_srcs(raw: RawEpisode) -> List[str]:
+    # 中間形式の本文にある挿絵の src を重複なく出現順に返す
+    return list(
+        dict.fromkeys(
+            run[2]
+            for raw_paragraph in raw.paragraphs
+            for run in raw_paragraph
+            if not isinstance(run, str) and run[0] == "img"
+        )
+    )
+
+
+def resolve_episode_images(
+    episode: Episode, tcy: bool, image_profile: str = "original"
+) -> List[Image]:
+    # defer_images で後回しにした挿絵を取得し、本文を変換する
+    assert episode.raw is not None
+    episode.raw.images, images = NarouEpisodeParser.resolve_images(
+        raw_image_srcs(episode.raw), image_profile
+    )
+    render_episode(episode, episode.raw, tcy, True)
+    return images
+
+
+# 中間形式の本文からエピソードのタイトルと段落を作る
+def render_episode(episode: Episode, raw: RawEpisode, tcy: bool, include_images: bool):
+    episode.title = NarouEpisodeParser.render_title(raw.title, tcy)
+    episode.paragraphs = NarouEpisodeParser.render_paragraphs(
+        raw.paragraphs, tcy, raw.images if include_images else None
+    )
+    episode.raw = raw
+
+
+# 取得済みの HTML をパースして中間形式の本文と取得が必要な画像の URL を返す
+# プロセスプールのワーカーで実行するため、画像は取得しない
+# 取得する画像がない場合は段落への変換もワーカーで済ませておく
+def parse_episode(
+    html_text: str,
+    illustration: bool,
+    tcy: bool,
+    kakuyomu: bool,
+    image_profile: str = "original",
+) -> Tuple[RawEpisode, List[str], Tuple[str, List[str]] | None]:
+    episode_parser = get_episode_parser(illustration, tcy, kakuyomu, image_profile)
+    episode_parser.defer_images = True
+    episode_parser.feed(html_text)
+    rendered = None
+    if not episode_parser.image_srcs:
+        rendered = (episode_parser.title, episode_parser.paragraphs)
+    return episode_parser.raw, episode_parser.image_srcs, rendered
+
+
+def _parse_executor(jobs: int) -> Executor:
+    # GIL のないビルドではスレッドで並列に動くのでプロセスを起動しない
+    is_gil_enabled = getattr(sys, "_is_gil_enabled", None)
+    if is_gil_enabled is not None and not is_gil_enabled():
+        return ThreadPoolExecutor(jobs)
+    return ProcessPoolExecutor(jobs)
+
+
+def _iter_episodes_parallel(
+    novel_id: str,
+    episodes: Iterable[Episode],
+    illustration: bool,
+    tcy: bool,
+    kakuyomu: bool,
+    image_profile: str,
+    jobs: int,
+    defer_images: bool,
+) -> Iterator[Tuple[Episode, List[Image] | None]]:
+    def complete(
+        episode: Episode, future: Future | None
+    ) -> Tuple[Episode, List[Image] | None]:
+        if future is None:
+            # 変更がなかったエピソード
+            return episode, []
+        raw, _, rendered = future.result()
+        emit("episode_parsed", episode_id=episode.id)
+        episode.fetched = True
+        if rendered is not None:
+            episode.title, episode.paragraphs = rendered
+            episode.raw = raw
+            return episode, []
+        episode.title = NarouEpisodeParser.render_title(raw.title, tcy)
+        episode.raw = raw
+        if defer_images:
+            return episode, None
+        return episode, resolve_episode_images(episode, tcy, image_profile)
+
+    # 取得 -> パース -> 書き込みの間に溜まるエピソードの数を制限してメモリ使用量を抑える
+    max_pending = jobs * 2
+    pending: Deque[Tuple[Episode, Future | None]] = deque()
+    with _parse_executor(jobs) as executor:
+        for episode in episodes:
+            if episode.validators is None:
+                episode.validators = {}
+            # ワーカーに渡すため、ここではページ全体を受信してからパースする
+            try:
+                html_text = get(
+                    get_episode_page_url(novel_id, episode.id, kakuyomu),
+                    episode.validators,
+                )
+            except NotModified:
+                emit("episode_not_modified", episode_id=episode.id)
+                pending.append((episode, None))
+                continue
+            emit("episode_fetched", episode_id=episode.id)
+            pending.append(
+                (
+                    episode,
+                    executor.submit(
+                        parse_episode,
+                        html_text,
+                        illustration,
+                        tcy,
+                        kakuyomu,
+                        image_profile,
+                    ),
+                )
+            )
+            while pending and (
+                len(pending) >= max_pending
+                or pending[0][1] is None
+                or pending[0][1].done()
+            ):
+                yield complete(*pending.popleft())
+        while pending:
+            yield complete(*pending.popleft())
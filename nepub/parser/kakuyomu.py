@@ -5,7 +5,7 @@ from html.parser import HTMLParser
 from typing import List
 
 from nepub.parser.narou import NarouEpisodeParser
-from nepub.type import Chapter
+from nepub.type import Chapter, Episode
 
 
 class KakuyomuEpisodeParser(NarouEpisodeParser):
@@ -22,7 +22,7 @@ class KakuyomuIndexParser(HTMLParser):
         self.title = ""
         self.author = ""
         self.next_page = None
-        self.chapters: List[Chapter] = [{"name": "default", "episodes": []}]
+        self.chapters: List[Chapter] = [Chapter("default")]
         self._json_flg = False
         self._buff = ""
 
@@ -53,22 +53,17 @@ class KakuyomuIndexParser(HTMLParser):
                 if chapter_ref is not None:
                     chapter = state[chapter_ref["__ref"]]
                     chapter_name = chapter["title"]
-                    self.chapters.append(
-                        {"name": html.escape(chapter_name).strip(), "episodes": []}
-                    )
+                    self.chapters.append(Chapter(html.escape(chapter_name).strip()))
                 episode_refs = toc_chapter["episodeUnions"]
                 for episode_ref in episode_refs:
                     episode = state[episode_ref["__ref"]]
-                    self.chapters[-1]["episodes"].append(
-                        {
-                            "id": html.escape(episode["id"]).strip(),
-                            "title": "",
-                            "created_at": html.escape(episode["publishedAt"]).strip(),
+                    self.chapters[-1].episodes.append(
+                        Episode(
+                            id=html.escape(episode["id"]).strip(),
+                            created_at=html.escape(episode["publishedAt"]).strip(),
                             # 更新日が分からないので作成日と同じ値を入れておく
-                            "updated_at": html.escape(episode["publishedAt"]).strip(),
-                            "paragraphs": [],
-                            "fetched": False,
-                        }
+                            updated_at=html.escape(episode["publishedAt"]).strip(),
+                        )
                     )
 
             self._json_flg = False
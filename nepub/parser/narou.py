@@ -1,52 +1,146 @@
 import html
 import re
 from html.parser import HTMLParser
-from typing import List
+from typing import Any, Dict, List, Sequence, Tuple
 
 from nepub.http import get_image
-from nepub.type import Chapter, Image
+from nepub.image import IMAGE_PROFILES, resize_image
+from nepub.type import Chapter, Episode, Image, RawEpisode
 from nepub.util import tcy
 
 
 class NarouEpisodeParser(HTMLParser):
     PARAGRAPH_ID_PATTERN = re.compile(r"L[1-9][0-9]*")
     IMG_SRC_PATTERN = re.compile(
-        r"//[1-9][0-9]*.mitemin.net/userpageimage/viewimagebig/icode/i[1-9][0-9]*/"
+        r"(//[1-9][0-9]*.mitemin.net/userpageimage/)(viewimagebig|viewimage)(/icode/i[1-9][0-9]*/)"
     )
     EPISODE_TITLE_CLASS = "p-novel__title"
 
-    def __init__(self, include_images=False, convert_tcy=False):
+    def __init__(
+        self,
+        include_images=False,
+        convert_tcy=False,
+        image_profile="original",
+        defer_images=False,
+    ):
         super().__init__()
         self.include_images = include_images
         self.convert_tcy = convert_tcy
+        self.image_profile = image_profile
+        # True の場合は画像を取得せず、画像の URL を image_srcs に積んでおく
+        # 画像は resolve_images で後から取得する
+        self.defer_images = defer_images
 
     def reset(self):
         super().reset()
         self._title = ""
-        self.paragraphs: List[str] = []
+        # 段落はオプションによらない中間形式 (テキストとタグの目印の並び) で保持し、
+        # paragraphs で縦中横や挿絵の有無を反映した HTML に変換する
+        self.raw_paragraphs: List[List[Any]] = []
         self.images: List[Image] = []
+        self.image_srcs: List[str] = []
+        # img の src -> 取得した画像のファイル名
+        self.image_names: Dict[str, str] = {}
         self._tag_stack: List[str | None] = [None, None]
         self._id_stack: List[str | None] = [None]
         self._classes_stack: List[List[str] | None] = [None]
         self._paragraph_flg = False
-        self._current_paragraph = ""
+        self._current_paragraph: List[Any] = []
         self._paragraph_buff = ""
-        self._consecutive_blank_paragraphs = 0
 
     @property
     def title(self):
-        if self.convert_tcy:
-            return tcy(html.escape(self._title).strip())
-        else:
-            return html.escape(self._title).strip()
+        return self.render_title(self._title, self.convert_tcy)
 
-    def handle_starttag(self, tag, attrs):
-        # バッファのデータをエスケープ & 縦中横処理し _current_paragraph に連結
-        if self.convert_tcy:
-            self._current_paragraph += tcy(html.escape(self._paragraph_buff))
+    @property
+    def paragraphs(self):
+        return self.render_paragraphs(
+            self.raw_paragraphs,
+            self.convert_tcy,
+            self.image_names if self.include_images else None,
+        )
+
+    @property
+    def raw(self):
+        return RawEpisode(self._title, self.raw_paragraphs, self.image_names)
+
+    @classmethod
+    def render_title(cls, raw_title: str, convert_tcy=False):
+        if convert_tcy:
+            return tcy(html.escape(raw_title).strip())
         else:
-            self._current_paragraph += html.escape(self._paragraph_buff)
+            return html.escape(raw_title).strip()
+
+    @classmethod
+    def render_paragraphs(
+        cls,
+        raw_paragraphs: Sequence[Sequence[Any]],
+        convert_tcy=False,
+        image_names: Dict[str, str] | None = None,
+    ):
+        # 中間形式の段落を HTML に変換する
+        # image_names が None の場合は挿絵を出力しない
+        paragraphs: List[str] = []
+        consecutive_blank_paragraphs = 0
+        for raw_paragraph in raw_paragraphs:
+            paragraph = ""
+            for run in raw_paragraph:
+                if isinstance(run, str):
+                    # テキストをエスケープ & 縦中横処理する
+                    if convert_tcy:
+                        paragraph += tcy(html.escape(run))
+                    else:
+                        paragraph += html.escape(run)
+                elif run[0] == "img":
+                    if image_names is not None:
+                        paragraph += f'<img alt="{html.escape(run[1]).strip()}" src="../image/{image_names[run[2]]}"/>'
+                else:
+                    paragraph += f"<{run[0]}>"
+            # 先頭の字下げを残すため rstrip にしている
+            paragraph = paragraph.rstrip()
+            if paragraph:
+                consecutive_blank_paragraphs = 0
+                paragraphs.append(paragraph)
+            else:
+                # 連続しない空行はそのまま除去
+                # 2 回以上連続する空行は一つの空行として出力する
+                consecutive_blank_paragraphs += 1
+                if consecutive_blank_paragraphs == 2:
+                    paragraphs.append("<br />")
+        return paragraphs
+
+    @classmethod
+    def image_url(cls, img_src: str, image_profile="original"):
+        m = cls.IMG_SRC_PATTERN.fullmatch(img_src)
+        if not m:
+            raise Exception(f"img_src が想定しない形式です: {img_src}")
+        # プロファイルに合わせたサイズの画像を取得する
+        return f"https:{m.group(1)}{IMAGE_PROFILES[image_profile].variant}{m.group(3)}"
+
+    @classmethod
+    def resolve_images(
+        cls, image_srcs: List[str], image_profile="original"
+    ) -> Tuple[Dict[str, str], List[Image]]:
+        # defer_images で後回しにした画像を取得し、src と画像のファイル名の対応を返す
+        images = [
+            resize_image(
+                get_image(cls.image_url(img_src, image_profile)), image_profile
+            )
+            for img_src in image_srcs
+        ]
+        image_names = {
+            img_src: image.name for img_src, image in zip(image_srcs, images)
+        }
+        return image_names, images
+
+    def _flush(self):
+        # バッファのデータを 1 つのテキストとして段落に追加する
+        if self._paragraph_buff:
+            self._current_paragraph.append(self._paragraph_buff)
         self._paragraph_buff = ""
+
+    def handle_starttag(self, tag, attrs):
+        self._flush()
         # tag, id, classes をスタックに積む
         self._tag_stack.append(tag)
         self._id_stack.append(None)
@@ -62,56 +156,50 @@ class NarouEpisodeParser(HTMLParser):
         ):
             self._paragraph_flg = True
         # ruby, rt (rb タグは省略する) の処理
-        # include_images が設定されている場合は img も処理する
+        # img は include_images の指定によらず目印を残し、取得は include_images が設定されている場合のみ行う
         if self._paragraph_flg:
             if tag == "ruby":
-                self._current_paragraph += "<ruby>"
+                self._current_paragraph.append(["ruby"])
             elif tag == "rt":
-                self._current_paragraph += "<rt>"
-            elif self.include_images and tag == "img":
+                self._current_paragraph.append(["rt"])
+            elif tag == "img":
                 img_alt = ""
                 img_src = ""
                 for attr in attrs:
                     if attr[0] == "alt":
-                        img_alt = html.escape(attr[1])
+                        img_alt = attr[1] or ""
                     elif attr[0] == "src":
-                        if not self.IMG_SRC_PATTERN.fullmatch(attr[1]):
-                            raise Exception(f"img_src が想定しない形式です: {attr[1]}")
-                        img_src = attr[1]
-                if img_src:
-                    image = get_image(f"https:{img_src}")
-                    self._current_paragraph += (
-                        f'<img alt="{img_alt.strip()}" src="../image/{image["name"]}"/>'
+                        img_src = attr[1] or ""
+                if not img_src:
+                    return
+                self._current_paragraph.append(["img", img_alt, img_src])
+                if not self.include_images or img_src in self.image_names:
+                    return
+                if self.defer_images:
+                    # 形式だけ確認しておく
+                    self.image_url(img_src, self.image_profile)
+                    if img_src not in self.image_srcs:
+                        self.image_srcs.append(img_src)
+                else:
+                    image = resize_image(
+                        get_image(self.image_url(img_src, self.image_profile)),
+                        self.image_profile,
                     )
+                    self.image_names[img_src] = image.name
                     self.images.append(image)
 
     def handle_endtag(self, tag):
-        # バッファのデータをエスケープ & 縦中横処理し _current_paragraph に連結
-        if self.convert_tcy:
-            self._current_paragraph += tcy(html.escape(self._paragraph_buff))
-        else:
-            self._current_paragraph += html.escape(self._paragraph_buff)
-        self._paragraph_buff = ""
+        self._flush()
         # ruby, rt, p
         # rb タグは省略する
         if self._paragraph_flg:
             if tag == "ruby":
-                self._current_paragraph += "</ruby>"
+                self._current_paragraph.append(["/ruby"])
             elif tag == "rt":
-                self._current_paragraph += "</rt>"
+                self._current_paragraph.append(["/rt"])
             elif tag == "p":
-                # 先頭の字下げを残すため rstrip にしている
-                paragraph = self._current_paragraph.rstrip()
-                if paragraph:
-                    self._consecutive_blank_paragraphs = 0
-                    self.paragraphs.append(paragraph)
-                else:
-                    # 連続しない空行はそのまま除去
-                    # 2 回以上連続する空行は一つの空行として出力する
-                    self._consecutive_blank_paragraphs += 1
-                    if self._consecutive_blank_paragraphs == 2:
-                        self.paragraphs.append("<br />")
-                self._current_paragraph = ""
+                self.raw_paragraphs.append(self._current_paragraph)
+                self._current_paragraph = []
         # paragraph_flg
         if self._id_stack[-1] is not None and self.PARAGRAPH_ID_PATTERN.fullmatch(
             self._id_stack[-1]
@@ -144,7 +232,7 @@ class NarouIndexParser(HTMLParser):
         self._title = ""
         self._author = ""
         self.next_page = None
-        self.chapters: List[Chapter] = [{"name": "default", "episodes": []}]
+        self.chapters: List[Chapter] = [Chapter("default")]
         self._classes_stack: List[List[str] | None] = [None, None]
         self._current_chapter = ""
         self._current_episode_created_at = ""
@@ -184,21 +272,12 @@ class NarouIndexParser(HTMLParser):
                     m = self.EPISODE_ID_PATTERN.fullmatch(attr[1])
                     if not m:
                         raise Exception(f"episode_id が認識できませんでした: {attr[1]}")
-                    self.chapters[-1]["episodes"].append(
-                        {
-                            "id": m.group(1),
-                            "title": "",
-                            "created_at": "",
-                            "updated_at": "",
-                            "paragraphs": [],
-                            "fetched": False,
-                        }
-                    )
+                    self.chapters[-1].episodes.append(Episode(m.group(1)))
         # episode_updated_at
         if tag == "span":
             for attr in attrs:
                 if attr[0] == "title":
-                    self.chapters[-1]["episodes"][-1]["updated_at"] = html.escape(
+                    self.chapters[-1].episodes[-1].updated_at = html.escape(
                         attr[1].strip().replace(" 改稿", "")
                     )
 
@@ -206,11 +285,11 @@ class NarouIndexParser(HTMLParser):
         if tag == "div":
             if self._current_chapter:
                 self.chapters.append(
-                    {"name": html.escape(self._current_chapter).strip(), "episodes": []}
+                    Chapter(html.escape(self._current_chapter).strip())
                 )
                 self._current_chapter = ""
             elif self._current_episode_created_at:
-                self.chapters[-1]["episodes"][-1]["created_at"] = html.escape(
+                self.chapters[-1].episodes[-1].created_at = html.escape(
                     self._current_episode_created_at
                 ).strip()
                 self._current_episode_created_at = ""
@@ -0,0 +1,179 @@
+import datetime
+import os
+import zipfile
+from dataclasses import dataclass, fields
+from typing import Dict, List
+
+from nepub.epub import load_metadata, text_file_name
+from nepub.novel import iter_index
+from nepub.type import Episode, Metadata
+from nepub.util import EpisodeRange, parse_range
+
+# 目次に載っているエピソードの扱い
+# 取得する
+FETCH = "fetch"
+# 更新はないが取得し直して内容を比較する
+REVALIDATE = "revalidate"
+# 更新がないので既存のファイルから取り出す
+SKIP = "skip"
+# 取得対象外で既存のファイルに存在するので、そのまま取り出す
+REUSE = "reuse"
+# 取得対象外で既存のファイルにも存在しないので除く
+IGNORE = "ignore"
+
+
+def classify_episode(
+    episode: Episode,
+    num: int,
+    total: int,
+    metadata: Metadata | None,
+    target_range: EpisodeRange | None,
+    revalidate: bool,
+):
+    # num は 0 始まりのエピソード番号、total は目次に含まれるエピソード数
+    in_range = target_range is None or target_range.contains(num + 1, total, episode)
+    if metadata and episode.id in metadata.episodes:
+        metadata_episode = metadata.episodes[episode.id]
+        if not in_range:
+            return REUSE
+        if not max(episode.created_at, episode.updated_at) > max(
+            metadata_episode.created_at, metadata_episode.updated_at
+        ):
+            # 更新日時が変わらなくても内容が変わっていることがあるので
+            # revalidate の場合は取得し直してハッシュ値を比較する
+            return REVALIDATE if revalidate else SKIP
+    if not in_range:
+        return IGNORE
+    return FETCH
+
+
+@dataclass(slots=True)
+class Plan:
+    novel_id: str
+    index_pages: int = 0
+    episodes: int = 0
+    fetch: int = 0
+    revalidate: int = 0
+    skip: int = 0
+    reuse: int = 0
+    ignore: int = 0
+    # 取得する挿絵の数は既存のファイルから推定する
+    images_fetch: int = 0
+    images_reuse: int = 0
+    # 既存のファイルからそのまま書き込むバイト数
+    bytes_reused: int = 0
+    # 新たに書き込むバイト数 (既存のファイルがない場合は推定できないので None)
+    bytes_new: int | None = None
+    requests: int = 0
+    seconds: float = 0.0
+
+    def add(self, other: "Plan"):
+        # バッチの合計を求めるために他の小説の見積もりを足し込む
+        for f in fields(self):
+            if f.name == "novel_id":
+                continue
+            value = getattr(other, f.name)
+            if f.name == "bytes_new":
+                if value is not None:
+                    self.bytes_new = (self.bytes_new or 0) + value
+            else:
+                setattr(self, f.name, getattr(self, f.name) + value)
+
+
+def make_plan(
+    novel_id: str,
+    illustration: bool,
+    my_range: str | None,
+    output: str,
+    kakuyomu: bool,
+    revalidate: bool,
+    interval: float,
+) -> Plan:
+    # 目次だけを取得し、convert_narou_to_epub と同じ判定で取得・再利用するエピソードを数える
+    plan = Plan(novel_id)
+    target_range = parse_range(my_range) if my_range else None
+    episodes: List[Episode] = []
+    for _, new_episodes in iter_index(novel_id, kakuyomu):
+        plan.index_pages += 1
+        episodes.extend(new_episodes)
+    plan.episodes = len(episodes)
+
+    metadata: Metadata | None = None
+    entry_sizes: Dict[str, int] = {}
+    if os.path.exists(output):
+        metadata = load_metadata(output)
+        with zipfile.ZipFile(output) as zf:
+            entry_sizes = {info.filename: info.compress_size for info in zf.infolist()}
+
+    def episode_size(episode_id: str):
+        assert metadata is not None
+        metadata_episode = metadata.episodes[episode_id]
+        names = (
+            [
+                text_file_name(episode_id, part)
+                for part in range(1, metadata_episode.parts + 1)
+            ]
+            + [f"src/raw/{episode_id}.json"]
+            + [f"src/image/{image.name}" for image in metadata_episode.images]
+        )
+        return sum(entry_sizes.get(name, 0) for name in names)
+
+    # 新しいエピソードの挿絵の数とサイズは、既存のエピソードの平均で推定する
+    average_images = 0.0
+    average_size = 0.0
+    if metadata and metadata.episodes:
+        average_images = sum(len(e.images) for e in metadata.episodes.values()) / len(
+            metadata.episodes
+        )
+        average_size = sum(
+            episode_size(episode_id) for episode_id in metadata.episodes
+        ) / len(metadata.episodes)
+
+    images_fetch = 0.0
+    bytes_new = 0.0
+    for num, episode in enumerate(episodes):
+        kind = classify_episode(
+            episode, num, len(episodes), metadata, target_range, revalidate
+        )
+        setattr(plan, kind, getattr(plan, kind) + 1)
+        if kind in (SKIP, REUSE):
+            assert metadata is not None
+            plan.images_reuse += len(metadata.episodes[episode.id].images)
+            plan.bytes_reused += episode_size(episode.id)
+        elif kind in (FETCH, REVALIDATE):
+            if metadata and episode.id in metadata.episodes:
+                images_fetch += len(metadata.episodes[episode.id].images)
+                bytes_new += episode_size(episode.id)
+            else:
+                images_fetch += average_images
+                bytes_new += average_size
+    if illustration:
+        plan.images_fetch = round(images_fetch)
+    if metadata:
+        plan.bytes_new = round(bytes_new)
+
+    # 挿絵は別のホストから取得するので、エピソードの取得間隔と重なる
+    pages = plan.index_pages + plan.fetch + plan.revalidate
+    plan.requests = pages + plan.images_fetch
+    plan.seconds = max(pages, plan.images_fetch) * interval
+    return plan
+
+
+def format_bytes(n: float):
+    for unit in ["B", "KiB", "MiB"]:
+        if n < 1024:
+            return f"{n:.1f} {unit}" if unit != "B" else f"{int(n)} {unit}"
+        n /= 1024
+    return f"{n:.1f} GiB"
+
+
+def format_plan(plan: Plan, label: str):
+    bytes_new = "?" if plan.bytes_new is None else f"~{format_bytes(plan.bytes_new)}"
+    return (
+        f"{label}: {plan.episodes} episodes "
+        f"(fetch: {plan.fetch}, revalidate: {plan.revalidate}, skip: {plan.skip}, reuse: {plan.reuse}, ignore: {plan.ignore}), "
+        f"images (fetch: ~{plan.images_fetch}, reuse: {plan.images_reuse}), "
+        f"bytes (reuse: {format_bytes(plan.bytes_reused)}, new: {bytes_new}), "
+        f"requests: {plan.requests}, "
+        f"estimated time: {datetime.timedelta(seconds=round(plan.seconds))}"
+    )
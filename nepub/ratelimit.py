@@ -0,0 +1,70 @@
+import os
+import threading
+import time
+from typing import Dict
+
+try:
+    import fcntl
+except ImportError:
+    # Windows では共有のレート制限は使えない
+    fcntl = None  # type: ignore[assignment]
+
+
+class RateLimiter:
+    # 同じホストへのリクエストの間隔を interval 秒以上空ける
+    def __init__(self, interval: float = 1.0):
+        self.interval = interval
+        self._last_requested_at: Dict[str, float] = {}
+        # ホストごとのロック (別のホストへのリクエストを待たせないように分ける)
+        self._locks: Dict[str, threading.Lock] = {}
+        self._locks_lock = threading.Lock()
+
+    def _lock(self, host: str):
+        with self._locks_lock:
+            lock = self._locks.get(host)
+            if lock is None:
+                lock = self._locks[host] = threading.Lock()
+            return lock
+
+    def wait(self, host: str):
+        # 待っている間も他のスレッドが同じ枠を使わないように、そのホストのロックを保持したまま待つ
+        with self._lock(host):
+            last_requested_at = self._last_requested_at.get(host, 0.0)
+            self._sleep_until(last_requested_at + self.interval)
+            self._last_requested_at[host] = time.time()
+
+    @staticmethod
+    def _sleep_until(t: float):
+        delay = t - time.time()
+        if delay > 0:
+            time.sleep(delay)
+
+
+class SharedRateLimiter(RateLimiter):
+    # ホストごとのロックファイルに最終リクエスト時刻を記録し、
+    # 同じディレクトリを指定したすべてのプロセスで間隔を共有する
+    # 最終リクエスト時刻はファイルに残るので、実行をまたいでも間隔が守られる
+    def __init__(self, directory: str, interval: float = 1.0):
+        if fcntl is None:
+            raise Exception("この OS では共有のレート制限を使用できません")
+        super().__init__(interval)
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+
+    def wait(self, host: str):
+        # 同じプロセス内のスレッド同士はプロセス内のホストごとのロックで順番を決める
+        with self._lock(host):
+            path = os.path.join(self.directory, f"{host}.lock")
+            with open(path, "a+b") as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    f.seek(0)
+                    data = f.read().strip()
+                    last_requested_at = float(data) if data else 0.0
+                    self._sleep_until(last_requested_at + self.interval)
+                    f.seek(0)
+                    f.truncate()
+                    f.write(repr(time.time()).encode("ascii"))
+                    f.flush()
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
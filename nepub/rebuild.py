@@ -0,0 +1,124 @@
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Sequence
+
+from nepub.__main__ import rerender_epub
+from nepub.epub import (
+    DEFAULT_NAV_GROUP_SIZE,
+    DEFAULT_SPLIT_SIZE,
+    FORMAT_VERSION,
+    load_metadata,
+)
+from nepub.events import JsonlReporter, emit, set_reporter
+from nepub.util import find_epubs
+
+
+def rebuild_epub(
+    path: str,
+    split_size: int | None = DEFAULT_SPLIT_SIZE,
+    nav_group_size: int | None = DEFAULT_NAV_GROUP_SIZE,
+):
+    # 既存のファイルと同じオプションで、保存済みの本文と挿絵から作り直す
+    metadata = load_metadata(path)
+    return rerender_epub(
+        metadata.novel_id,
+        metadata.illustration,
+        metadata.tcy,
+        path,
+        metadata.kakuyomu,
+        metadata.image_profile,
+        split_size,
+        nav_group_size,
+    )
+
+
+def rebuild_library(
+    paths: Sequence[str],
+    jobs: int | None = None,
+    force: bool = False,
+    split_size: int | None = DEFAULT_SPLIT_SIZE,
+    nav_group_size: int | None = DEFAULT_NAV_GROUP_SIZE,
+) -> List[str]:
+    # 出力形式が古いファイルをプロセスプールで並行して作り直し、作り直したファイルを返す
+    # force の場合は出力形式が最新のファイルも作り直す
+    targets: List[str] = []
+    up_to_date = 0
+    for path in find_epubs(paths):
+        if force or load_metadata(path).format_version < FORMAT_VERSION:
+            targets.append(path)
+        else:
+            up_to_date += 1
+            emit(
+                "rebuild_skipped",
+                f"Rebuild skipped (already up to date): {path}",
+                path=path,
+            )
+    rebuilt: List[str] = []
+    failed = 0
+    with ProcessPoolExecutor(jobs) as executor:
+        futures = [
+            (path, executor.submit(rebuild_epub, path, split_size, nav_group_size))
+            for path in targets
+        ]
+        for path, future in futures:
+            try:
+                if future.result():
+                    rebuilt.append(path)
+                    continue
+            except Exception as e:
+                emit("rebuild_failed", f"Rebuild failed: {path} ({e})", path=path)
+            failed += 1
+    emit(
+        "rebuild_complete",
+        f"Rebuild is complete! (rebuilt: {len(rebuilt)}, failed: {failed}, up to date: {up_to_date})",
+        rebuilt=len(rebuilt),
+        failed=failed,
+        up_to_date=up_to_date,
+    )
+    return rebuilt
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="nepub rebuild")
+    parser.add_argument(
+        "path", help="EPUB files or directories containing them", nargs="+"
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        metavar="<n>",
+        help="Number of worker processes (default: number of CPUs)",
+        type=int,
+    )
+    parser.add_argument(
+        "--force",
+        help="Rebuild files whose format is already up to date",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--split-size",
+        metavar="<chars>",
+        help=f"Split episodes longer than this many characters into several pages at paragraph boundaries. 0 disables splitting. (default: {DEFAULT_SPLIT_SIZE})",
+        type=int,
+        default=DEFAULT_SPLIT_SIZE,
+    )
+    parser.add_argument(
+        "--nav-group-size",
+        metavar="<n>",
+        help=f"Group more than this many episodes in the table of contents into nested blocks of <n> episodes. 0 keeps a flat list. (default: {DEFAULT_NAV_GROUP_SIZE})",
+        type=int,
+        default=DEFAULT_NAV_GROUP_SIZE,
+    )
+    parser.add_argument(
+        "--events",
+        help='Progress output format (default: "text"). "jsonl" emits one JSON event per line.',
+        choices=["text", "jsonl"],
+        default="text",
+    )
+    args = parser.parse_args(argv)
+    if args.events == "jsonl":
+        set_reporter(JsonlReporter())
+    rebuild_library(
+        args.path, args.jobs, args.force, args.split_size, args.nav_group_size
+    )
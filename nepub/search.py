@@ -0,0 +1,271 @@
+import argparse
+import sqlite3
+import time
+import zipfile
+from dataclasses import asdict, dataclass
+from typing import Iterable, List
+
+from nepub.epub import load_metadata, load_raw_episode, load_raw_index
+from nepub.events import JsonlReporter, emit, set_reporter
+from nepub.novel import get_episode_page_url
+from nepub.type import RawEpisode
+from nepub.util import find_epubs
+
+# nepub search で使う索引のデフォルトのファイル名
+DEFAULT_INDEX = "nepub-search.db"
+
+# 日本語は単語に区切れないので、3 文字ずつの n-gram (trigram) で索引を作る
+# trigram は 3 文字未満の語を MATCH で検索できないので、その場合は LIKE で全件を走査する
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS novels (
+    novel_id TEXT NOT NULL,
+    kakuyomu INTEGER NOT NULL,
+    title TEXT NOT NULL,
+    PRIMARY KEY (novel_id, kakuyomu)
+);
+CREATE TABLE IF NOT EXISTS episodes (
+    id INTEGER PRIMARY KEY,
+    novel_id TEXT NOT NULL,
+    kakuyomu INTEGER NOT NULL,
+    episode_id TEXT NOT NULL,
+    UNIQUE (novel_id, kakuyomu, episode_id)
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS texts USING fts5(
+    title, text, tokenize = 'trigram'
+);
+"""
+
+
+@dataclass(slots=True)
+class SearchHit:
+    novel_id: str
+    kakuyomu: bool
+    episode_id: str
+    novel_title: str
+    title: str
+    snippet: str
+
+    @property
+    def url(self):
+        return get_episode_page_url(self.novel_id, self.episode_id, self.kakuyomu)
+
+
+def plain_text(raw: RawEpisode):
+    # 中間形式の本文から検索用のテキストを作る
+    # ルビの読みは本文の語句を分断するので除く
+    lines: List[str] = []
+    for raw_paragraph in raw.paragraphs:
+        line = ""
+        in_rt = False
+        for run in raw_paragraph:
+            if isinstance(run, str):
+                if not in_rt:
+                    line += run
+            elif run[0] == "rt":
+                in_rt = True
+            elif run[0] == "/rt":
+                in_rt = False
+        if line.strip():
+            lines.append(line.strip())
+    return "\n".join(lines)
+
+
+class SearchIndex:
+    # (小説, エピソード) ごとにタイトルと本文を保持する全文検索の索引
+    # 更新は呼び出し側で commit するまで確定しない
+    def __init__(self, path: str):
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.executescript(SCHEMA)
+
+    def close(self):
+        self._db.close()
+
+    def commit(self):
+        self._db.commit()
+
+    def rollback(self):
+        self._db.rollback()
+
+    def set_novel(self, novel_id: str, kakuyomu: bool, title: str):
+        self._db.execute(
+            "INSERT OR REPLACE INTO novels VALUES (?, ?, ?)",
+            (novel_id, kakuyomu, title),
+        )
+
+    def _episode_rowid(self, novel_id: str, kakuyomu: bool, episode_id: str):
+        row = self._db.execute(
+            "SELECT id FROM episodes WHERE novel_id = ? AND kakuyomu = ? AND episode_id = ?",
+            (novel_id, kakuyomu, episode_id),
+        ).fetchone()
+        return None if row is None else row[0]
+
+    def has_episode(self, novel_id: str, kakuyomu: bool, episode_id: str):
+        return self._episode_rowid(novel_id, kakuyomu, episode_id) is not None
+
+    def replace_episode(
+        self, novel_id: str, kakuyomu: bool, episode_id: str, raw: RawEpisode
+    ):
+        # 更新されたエピソードは以前の内容を消してから登録し直す
+        rowid = self._episode_rowid(novel_id, kakuyomu, episode_id)
+        if rowid is None:
+            rowid = self._db.execute(
+                "INSERT INTO episodes (novel_id, kakuyomu, episode_id) VALUES (?, ?, ?)",
+                (novel_id, kakuyomu, episode_id),
+            ).lastrowid
+        else:
+            self._db.execute("DELETE FROM texts WHERE rowid = ?", (rowid,))
+        self._db.execute(
+            "INSERT INTO texts (rowid, title, text) VALUES (?, ?, ?)",
+            (rowid, raw.title.strip(), plain_text(raw)),
+        )
+
+    def retain(self, novel_id: str, kakuyomu: bool, episode_ids: Iterable[str]):
+        # 目次からなくなったエピソードを削除する
+        keep = set(episode_ids)
+        rows = self._db.execute(
+            "SELECT id, episode_id FROM episodes WHERE novel_id = ? AND kakuyomu = ?",
+            (novel_id, kakuyomu),
+        ).fetchall()
+        for rowid, episode_id in rows:
+            if episode_id not in keep:
+                self._db.execute("DELETE FROM texts WHERE rowid = ?", (rowid,))
+                self._db.execute("DELETE FROM episodes WHERE id = ?", (rowid,))
+
+    def search(self, query: str, limit: int = 20) -> List[SearchHit]:
+        query = query.strip()
+        if not query:
+            return []
+        select = """
+            SELECT e.novel_id, e.kakuyomu, e.episode_id, COALESCE(n.title, ''), t.title, {snippet}
+            FROM texts t
+            JOIN episodes e ON e.id = t.rowid
+            LEFT JOIN novels n ON n.novel_id = e.novel_id AND n.kakuyomu = e.kakuyomu
+            WHERE {where}
+            ORDER BY {order}
+            LIMIT ?
+        """
+        if len(query) >= 3:
+            # フレーズとして検索する
+            phrase = '"' + query.replace('"', '""') + '"'
+            sql = select.format(
+                snippet="snippet(texts, 1, '[', ']', '…', 24)",
+                where="texts MATCH ?",
+                order="rank",
+            )
+            params: tuple = (phrase, limit)
+        else:
+            pattern = (
+                "%"
+                + query.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+                + "%"
+            )
+            sql = select.format(
+                snippet="substr(t.text, max(instr(t.text, ?) - 20, 1), 50)",
+                where="t.title LIKE ? ESCAPE '\\' OR t.text LIKE ? ESCAPE '\\'",
+                order="e.id",
+            )
+            params = (query, pattern, pattern, limit)
+        return [
+            SearchHit(
+                novel_id,
+                bool(kakuyomu),
+                episode_id,
+                novel_title,
+                title,
+                snippet.replace("\n", " "),
+            )
+            for novel_id, kakuyomu, episode_id, novel_title, title, snippet in self._db.execute(
+                sql, params
+            )
+        ]
+
+
+def index_epub(search_index: SearchIndex, path: str):
+    # 作成済みの EPUB に保存されている中間形式の本文を索引に登録する
+    # 中間形式を保存していない古いファイルは登録できない
+    metadata = load_metadata(path)
+    with zipfile.ZipFile(path) as zf:
+        index = load_raw_index(zf)
+        if index is None:
+            return False
+        episode_ids = [
+            episode.id for chapter in index.chapters for episode in chapter.episodes
+        ]
+        for episode_id in episode_ids:
+            raw = load_raw_episode(zf, episode_id)
+            if raw is not None:
+                search_index.replace_episode(
+                    metadata.novel_id, metadata.kakuyomu, episode_id, raw
+                )
+    search_index.set_novel(metadata.novel_id, metadata.kakuyomu, index.title)
+    search_index.retain(metadata.novel_id, metadata.kakuyomu, episode_ids)
+    search_index.commit()
+    return True
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="nepub search")
+    parser.add_argument("query", help="Phrase to search for", nargs="?")
+    parser.add_argument(
+        "--index",
+        metavar="<file>",
+        help=f"Search index file (default: {DEFAULT_INDEX})",
+        default=DEFAULT_INDEX,
+    )
+    parser.add_argument(
+        "--add",
+        metavar="<path>",
+        help="Add EPUB files or directories containing them to the index before searching",
+        nargs="+",
+        default=[],
+    )
+    parser.add_argument(
+        "-n",
+        "--limit",
+        metavar="<n>",
+        help="Maximum number of hits (default: 20)",
+        type=int,
+        default=20,
+    )
+    parser.add_argument(
+        "--events",
+        help='Output format (default: "text"). "jsonl" emits one JSON event per line.',
+        choices=["text", "jsonl"],
+        default="text",
+    )
+    args = parser.parse_args(argv)
+    if args.query is None and not args.add:
+        parser.error("a query or --add is required")
+    if args.events == "jsonl":
+        set_reporter(JsonlReporter())
+    search_index = SearchIndex(args.index)
+    try:
+        for path in find_epubs(args.add):
+            if index_epub(search_index, path):
+                emit("indexed", f"Indexed {path}.", path=path)
+            else:
+                emit(
+                    "index_skipped",
+                    f"Index skipped as {path} does not contain the stored episode text.",
+                    path=path,
+                )
+        if args.query is None:
+            return
+        started_at = time.monotonic()
+        hits = search_index.search(args.query, args.limit)
+        elapsed = time.monotonic() - started_at
+        for hit in hits:
+            emit(
+                "search_hit",
+                f"{hit.novel_title} / {hit.title}: {hit.url}\n    {hit.snippet}",
+                url=hit.url,
+                **asdict(hit),
+            )
+        emit(
+            "search_done",
+            f"{len(hits)} hits ({elapsed * 1000:.1f} ms)",
+            hits=len(hits),
+            seconds=round(elapsed, 4),
+        )
+    finally:
+        search_index.close()
@@ -0,0 +1,377 @@
+import argparse
+import copy
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+import urllib.parse
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Tuple
+
+from nepub.__main__ import convert_narou_to_epub
+from nepub.events import JsonlReporter, emit, set_reporter
+from nepub.http import set_rate_limiter
+from nepub.image import IMAGE_PROFILES
+from nepub.metrics import JOBS, registry
+from nepub.ratelimit import SharedRateLimiter
+from nepub.type import Index
+
+# 小説は (novel_id, kakuyomu) で識別する
+NovelKey = Tuple[str, bool]
+
+
+@dataclass(slots=True)
+class Job:
+    id: int
+    novel_id: str
+    kakuyomu: bool
+    illustration: bool
+    tcy: bool
+    image_profile: str
+    # queued -> running -> done / stopped / failed
+    status: str = "queued"
+    error: str | None = None
+    created_at: float = field(default_factory=time.time)
+    finished_at: float | None = None
+    # 処理が終わるとセットされる
+    completed: threading.Event = field(default_factory=threading.Event)
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "novel_id": self.novel_id,
+            "kakuyomu": self.kakuyomu,
+            "illustration": self.illustration,
+            "tcy": self.tcy,
+            "image_profile": self.image_profile,
+            "status": self.status,
+            "error": self.error,
+            "created_at": self.created_at,
+            "finished_at": self.finished_at,
+        }
+
+
+class JobConflict(Exception):
+    # 同じ小説のジョブが異なるオプションで処理待ちまたは処理中の場合に送出する
+    def __init__(self, job: Job):
+        super().__init__(
+            f"a job for {job.novel_id} is already active with other options"
+        )
+        self.job = job
+
+
+class IndexCache:
+    # 直近に取得した目次を ttl 秒の間保持し、続けて作成・更新する場合は目次を取得し直さない
+    def __init__(self, ttl: float = 600.0, size: int = 64):
+        self.ttl = ttl
+        self.size = size
+        self._entries: "OrderedDict[NovelKey, Tuple[float, Index]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: NovelKey) -> Index | None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            cached_at, index = entry
+            if time.time() - cached_at > self.ttl:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            # 変換中にエピソードが書き換えられるので複製して渡す
+            return copy.deepcopy(index)
+
+    def put(self, key: NovelKey, index: Index):
+        with self._lock:
+            self._entries[key] = (time.time(), copy.deepcopy(index))
+            self._entries.move_to_end(key)
+            if len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+
+class BuildService:
+    # 作成・更新の要求をワーカーで順に処理する
+    # 同じ小説の要求が処理待ちまたは処理中の場合は、新しいジョブを作らずにそのジョブを返す
+    # (同じファイルに書き込むので、オプションが異なる場合は JobConflict を送出する)
+    def __init__(
+        self, output_dir: str, workers: int = 2, index_cache: IndexCache | None = None
+    ):
+        self.output_dir = output_dir
+        self.index_cache = index_cache or IndexCache()
+        self._executor = ThreadPoolExecutor(workers)
+        self._lock = threading.Lock()
+        self._next_id = 1
+        self._active: Dict[NovelKey, Job] = {}
+        self._latest: Dict[NovelKey, Job] = {}
+        # ファイルのパス -> (更新日時, サイズ, ETag)
+        self._etags: Dict[str, Tuple[float, int, str]] = {}
+        # 複数のリクエストから参照されるので、ジョブの管理とは別のロックで保護する (ハッシュ値の計算中は取得しない)
+        self._etags_lock = threading.Lock()
+
+    def output_path(self, novel_id: str, kakuyomu: bool = False):
+        # なろうとカクヨムで同じ ID の小説が同じファイルに書き込まれないよう、カクヨムは接頭辞を付ける
+        name = f"kakuyomu-{novel_id}" if kakuyomu else novel_id
+        return os.path.join(self.output_dir, f"{name}.epub")
+
+    def submit(
+        self,
+        novel_id: str,
+        kakuyomu: bool = False,
+        illustration: bool = False,
+        tcy: bool = True,
+        image_profile: str = "original",
+    ) -> Job:
+        key = (novel_id, kakuyomu)
+        with self._lock:
+            job = self._active.get(key)
+            if job is not None:
+                if (job.illustration, job.tcy, job.image_profile) != (
+                    illustration,
+                    tcy,
+                    image_profile,
+                ):
+                    raise JobConflict(job)
+                return job
+            job = Job(
+                self._next_id, novel_id, kakuyomu, illustration, tcy, image_profile
+            )
+            self._next_id += 1
+            self._active[key] = job
+            self._latest[key] = job
+            self._update_jobs_gauge()
+        self._executor.submit(self._run, job)
+        return job
+
+    def latest(self, novel_id: str, kakuyomu: bool = False) -> Job | None:
+        with self._lock:
+            return self._latest.get((novel_id, kakuyomu))
+
+    def etag(self, path: str):
+        # 内容が変わらなければファイルは同じバイト列になるので、内容のハッシュ値を ETag にする
+        stat = os.stat(path)
+        with self._etags_lock:
+            cached = self._etags.get(path)
+        if cached is not None and cached[:2] == (stat.st_mtime, stat.st_size):
+            return cached[2]
+        md5 = hashlib.md5()
+        with open(path, "rb") as f:
+            while chunk := f.read(64 * 1024):
+                md5.update(chunk)
+        etag = f'"{md5.hexdigest()}"'
+        with self._etags_lock:
+            self._etags[path] = (stat.st_mtime, stat.st_size, etag)
+        return etag
+
+    def shutdown(self):
+        self._executor.shutdown()
+
+    def _update_jobs_gauge(self):
+        # 処理待ち・処理中のジョブの数 (self._lock を取得した状態で呼ぶ)
+        for status in ("queued", "running"):
+            JOBS.set(
+                sum(job.status == status for job in self._active.values()),
+                status=status,
+            )
+
+    def _run(self, job: Job):
+        key = (job.novel_id, job.kakuyomu)
+        with self._lock:
+            job.status = "running"
+            self._update_jobs_gauge()
+        try:
+            index = convert_narou_to_epub(
+                job.novel_id,
+                job.illustration,
+                job.tcy,
+                "",
+                self.output_path(job.novel_id, job.kakuyomu),
+                job.kakuyomu,
+                image_profile=job.image_profile,
+                cached_index=self.index_cache.get(key),
+            )
+            if index is None:
+                # オプションが既存のファイルと異なる場合など
+                job.status = "stopped"
+            else:
+                self.index_cache.put(key, index)
+                job.status = "done"
+        except Exception as e:
+            job.status = "failed"
+            job.error = str(e)
+        finally:
+            job.finished_at = time.time()
+            with self._lock:
+                del self._active[key]
+                self._update_jobs_gauge()
+            job.completed.set()
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    # POST /novels/{novel_id}      作成・更新を要求する (202 とジョブの状態を返す)
+    #                              異なるオプションのジョブが処理待ち・処理中の場合は 409 を返す
+    # GET  /novels/{novel_id}      直近のジョブの状態を返す
+    # GET  /novels/{novel_id}.epub 作成済みの EPUB を返す (If-None-Match に対応)
+    # GET  /metrics                 Prometheus のテキスト形式でメトリクスを返す
+    # いずれも ?kakuyomu=1 でカクヨムの小説を指定する
+    # POST では illustration, tcy, image_profile も指定でき、wait=1 の場合は処理が終わるまで待つ
+    service: BuildService
+
+    def do_POST(self):
+        novel_id, epub, query = self._parse_path()
+        if novel_id is None or epub:
+            return self._send_json(404, {"error": "not found"})
+        image_profile = query.get("image_profile", "original")
+        if image_profile not in IMAGE_PROFILES:
+            return self._send_json(400, {"error": "unknown image_profile"})
+        try:
+            job = self.service.submit(
+                novel_id,
+                self._flag(query, "kakuyomu", False),
+                self._flag(query, "illustration", False),
+                self._flag(query, "tcy", True),
+                image_profile,
+            )
+        except JobConflict as e:
+            return self._send_json(409, {"error": str(e), "job": e.job.to_dict()})
+        if self._flag(query, "wait", False):
+            job.completed.wait()
+            return self._send_json(200, job.to_dict())
+        self._send_json(202, job.to_dict())
+
+    def do_GET(self):
+        if urllib.parse.urlsplit(self.path).path == "/metrics":
+            data = registry.render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+            return
+        novel_id, epub, query = self._parse_path()
+        if novel_id is None:
+            return self._send_json(404, {"error": "not found"})
+        if not epub:
+            job = self.service.latest(novel_id, self._flag(query, "kakuyomu", False))
+            if job is None:
+                return self._send_json(404, {"error": "no job"})
+            return self._send_json(200, job.to_dict())
+        path = self.service.output_path(novel_id, self._flag(query, "kakuyomu", False))
+        try:
+            f = open(path, "rb")
+        except FileNotFoundError:
+            return self._send_json(404, {"error": "not built yet"})
+        with f:
+            etag = self.service.etag(path)
+            if self.headers.get("If-None-Match") == etag:
+                self.send_response(304)
+                self.send_header("ETag", etag)
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", "application/epub+zip")
+            self.send_header("Content-Length", str(os.fstat(f.fileno()).st_size))
+            self.send_header("ETag", etag)
+            self.end_headers()
+            shutil.copyfileobj(f, self.wfile)
+
+    def _parse_path(self):
+        parts = urllib.parse.urlsplit(self.path)
+        query = dict(urllib.parse.parse_qsl(parts.query))
+        segments = parts.path.strip("/").split("/")
+        if len(segments) != 2 or segments[0] != "novels" or not segments[1]:
+            return None, False, query
+        novel_id = segments[1]
+        epub = novel_id.endswith(".epub")
+        if epub:
+            novel_id = novel_id.removesuffix(".epub")
+        # パスに使うので英数字のみ受け付ける
+        if not novel_id.isascii() or not novel_id.isalnum():
+            return None, False, query
+        return novel_id, epub, query
+
+    @staticmethod
+    def _flag(query: Dict[str, str], name: str, default: bool):
+        if name not in query:
+            return default
+        return query[name] not in ("0", "false", "")
+
+    def _send_json(self, code: int, body):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def make_server(host: str, port: int, service: BuildService):
+    handler = type("Handler", (RequestHandler,), {"service": service})
+    return ThreadingHTTPServer((host, port), handler)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="nepub serve")
+    parser.add_argument(
+        "--host", help="Address to listen on (default: 127.0.0.1)", default="127.0.0.1"
+    )
+    parser.add_argument(
+        "--port", help="Port to listen on (default: 8080)", type=int, default=8080
+    )
+    parser.add_argument(
+        "--output-dir",
+        metavar="<dir>",
+        help="Directory to store the built EPUBs (default: current directory)",
+        default=".",
+    )
+    parser.add_argument(
+        "--workers",
+        metavar="<n>",
+        help="Number of novels built at the same time (default: 2)",
+        type=int,
+        default=2,
+    )
+    parser.add_argument(
+        "--index-ttl",
+        metavar="<seconds>",
+        help="Reuse a fetched index for this many seconds (default: 600)",
+        type=float,
+        default=600.0,
+    )
+    parser.add_argument(
+        "--shared-rate-limit",
+        metavar="<dir>",
+        help="Share the per-host request interval with other nepub processes through lock files in <dir>",
+        type=str,
+    )
+    parser.add_argument(
+        "--events",
+        help='Progress output format (default: "text"). "jsonl" emits one JSON event per line.',
+        choices=["text", "jsonl"],
+        default="text",
+    )
+    args = parser.parse_args(argv)
+    if args.events == "jsonl":
+        set_reporter(JsonlReporter())
+    if args.shared_rate_limit:
+        set_rate_limiter(SharedRateLimiter(args.shared_rate_limit))
+    os.makedirs(args.output_dir, exist_ok=True)
+    service = BuildService(args.output_dir, args.workers, IndexCache(args.index_ttl))
+    server = make_server(args.host, args.port, service)
+    emit(
+        "serving",
+        f"Serving on http://{args.host}:{server.server_port}/",
+        host=args.host,
+        port=server.server_port,
+    )
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.shutdown()
@@ -1,44 +1,176 @@
-from typing import Dict, List, TypedDict
+from __future__ import annotations
 
+import io
+from dataclasses import asdict, dataclass, field
+from typing import IO, Any, Dict, List, Sequence
 
-class Episode(TypedDict):
+# エピソード数に比例して生成されるので、メモリ使用量を抑えるため __slots__ を使う
+
+
+@dataclass(slots=True)
+class Episode:
     id: str
+    title: str = ""
+    created_at: str = ""
+    updated_at: str = ""
+    # 本文は取得したエピソードだけが持つ
+    # 目次から作られたエピソードは共有の空タプルを参照する
+    paragraphs: Sequence[str] = ()
+    fetched: bool = False
+    # 長いエピソードを分割して書き込んだ XHTML の数
+    parts: int = 1
+    # オプションによらない中間形式の本文
+    # --rerender で取得し直さずに HTML を作り直すために EPUB に保存する
+    raw: RawEpisode | None = None
+    # 条件付き GET の検証子 (ETag, Last-Modified)
+    # 値がある場合は条件付き GET を行い、取得時にレスポンスの値で置き換えられる
+    validators: Dict[str, str] | None = None
+
+
+@dataclass(slots=True)
+class RawEpisode:
+    # 変換前のタイトル
     title: str
-    created_at: str
-    updated_at: str
-    paragraphs: List[str]
-    fetched: bool
+    # 段落ごとのテキストとタグの目印 (["ruby"], ["/ruby"], ["rt"], ["/rt"], ["img", alt, src]) の並び
+    paragraphs: Sequence[Sequence[Any]]
+    # img の src -> 取得した画像のファイル名
+    images: Dict[str, str] = field(default_factory=dict)
+
+    @classmethod
+    def from_dict(cls, d: Dict[str, Any]) -> RawEpisode:
+        return cls(d["title"], d["paragraphs"], d["images"])
 
+    def to_dict(self) -> Dict[str, Any]:
+        return asdict(self)
 
-class Chapter(TypedDict):
+
+@dataclass(slots=True)
+class Chapter:
     name: str
-    episodes: List[Episode]
+    episodes: List[Episode] = field(default_factory=list)
+
+
+@dataclass(slots=True)
+class NavItem:
+    # 目次 (navigation.xhtml) の項目
+    # children を持つ項目は章またはエピソードのまとまりで、id は最初のエピソードを指す
+    id: str
+    title: str
+    children: List[NavItem] = field(default_factory=list)
+
 
+@dataclass(slots=True)
+class Index:
+    title: str
+    author: str
+    chapters: List[Chapter]
+
+
+@dataclass(slots=True)
+class NovelStatus:
+    # なろう小説 API で取得した小説の更新状況
+    novel_id: str
+    # 最終掲載日と最終更新日 (目次と同じ "2000/01/02 00:00" の形式)
+    general_lastup: str
+    novelupdated_at: str
+    # エピソード数
+    episodes: int
 
-class Image(TypedDict):
+
+@dataclass(slots=True)
+class Image:
     id: str
     name: str
     type: str
-    data: bytes
+    # 取得した画像はメモリに載せきらず、一定のサイズを超えるとディスクに書き出す一時ファイルで持つ
+    data: bytes | IO[bytes]
+
+    def open(self) -> IO[bytes]:
+        # 先頭から読み出せるストリームを返す
+        if isinstance(self.data, bytes):
+            return io.BytesIO(self.data)
+        self.data.seek(0)
+        return self.data
+
+    @property
+    def size(self) -> int:
+        if isinstance(self.data, bytes):
+            return len(self.data)
+        return self.data.seek(0, io.SEEK_END)
 
 
-class MetadataImage(TypedDict):
+@dataclass(slots=True)
+class ImageProfile:
+    variant: str
+    max_size: int | None
+    quality: int | None
+
+
+@dataclass(slots=True)
+class MetadataImage:
     id: str
     name: str
     type: str
 
+    @classmethod
+    def from_dict(cls, d: Dict[str, Any]) -> MetadataImage:
+        return cls(d["id"], d["name"], d["type"])
+
 
-class MetadataEpisode(TypedDict):
+@dataclass(slots=True)
+class MetadataEpisode:
     id: str
     title: str
     created_at: str
     updated_at: str
-    images: List[MetadataImage]
+    # hash を持たない古い metadata.json の場合は空文字になる
+    hash: str = ""
+    images: Sequence[MetadataImage] = ()
+    # 長いエピソードを分割して書き込んだ XHTML の数
+    parts: int = 1
+    # --revalidate の条件付き GET に使う検証子 (ETag, Last-Modified)
+    validators: Dict[str, str] = field(default_factory=dict)
 
+    @classmethod
+    def from_dict(cls, d: Dict[str, Any]) -> MetadataEpisode:
+        return cls(
+            d["id"],
+            d["title"],
+            d["created_at"],
+            d["updated_at"],
+            d.get("hash", ""),
+            tuple(MetadataImage.from_dict(image) for image in d["images"]),
+            d.get("parts", 1),
+            d.get("validators", {}),
+        )
 
-class Metadata(TypedDict):
+
+@dataclass(slots=True)
+class Metadata:
     novel_id: str
-    kakuyomu: bool
-    illustration: bool
-    tcy: bool
-    episodes: Dict[str, MetadataEpisode]
+    kakuyomu: bool = False
+    illustration: bool = False
+    tcy: bool = False
+    image_profile: str = "original"
+    episodes: Dict[str, MetadataEpisode] = field(default_factory=dict)
+    # 出力形式のバージョン (古い metadata.json の場合は 0)
+    format_version: int = 0
+
+    @classmethod
+    def from_dict(cls, d: Dict[str, Any]) -> Metadata:
+        # 古い metadata.json に存在しない項目はデフォルト値を使う
+        return cls(
+            d["novel_id"],
+            d.get("kakuyomu", False),
+            d.get("illustration", False),
+            d.get("tcy", False),
+            d.get("image_profile", "original"),
+            {
+                episode_id: MetadataEpisode.from_dict(episode)
+                for episode_id, episode in d["episodes"].items()
+            },
+            d.get("format_version", 0),
+        )
+
+    def to_dict(self) -> Dict[str, Any]:
+        return asdict(self)
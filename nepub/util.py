@@ -1,6 +1,18 @@
+import bisect
+import glob
+import hashlib
+import math
+import os
 import re
+from typing import List, Sequence, Tuple
 
-RANGE_PATTERN = re.compile(r"[1-9][0-9]*(-[1-9][0-9]*)?(,[1-9][0-9]*(-[1-9][0-9]*)?)*")
+from nepub.type import Episode
+
+RANGE_ITEM_PATTERN = re.compile(
+    r"(?P<start>[1-9][0-9]*)(?P<hyphen>-(?P<end>[1-9][0-9]*)?)?"
+    r"|last:(?P<last>[1-9][0-9]*)"
+    r"|since:(?P<since>[0-9]{4}-[0-9]{2}-[0-9]{2})"
+)
 
 
 def half_to_full(c: str):
@@ -96,19 +108,104 @@ def tcy(text: str):
     return text
 
 
-def range_to_episode_nums(my_range: str):
+class EpisodeRange:
+    # 取得対象のエピソード番号を区間の集合として持つ
+    # 区間を展開しないので、エピソード数が多くても範囲指定の大きさによらず動作する
+    def __init__(
+        self,
+        intervals: List[Tuple[int, int | None]],
+        last: int | None = None,
+        since: str | None = None,
+    ):
+        # 重なっている区間や隣接している区間はまとめておく
+        merged: List[Tuple[int, int | None]] = []
+        # 終わりのない区間 (end が None) は同じ開始位置の区間の後ろに並べる
+        for start, end in sorted(
+            intervals, key=lambda iv: (iv[0], math.inf if iv[1] is None else iv[1])
+        ):
+            if merged:
+                prev_start, prev_end = merged[-1]
+                if prev_end is None or start <= prev_end + 1:
+                    merged[-1] = (
+                        prev_start,
+                        None if prev_end is None or end is None else max(prev_end, end),
+                    )
+                    continue
+            merged.append((start, end))
+        self.intervals = merged
+        self._starts = [start for start, _ in merged]
+        self.last = last
+        self.since = since
+
+    @property
+    def needs_total(self):
+        # last: の指定は目次に含まれるエピソード数が分からないと判定できない
+        return self.last is not None
+
+    def contains(self, num: int, total: int, episode: Episode):
+        # num は 1 始まりのエピソード番号、total は目次に含まれるエピソード数
+        i = bisect.bisect_right(self._starts, num) - 1
+        if i >= 0:
+            end = self.intervals[i][1]
+            if end is None or num <= end:
+                return True
+        if self.last is not None and num > total - self.last:
+            return True
+        if self.since is not None and episode_date(episode) >= self.since:
+            return True
+        return False
+
+
+def parse_range(my_range: str):
     my_range = my_range.replace(" ", "")
-    if not RANGE_PATTERN.fullmatch(my_range):
-        raise Exception(f"range が想定しない形式です: {my_range}")
-    episode_nums: set[str] = set([])
+    intervals: List[Tuple[int, int | None]] = []
+    last: int | None = None
+    since: str | None = None
     for r in my_range.split(","):
-        if "-" in r:
-            start, end = r.split("-")
-            if int(end) > 10_000:
-                # 安全のため値が大きすぎる場合はエラーにする
-                raise Exception(f"range に含まれる値が大きすぎます: {end}")
-            for i in range(int(start), int(end) + 1):
-                episode_nums.add(str(i))
+        m = RANGE_ITEM_PATTERN.fullmatch(r)
+        if not m:
+            raise Exception(f"range が想定しない形式です: {my_range}")
+        if m.group("last"):
+            last = max(last or 0, int(m.group("last")))
+        elif m.group("since"):
+            if since is None or m.group("since") < since:
+                since = m.group("since")
+        else:
+            start = int(m.group("start"))
+            if not m.group("hyphen"):
+                intervals.append((start, start))
+            elif m.group("end"):
+                end = int(m.group("end"))
+                if end < start:
+                    raise Exception(f"range が想定しない形式です: {my_range}")
+                intervals.append((start, end))
+            else:
+                # 終わりを省略した場合は最後のエピソードまでを対象にする
+                intervals.append((start, None))
+    return EpisodeRange(intervals, last, since)
+
+
+def episode_date(episode: Episode):
+    # なろうは "2000/01/02 00:00"、カクヨムは "2000-01-02T00:00:00Z" の形式なので
+    # 日付部分を "2000-01-02" の形式にそろえる
+    return max(episode.created_at, episode.updated_at)[:10].replace("/", "-")
+
+
+def episode_hash(title: str, paragraphs: Sequence[str]):
+    # エピソードの内容の変更検出に使う
+    md5 = hashlib.md5(title.encode("utf-8"))
+    for paragraph in paragraphs:
+        md5.update(b"\n")
+        md5.update(paragraph.encode("utf-8"))
+    return md5.hexdigest()
+
+
+def find_epubs(paths: Sequence[str]) -> List[str]:
+    # ディレクトリが指定された場合は直下の *.epub を対象にする
+    files: List[str] = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(glob.glob(os.path.join(path, "*.epub"))))
         else:
-            episode_nums.add(r)
-    return episode_nums
+            files.append(path)
+    return files
@@ -21,6 +21,7 @@ setup(
     url="https://github.com/ttk1/nepub",
     license=license,
     install_requires=install_requires,
+    extras_require={"image": ["Pillow"]},
     packages=find_packages(exclude=("test",)),
     package_data={"": ["files/*", "templates/*"]},
     entry_points=entry_points,
@@ -0,0 +1,153 @@
+import json
+import tempfile
+import threading
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List
+from unittest import TestCase
+from unittest.mock import patch
+
+from nepub.api import (
+    changed_novels,
+    fetch_novel_status,
+    novel_changed,
+    set_narou_api_url,
+)
+from nepub.epub import EpubWriter
+from nepub.ratelimit import RateLimiter
+from nepub.type import (
+    Chapter,
+    Episode,
+    Metadata,
+    MetadataEpisode,
+    NovelStatus,
+)
+
+NOVELS = {
+    "n0001aa": ("2000-01-02 00:00:00", "2000-01-02 00:00:30", 2),
+    "n0002aa": ("2000-01-03 00:00:00", "2000-01-03 00:00:00", 3),
+}
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    # なろう小説 API の代わりに NOVELS の内容を返す
+    queries: List[dict] = []
+
+    def do_GET(self):
+        query = dict(urllib.parse.parse_qsl(urllib.parse.urlsplit(self.path).query))
+        self.queries.append(query)
+        ncodes = [ncode for ncode in query["ncode"].split("-") if ncode in NOVELS]
+        body = [{"allcount": len(ncodes)}] + [
+            {
+                "ncode": ncode.upper(),
+                "general_lastup": NOVELS[ncode][0],
+                "novelupdated_at": NOVELS[ncode][1],
+                "general_all_no": NOVELS[ncode][2],
+            }
+            for ncode in ncodes
+        ]
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def metadata(*episodes: MetadataEpisode):
+    return Metadata("n0001aa", episodes={episode.id: episode for episode in episodes})
+
+
+class TestApi(TestCase):
+    def setUp(self):
+        StubHandler.queries = []
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        set_narou_api_url(f"http://127.0.0.1:{self.server.server_port}/novelapi/api/")
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        set_narou_api_url("https://api.syosetu.com/novelapi/api/")
+
+    @patch("nepub.events.reporter")
+    @patch("nepub.http.rate_limiter", RateLimiter(0))
+    def test_fetch_novel_status(self, _):
+        with patch("nepub.api.NAROU_API_LIMIT", 1):
+            statuses = fetch_novel_status(["n0001aa", "n0002aa", "n9999zz"])
+        self.assertEqual(
+            {
+                "n0001aa": NovelStatus(
+                    "n0001aa", "2000/01/02 00:00", "2000/01/02 00:00", 2
+                ),
+                "n0002aa": NovelStatus(
+                    "n0002aa", "2000/01/03 00:00", "2000/01/03 00:00", 3
+                ),
+            },
+            statuses,
+        )
+        # 上限を超える場合は分けて問い合わせる
+        self.assertEqual(
+            ["n0001aa", "n0002aa", "n9999zz"],
+            [query["ncode"] for query in StubHandler.queries],
+        )
+
+    def test_novel_changed(self):
+        status = NovelStatus("n0001aa", "2000/01/02 00:00", "2000/01/03 00:00", 2)
+        episode1 = MetadataEpisode("1", "", "2000/01/01 00:00", "")
+        episode2 = MetadataEpisode("2", "", "2000/01/02 00:00", "2000/01/03 00:00")
+        self.assertFalse(novel_changed(status, metadata(episode1, episode2)))
+        # 取得できなかった場合や既存のファイルがない場合は変更ありとする
+        self.assertTrue(novel_changed(None, metadata(episode1, episode2)))
+        self.assertTrue(novel_changed(status, None))
+        # エピソードの追加
+        self.assertTrue(novel_changed(status, metadata(episode1)))
+        # 新しいエピソードの掲載
+        self.assertTrue(
+            novel_changed(
+                NovelStatus("n0001aa", "2000/01/04 00:00", "2000/01/04 00:00", 2),
+                metadata(episode1, episode2),
+            )
+        )
+        # エピソードの改稿
+        self.assertTrue(
+            novel_changed(
+                NovelStatus("n0001aa", "2000/01/02 00:00", "2000/01/04 00:00", 2),
+                metadata(episode1, episode2),
+            )
+        )
+
+    @patch("nepub.events.reporter")
+    def test_changed_novels(self, _):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            outputs = {
+                novel_id: f"{tmp_dir}/{novel_id}.epub"
+                for novel_id in ["n0001aa", "n0002aa", "n0003aa"]
+            }
+            # n0001aa は最新、n0002aa はエピソードが 1 つ増えている、n0003aa は未作成
+            for novel_id in ["n0001aa", "n0002aa"]:
+                chapters = [
+                    Chapter(
+                        "default",
+                        [
+                            Episode("1", "たいとる1", "2000/01/01 00:00"),
+                            Episode("2", "たいとる2", "2000/01/02 00:00"),
+                        ],
+                    )
+                ]
+                with open(outputs[novel_id], "wb") as f:
+                    with EpubWriter(f, novel_id, False, False, True) as writer:
+                        for episode in chapters[0].episodes:
+                            writer.add_episode(episode, [])
+                        writer.finish("たいとる", "作者", "", chapters)
+            self.assertEqual(
+                ["n0002aa", "n0003aa"],
+                changed_novels(["n0001aa", "n0002aa", "n0003aa"], outputs),
+            )
+        # 既存のファイルがある小説だけを 1 回で問い合わせる
+        self.assertEqual(
+            ["n0001aa-n0002aa"], [query["ncode"] for query in StubHandler.queries]
+        )
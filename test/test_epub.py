@@ -1,6 +1,29 @@
+import dataclasses
+import io
+import json
+import zipfile
 from unittest import TestCase
+from unittest.mock import patch
 
-from nepub.epub import content, nav, text
+from nepub.epub import (
+    EpubWriter,
+    content,
+    load_metadata,
+    load_raw_episode,
+    load_raw_index,
+    nav,
+    nav_items,
+    text,
+)
+from nepub.type import (
+    Chapter,
+    Episode,
+    Image,
+    MetadataEpisode,
+    MetadataImage,
+    NavItem,
+    RawEpisode,
+)
 
 
 class TestEpub(TestCase):
@@ -19,7 +42,9 @@ class TestEpub(TestCase):
         <item media-type="application/xhtml+xml" id="nav" href="navigation.xhtml" properties="nav" />
         <item media-type="text/css" id="style" href="style.css" />
         <item media-type="application/json" id="metadata" href="metadata.json" />
+        <item media-type="application/json" id="raw-index" href="raw/index.json" />
         <item media-type="application/xhtml+xml" id="001" href="text/001.xhtml" />
+        <item media-type="application/json" id="raw-001" href="raw/001.json" />
         <item media-type="application/xhtml+xml" id="002" href="text/002.xhtml" />
         <item media-type="image/jpeg" id="003" href="image/003.jpg" />
     </manifest>
@@ -33,30 +58,11 @@ class TestEpub(TestCase):
                 "作者",
                 "2022-01-01T00:00:00Z",
                 [
-                    {
-                        "id": "001",
-                        "title": "たいとる1",
-                        "created_at": "",
-                        "updated_at": "",
-                        "paragraphs": [],
-                        "fetched": False,
-                    },
-                    {
-                        "id": "002",
-                        "title": "たいとる2",
-                        "created_at": "",
-                        "updated_at": "",
-                        "paragraphs": [],
-                        "fetched": False,
-                    },
-                ],
-                [
-                    {
-                        "id": "003",
-                        "name": "003.jpg",
-                        "type": "image/jpeg",
-                    }
+                    Episode(id="001", title="たいとる1"),
+                    Episode(id="002", title="たいとる2"),
                 ],
+                [MetadataImage("003", "003.jpg", "image/jpeg")],
+                {"001"},
             ),
         )
 
@@ -94,45 +100,30 @@ class TestEpub(TestCase):
                 </li>
             </ol>
         </nav>
+        <nav epub:type="landmarks" hidden="">
+            <h1>Landmarks</h1>
+            <ol>
+                <li>
+                    <a epub:type="toc" href="navigation.xhtml">Navigation</a>
+                </li>
+                <li>
+                    <a epub:type="bodymatter" href="text/001.xhtml">Start</a>
+                </li>
+            </ol>
+        </nav>
     </body>
 </html>""",
             nav(
                 [
-                    {"name": "default", "episodes": []},
-                    {
-                        "name": "ちゃぷたー1",
-                        "episodes": [
-                            {
-                                "id": "001",
-                                "title": "たいとる1",
-                                "created_at": "",
-                                "updated_at": "",
-                                "paragraphs": [],
-                                "fetched": False,
-                            },
-                            {
-                                "id": "002",
-                                "title": "たいとる2",
-                                "created_at": "",
-                                "updated_at": "",
-                                "paragraphs": [],
-                                "fetched": False,
-                            },
-                        ],
-                    },
-                    {
-                        "name": "ちゃぷたー2",
-                        "episodes": [
-                            {
-                                "id": "003",
-                                "title": "たいとる3",
-                                "created_at": "",
-                                "updated_at": "",
-                                "paragraphs": [],
-                                "fetched": False,
-                            }
+                    Chapter("default"),
+                    Chapter(
+                        "ちゃぷたー1",
+                        [
+                            Episode(id="001", title="たいとる1"),
+                            Episode(id="002", title="たいとる2"),
                         ],
-                    },
+                    ),
+                    Chapter("ちゃぷたー2", [Episode(id="003", title="たいとる3")]),
                 ]
             ),
         )
@@ -158,35 +149,63 @@ class TestEpub(TestCase):
                 </li>
             </ol>
         </nav>
+        <nav epub:type="landmarks" hidden="">
+            <h1>Landmarks</h1>
+            <ol>
+                <li>
+                    <a epub:type="toc" href="navigation.xhtml">Navigation</a>
+                </li>
+                <li>
+                    <a epub:type="bodymatter" href="text/001.xhtml">Start</a>
+                </li>
+            </ol>
+        </nav>
     </body>
 </html>""",
             nav(
                 [
-                    {
-                        "name": "default",
-                        "episodes": [
-                            {
-                                "id": "001",
-                                "title": "たいとる1",
-                                "created_at": "",
-                                "updated_at": "",
-                                "paragraphs": [],
-                                "fetched": False,
-                            },
-                            {
-                                "id": "002",
-                                "title": "たいとる2",
-                                "created_at": "",
-                                "updated_at": "",
-                                "paragraphs": [],
-                                "fetched": False,
-                            },
+                    Chapter(
+                        "default",
+                        [
+                            Episode(id="001", title="たいとる1"),
+                            Episode(id="002", title="たいとる2"),
                         ],
-                    }
+                    )
                 ]
             ),
         )
 
+    def test_nav_items(self):
+        chapters = [
+            Chapter(
+                "default", [Episode(id=f"{i:03}", title=f"{i}") for i in range(1, 6)]
+            ),
+            Chapter("ちゃぷたー1", [Episode(id="006", title="6")]),
+        ]
+        self.assertEqual(
+            [
+                NavItem(
+                    "001",
+                    "1〜2",
+                    [NavItem("001", "1"), NavItem("002", "2")],
+                ),
+                NavItem(
+                    "003",
+                    "3〜4",
+                    [NavItem("003", "3"), NavItem("004", "4")],
+                ),
+                NavItem("005", "5", [NavItem("005", "5")]),
+                NavItem("006", "ちゃぷたー1", [NavItem("006", "6")]),
+            ],
+            nav_items(chapters, 2),
+        )
+        # まとめない場合は章のないエピソードを最上位に並べる
+        self.assertEqual(
+            [NavItem(f"{i:03}", f"{i}") for i in range(1, 6)]
+            + [NavItem("006", "ちゃぷたー1", [NavItem("006", "6")])],
+            nav_items(chapters, 0),
+        )
+
     def test_text(self):
         self.assertEqual(
             """<?xml version="1.0" encoding="UTF-8"?>
@@ -211,3 +230,193 @@ class TestEpub(TestCase):
                 ],
             ),
         )
+
+    def test_epub_writer(self):
+        buff = io.BytesIO()
+        episode = Episode(
+            id="1",
+            title="たいとる1",
+            created_at="2000/01/01 00:00",
+            paragraphs=["だんらく1"],
+            fetched=True,
+            raw=RawEpisode("たいとる1", [["だんらく1"]]),
+        )
+        image = Image("003", "003.jpg", "image/jpeg", b"test_data")
+        with EpubWriter(buff, "xxxx", False, True, True) as writer:
+            writer.add_episodes(
+                [(episode, [image]), (dataclasses.replace(episode, id="2"), [image])]
+            )
+            writer.finish(
+                "たいとる",
+                "作者",
+                "2022-01-01T00:00:00Z",
+                [Chapter("default", [episode])],
+            )
+        # 書き込んだ本文は解放される
+        self.assertEqual((), episode.paragraphs)
+        with zipfile.ZipFile(buff) as zf:
+            self.assertEqual("mimetype", zf.namelist()[0])
+            self.assertEqual(
+                [
+                    "mimetype",
+                    "src/image/003.jpg",
+                    "src/text/1.xhtml",
+                    "src/raw/1.json",
+                    "src/text/2.xhtml",
+                    "src/raw/2.json",
+                    "META-INF/container.xml",
+                    "src/style.css",
+                    "src/content.opf",
+                    "src/navigation.xhtml",
+                    "src/metadata.json",
+                    "src/raw/index.json",
+                ],
+                zf.namelist(),
+            )
+            # 中間形式の本文と目次が保存される
+            self.assertEqual(
+                RawEpisode("たいとる1", [["だんらく1"]]), load_raw_episode(zf, "1")
+            )
+            self.assertIsNone(load_raw_episode(zf, "3"))
+            index = load_raw_index(zf)
+            assert index is not None
+            self.assertEqual(("たいとる", "作者"), (index.title, index.author))
+            self.assertEqual(
+                ["1"], [episode.id for episode in index.chapters[0].episodes]
+            )
+            self.assertIn("<p>だんらく1</p>", zf.read("src/text/1.xhtml").decode())
+            metadata = json.loads(zf.read("src/metadata.json"))
+            self.assertEqual(
+                {
+                    "id": "1",
+                    "title": "たいとる1",
+                    "created_at": "2000/01/01 00:00",
+                    "updated_at": "",
+                    "hash": metadata["episodes"]["1"]["hash"],
+                    "images": [{"id": "003", "name": "003.jpg", "type": "image/jpeg"}],
+                    "parts": 1,
+                    "validators": {},
+                },
+                metadata["episodes"]["1"],
+            )
+        self.assertEqual(
+            MetadataEpisode(
+                "1",
+                "たいとる1",
+                "2000/01/01 00:00",
+                "",
+                metadata["episodes"]["1"]["hash"],
+                (MetadataImage("003", "003.jpg", "image/jpeg"),),
+            ),
+            load_metadata(buff).episodes["1"],
+        )
+
+    def test_epub_writer_split(self):
+        buff = io.BytesIO()
+        episode = Episode("1", "たいとる1", paragraphs=["あ" * 4, "い" * 4, "う" * 4])
+        chapters = [Chapter("default", [episode])]
+        with EpubWriter(buff, "xxxx", False, False, True, split_size=8) as writer:
+            writer.add_episode(episode, [])
+            writer.finish("たいとる", "作者", "2022-01-01T00:00:00Z", chapters)
+        self.assertEqual(2, episode.parts)
+        self.assertEqual(2, load_metadata(buff).episodes["1"].parts)
+        with zipfile.ZipFile(buff) as zf_old:
+            # 段落の区切りで分割し、見出しは最初の XHTML にだけ付ける
+            part1 = zf_old.read("src/text/1.xhtml").decode()
+            part2 = zf_old.read("src/text/1-2.xhtml").decode()
+            self.assertIn("<h1>たいとる1</h1>", part1)
+            self.assertIn("<p>いいいい</p>", part1)
+            self.assertNotIn("<h1>", part2)
+            self.assertIn("<p>うううう</p>", part2)
+            opf = zf_old.read("src/content.opf").decode()
+            self.assertIn('id="1-2" href="text/1-2.xhtml"', opf)
+            self.assertIn('<itemref linear="yes" idref="1-2" />', opf)
+
+            # 再利用する場合は分割した XHTML をすべて取り出す
+            buff2 = io.BytesIO()
+            reused = Episode("1", "たいとる1")
+            with EpubWriter(buff2, "xxxx", False, False, True) as writer:
+                metadata = load_metadata(buff)
+                writer.reuse_episode(
+                    reused, metadata.episodes["1"], zf_old, metadata.format_version
+                )
+                writer.finish(
+                    "たいとる",
+                    "作者",
+                    "2022-01-01T00:00:00Z",
+                    [Chapter("default", [reused])],
+                )
+        self.assertEqual(2, reused.parts)
+        with zipfile.ZipFile(buff2) as zf:
+            self.assertEqual(part2, zf.read("src/text/1-2.xhtml").decode())
+
+    def test_epub_writer_reuse_compressed(self):
+        buff = io.BytesIO()
+        with zipfile.ZipFile(buff, "w") as zf:
+            zf.writestr("src/image/003.jpg", b"test_data" * 100, zipfile.ZIP_STORED)
+            zf.writestr("src/text/1.xhtml", "だんらく" * 100, zipfile.ZIP_DEFLATED)
+        metadata_episode = MetadataEpisode(
+            "1",
+            "たいとる1",
+            "",
+            "",
+            "",
+            (MetadataImage("003", "003.jpg", "image/jpeg"),),
+        )
+        episode = Episode("1", "たいとる1")
+        buff2 = io.BytesIO()
+        with zipfile.ZipFile(buff) as zf_old:
+            # 再利用するエントリは展開せずに圧縮されたまま書き込む
+            with patch("zlib.decompressobj", side_effect=AssertionError), EpubWriter(
+                buff2, "xxxx", False, True, True
+            ) as writer:
+                writer.reuse_episode(episode, metadata_episode, zf_old)
+                writer.finish(
+                    "たいとる",
+                    "作者",
+                    "2022-01-01T00:00:00Z",
+                    [Chapter("default", [episode])],
+                )
+            with zipfile.ZipFile(buff2) as zf:
+                self.assertIsNone(zf.testzip())
+                for name in ["src/image/003.jpg", "src/text/1.xhtml"]:
+                    old, new = zf_old.getinfo(name), zf.getinfo(name)
+                    self.assertEqual(
+                        (old.compress_type, old.CRC, old.compress_size),
+                        (new.compress_type, new.CRC, new.compress_size),
+                    )
+                    self.assertEqual((1980, 1, 1, 0, 0, 0), new.date_time)
+                    self.assertEqual(zf_old.read(name), zf.read(name))
+
+    def test_epub_writer_deterministic(self):
+        def write(buff, chapters):
+            with EpubWriter(buff, "xxxx", False, False, True) as writer:
+                for chapter in chapters:
+                    for episode in chapter.episodes:
+                        writer.add_episode(
+                            dataclasses.replace(episode, paragraphs=["だんらく"]), []
+                        )
+                writer.finish("たいとる", "作者", "2022-01-01T00:00:00Z", chapters)
+
+        chapters = [Chapter("default", [Episode("1", "たいとる1")])]
+        buff1 = io.BytesIO()
+        write(buff1, chapters)
+        buff2 = io.BytesIO()
+        with patch("time.time", return_value=0.0):
+            write(buff2, chapters)
+        # 書き込んだ時刻によらず同じ内容なら同じバイト列になる
+        self.assertEqual(buff1.getvalue(), buff2.getvalue())
+
+        with zipfile.ZipFile(buff1) as zf_old:
+            with EpubWriter(io.BytesIO(), "xxxx", False, False, True) as writer:
+                metadata = load_metadata(buff1)
+                writer.reuse_episode(
+                    chapters[0].episodes[0],
+                    metadata.episodes["1"],
+                    zf_old,
+                    metadata.format_version,
+                )
+                self.assertTrue(writer.unchanged(zf_old, "たいとる", "作者", chapters))
+                self.assertFalse(
+                    writer.unchanged(zf_old, "たいとる2", "作者", chapters)
+                )
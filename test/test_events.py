@@ -0,0 +1,35 @@
+import io
+import json
+from unittest import TestCase
+from unittest.mock import patch
+
+from nepub.events import JsonlReporter
+
+
+class TestJsonlReporter(TestCase):
+    @patch("nepub.events.time.monotonic")
+    def test_jsonl_reporter(self, monotonic):
+        monotonic.return_value = 0.0
+        out = io.StringIO()
+        reporter = JsonlReporter(out)
+        for i in range(1, 5):
+            reporter.emit("episode_queued", episode_id=str(i))
+        for i in range(1, 4):
+            monotonic.return_value = float(i * 2)
+            reporter.emit("page_fetched", url=f"https://example.com/{i}", bytes=100)
+            reporter.emit("episode_written", "message", episode_id=str(i))
+        events = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual(10, len(events))
+        self.assertEqual("episode_queued", events[0]["event"])
+        self.assertIsNone(events[0]["eta"])
+        last = events[-1]
+        self.assertEqual("episode_written", last["event"])
+        self.assertEqual("3", last["episode_id"])
+        self.assertEqual("message", last["message"])
+        self.assertEqual(6.0, last["elapsed"])
+        self.assertEqual(300, last["bytes_total"])
+        self.assertEqual(4, last["queued"])
+        self.assertEqual(3, last["done"])
+        self.assertEqual(0.5, last["episodes_per_sec"])
+        self.assertEqual(50.0, last["bytes_per_sec"])
+        self.assertEqual(2.0, last["eta"])
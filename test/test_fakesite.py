@@ -0,0 +1,45 @@
+import os
+import tempfile
+import zipfile
+from unittest import TestCase
+
+from nepub.epub import load_metadata
+from nepub.fakesite import FakeSite, run_harness
+
+
+class TestFakeSite(TestCase):
+    def test_narou(self):
+        site = FakeSite(
+            episodes=25, per_page=10, paragraphs=10, images_every=5, throttle_rate=0.2
+        )
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            output = os.path.join(tmp_dir, "n0000aa.epub")
+            result = run_harness(site, illustration=True, output=output)
+            self.assertIsNone(result.error)
+            metadata = load_metadata(output)
+            self.assertEqual(25, len(metadata.episodes))
+            self.assertEqual(5, sum(len(e.images) for e in metadata.episodes.values()))
+            with zipfile.ZipFile(output) as zf:
+                self.assertIn(
+                    "<ruby>漢字<rt>かんじ</rt></ruby>",
+                    zf.read("src/text/1.xhtml").decode(),
+                )
+                self.assertIn("第3章", zf.read("src/navigation.xhtml").decode())
+        # 目次 3 ページ、エピソード 25、挿絵 5 に加えて、429 の分だけ再試行する
+        self.assertEqual(33, site.statuses[200])
+        self.assertEqual(site.statuses[429] + 33, result.requests)
+        self.assertGreater(site.statuses[429], 0)
+
+    def test_kakuyomu(self):
+        site = FakeSite(episodes=12, paragraphs=3)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            output = os.path.join(tmp_dir, "1.epub")
+            result = run_harness(site, "1", kakuyomu=True, output=output)
+            self.assertIsNone(result.error)
+            self.assertEqual(12, len(load_metadata(output).episodes))
+        self.assertEqual({200: 13}, site.statuses)
+
+    def test_error(self):
+        result = run_harness(FakeSite(episodes=10, error_rate=1.0))
+        self.assertEqual("HTTP Error 500: Internal Server Error", result.error)
+        self.assertEqual(0, result.output_bytes)
@@ -0,0 +1,109 @@
+import os
+import tempfile
+from unittest import TestCase
+from unittest.mock import patch
+
+from nepub.http import (
+    get,
+    get_image,
+    mirror_path,
+    override_url,
+    set_host_overrides,
+    set_mirror_dir,
+    stream,
+)
+
+
+class TestHttp(TestCase):
+    def test_mirror_path(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            self.assertEqual(
+                os.path.join(tmp_dir, "ncode.syosetu.com", "xxxx", "index.html?p=2"),
+                mirror_path(tmp_dir, "https://ncode.syosetu.com/xxxx/?p=2"),
+            )
+            self.assertEqual(
+                os.path.join(tmp_dir, "ncode.syosetu.com", "xxxx", "1", "index.html"),
+                mirror_path(tmp_dir, "https://ncode.syosetu.com/xxxx/1/"),
+            )
+            self.assertEqual(
+                os.path.join(tmp_dir, "kakuyomu.jp", "works", "xxxx"),
+                mirror_path(tmp_dir, "https://kakuyomu.jp/works/xxxx"),
+            )
+            # 同じ名前のディレクトリがある場合はその中の index.html を読む
+            os.makedirs(os.path.join(tmp_dir, "kakuyomu.jp", "works", "xxxx"))
+            self.assertEqual(
+                os.path.join(tmp_dir, "kakuyomu.jp", "works", "xxxx", "index.html"),
+                mirror_path(tmp_dir, "https://kakuyomu.jp/works/xxxx"),
+            )
+
+    @patch("nepub.http.rate_limiter")
+    def test_mirror(self, rate_limiter):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            page = mirror_path(tmp_dir, "https://ncode.syosetu.com/xxxx/1/")
+            os.makedirs(os.path.dirname(page))
+            with open(page, "w", encoding="utf-8") as f:
+                f.write("<p>本文</p>")
+            image = mirror_path(
+                tmp_dir,
+                "https://12345.mitemin.net/userpageimage/viewimagebig/icode/i1/",
+            )
+            os.makedirs(os.path.dirname(image))
+            with open(image, "wb") as f:
+                f.write(b"\x89PNG\r\n\x1a\ntest_data")
+            set_mirror_dir(tmp_dir)
+            try:
+                self.assertEqual(
+                    "<p>本文</p>", get("https://ncode.syosetu.com/xxxx/1/")
+                )
+                result = get_image(
+                    "https://12345.mitemin.net/userpageimage/viewimagebig/icode/i1/"
+                )
+                with self.assertRaises(Exception):
+                    get("https://ncode.syosetu.com/xxxx/2/")
+            finally:
+                set_mirror_dir(None)
+        self.assertEqual("image/png", result.type)
+        self.assertTrue(result.name.endswith(".png"))
+        # ミラーから読む場合はリクエストの間隔を空けない
+        rate_limiter.wait.assert_not_called()
+
+    @patch("nepub.http.CHUNK_SIZE", 1)
+    def test_stream(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            page = mirror_path(tmp_dir, "https://ncode.syosetu.com/xxxx/1/")
+            os.makedirs(os.path.dirname(page))
+            with open(page, "w", encoding="utf-8") as f:
+                f.write("<p>本文</p>")
+            set_mirror_dir(tmp_dir)
+            try:
+                chunks = list(stream("https://ncode.syosetu.com/xxxx/1/"))
+            finally:
+                set_mirror_dir(None)
+        # 1 バイトずつ受信しても、マルチバイト文字は分割されずにデコードされる
+        self.assertEqual(["<", "p", ">", "本", "文", "<", "/", "p", ">"], chunks)
+
+    def test_override_url(self):
+        set_host_overrides(
+            {
+                "ncode.syosetu.com": "http://127.0.0.1:8000/ncode.syosetu.com/",
+                "*.mitemin.net": "http://127.0.0.1:8000/mitemin.net",
+            }
+        )
+        try:
+            self.assertEqual(
+                "http://127.0.0.1:8000/ncode.syosetu.com/xxxx/?p=2",
+                override_url("https://ncode.syosetu.com/xxxx/?p=2"),
+            )
+            self.assertEqual(
+                "http://127.0.0.1:8000/mitemin.net/userpageimage/viewimagebig/icode/i1/",
+                override_url(
+                    "https://12345.mitemin.net/userpageimage/viewimagebig/icode/i1/"
+                ),
+            )
+            # 指定していないホストはそのまま
+            self.assertEqual(
+                "https://kakuyomu.jp/works/xxxx",
+                override_url("https://kakuyomu.jp/works/xxxx"),
+            )
+        finally:
+            set_host_overrides({})
@@ -0,0 +1,92 @@
+import hashlib
+import io
+from concurrent.futures import ThreadPoolExecutor
+from unittest import TestCase, skipIf
+from unittest.mock import MagicMock, patch
+
+import nepub.image
+from nepub.http import get_image, set_image_spool_threshold
+from nepub.image import PILImage, resize_image
+from nepub.type import Image
+
+
+class TestImage(TestCase):
+    def test_resize_image_original(self):
+        image = Image("test_id", "test_id.jpg", "image/jpeg", b"test_data")
+        self.assertIs(image, resize_image(image, "original"))
+
+    @skipIf(PILImage is None, "Pillow is not installed")
+    def test_resize_image_small(self):
+        buff = io.BytesIO()
+        PILImage.effect_noise((3000, 2000), 64).convert("RGB").save(
+            buff, format="JPEG", quality=95
+        )
+        image = Image(
+            "test_resize_image_small",
+            "test_resize_image_small.jpg",
+            "image/jpeg",
+            buff.getvalue(),
+        )
+        resized = resize_image(image, "small")
+        self.assertEqual("test_resize_image_small", resized.id)
+        self.assertEqual("test_resize_image_small.jpg", resized.name)
+        self.assertLess(resized.size, image.size)
+        with PILImage.open(resized.open()) as img:
+            self.assertEqual((1000, 667), img.size)
+        # 同じ画像はキャッシュから返す (一時ファイルを共有しないよう複製を返す)
+        with patch("nepub.image._resize_image") as _resize_image:
+            cached = resize_image(image, "small")
+        _resize_image.assert_not_called()
+        self.assertIsNot(resized.data, cached.data)
+        self.assertEqual(resized.open().read(), cached.open().read())
+
+    @skipIf(PILImage is None, "Pillow is not installed")
+    def test_resize_image_threads(self):
+        buff = io.BytesIO()
+        PILImage.effect_noise((2000, 2000), 64).convert("RGB").save(
+            buff, format="JPEG", quality=95
+        )
+        image = Image(
+            "test_resize_image_threads",
+            "test_resize_image_threads.jpg",
+            "image/jpeg",
+            buff.getvalue(),
+        )
+        set_image_spool_threshold(0)
+        try:
+            # 並列に呼ばれても同じ画像は 1 回だけ変換し、それぞれ読み出せる画像を返す
+            with patch(
+                "nepub.image._resize_image", wraps=nepub.image._resize_image
+            ) as _resize_image, ThreadPoolExecutor(8) as executor:
+                results = list(
+                    executor.map(lambda _: resize_image(image, "small"), range(16))
+                )
+        finally:
+            set_image_spool_threshold(256 * 1024)
+        self.assertEqual(1, _resize_image.call_count)
+        data = {result.open().read() for result in results}
+        self.assertEqual(1, len(data))
+        self.assertEqual(16, len({id(result.data) for result in results}))
+
+    @patch("nepub.http.urlopen")
+    def test_get_image(self, urlopen):
+        data = bytes(range(256)) * 1024
+        res = MagicMock()
+        res.__enter__.return_value = res
+        res.headers = {"Content-Type": "image/png"}
+        res.status = 200
+        res.read.side_effect = io.BytesIO(data).read
+        urlopen.return_value = res
+        set_image_spool_threshold(1024)
+        try:
+            image = get_image("https://example.com/test.png")
+        finally:
+            set_image_spool_threshold(256 * 1024)
+        md5 = hashlib.md5(data).hexdigest()
+        self.assertEqual(
+            (md5, f"{md5}.png", "image/png"), (image.id, image.name, image.type)
+        )
+        # 閾値を超えた画像はメモリ上の bytes ではなく一時ファイルとして持つ
+        self.assertNotIsInstance(image.data, bytes)
+        self.assertEqual(len(data), image.size)
+        self.assertEqual(data, image.open().read())
@@ -1,6 +1,8 @@
 from unittest import TestCase
 
+from nepub.fakesite import FakeSite
 from nepub.parser.kakuyomu import KakuyomuEpisodeParser, KakuyomuIndexParser
+from nepub.type import Chapter, Episode
 
 
 class TestKakuyomuEpisodeParser(TestCase):
@@ -85,27 +87,21 @@ class TestKakuyomuIndexParser(TestCase):
         self.assertEqual("作者", parser.author)
         self.assertEqual(
             [
-                {
-                    "name": "default",
-                    "episodes": [
-                        {
-                            "id": "epsode1",
-                            "title": "",
-                            "created_at": "2000-01-01T00:00:00Z",
-                            "updated_at": "2000-01-01T00:00:00Z",
-                            "paragraphs": [],
-                            "fetched": False,
-                        },
-                        {
-                            "id": "epsode2",
-                            "title": "",
-                            "created_at": "2000-01-02T00:00:00Z",
-                            "updated_at": "2000-01-02T00:00:00Z",
-                            "paragraphs": [],
-                            "fetched": False,
-                        },
+                Chapter(
+                    "default",
+                    [
+                        Episode(
+                            id="epsode1",
+                            created_at="2000-01-01T00:00:00Z",
+                            updated_at="2000-01-01T00:00:00Z",
+                        ),
+                        Episode(
+                            id="epsode2",
+                            created_at="2000-01-02T00:00:00Z",
+                            updated_at="2000-01-02T00:00:00Z",
+                        ),
                     ],
-                },
+                ),
             ],
             parser.chapters,
         )
@@ -194,41 +190,44 @@ class TestKakuyomuIndexParser(TestCase):
         self.assertEqual("作者", parser.author)
         self.assertEqual(
             [
-                {"name": "default", "episodes": []},
-                {
-                    "name": "第1章",
-                    "episodes": [
-                        {
-                            "id": "epsode1",
-                            "title": "",
-                            "created_at": "2000-01-01T00:00:00Z",
-                            "updated_at": "2000-01-01T00:00:00Z",
-                            "paragraphs": [],
-                            "fetched": False,
-                        },
-                        {
-                            "id": "epsode2",
-                            "title": "",
-                            "created_at": "2000-01-02T00:00:00Z",
-                            "updated_at": "2000-01-02T00:00:00Z",
-                            "paragraphs": [],
-                            "fetched": False,
-                        },
+                Chapter("default"),
+                Chapter(
+                    "第1章",
+                    [
+                        Episode(
+                            id="epsode1",
+                            created_at="2000-01-01T00:00:00Z",
+                            updated_at="2000-01-01T00:00:00Z",
+                        ),
+                        Episode(
+                            id="epsode2",
+                            created_at="2000-01-02T00:00:00Z",
+                            updated_at="2000-01-02T00:00:00Z",
+                        ),
                     ],
-                },
-                {
-                    "name": "第2章",
-                    "episodes": [
-                        {
-                            "id": "epsode3",
-                            "title": "",
-                            "created_at": "2000-01-03T00:00:00Z",
-                            "updated_at": "2000-01-03T00:00:00Z",
-                            "paragraphs": [],
-                            "fetched": False,
-                        },
+                ),
+                Chapter(
+                    "第2章",
+                    [
+                        Episode(
+                            id="epsode3",
+                            created_at="2000-01-03T00:00:00Z",
+                            updated_at="2000-01-03T00:00:00Z",
+                        ),
                     ],
-                },
+                ),
             ],
             parser.chapters,
         )
+
+    def test_kakuyomu_index_parser_chunked(self):
+        # 受信しながらパースする場合は script の途中で区切られる
+        page = FakeSite(episodes=30).kakuyomu_index("work1")
+        expected = KakuyomuIndexParser()
+        expected.feed(page)
+        parser = KakuyomuIndexParser()
+        for i in range(0, len(page), 3):
+            parser.feed(page[i : i + 3])
+        self.assertEqual("タイトル", parser.title)
+        self.assertEqual(expected.chapters, parser.chapters)
+        self.assertEqual(4, len(parser.chapters))
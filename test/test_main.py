@@ -0,0 +1,206 @@
+import os
+import tempfile
+import zipfile
+from unittest import TestCase
+from unittest.mock import patch
+
+from nepub.__main__ import convert_narou_to_epub, rerender_epub
+from nepub.epub import FORMAT_VERSION, load_metadata
+from nepub.fakesite import FakeSite, serve_fake_site
+from nepub.rebuild import rebuild_library
+from nepub.util import tcy
+
+
+class TestMain(TestCase):
+    def test_format_version_of_reused_episodes(self):
+        site = FakeSite(episodes=3, paragraphs=3)
+        with tempfile.TemporaryDirectory() as tmp_dir, serve_fake_site(site):
+            output = os.path.join(tmp_dir, "n0000aa.epub")
+            with patch("nepub.epub.FORMAT_VERSION", 1):
+                convert_narou_to_epub("n0000aa", False, True, "", output, False)
+            self.assertEqual(1, load_metadata(output).format_version)
+
+            # 既存のファイルから取り出したエピソードは古い出力形式のままなので、バージョンを上げない
+            site.episodes = 4
+            convert_narou_to_epub("n0000aa", False, True, "", output, False)
+            metadata = load_metadata(output)
+            self.assertEqual(4, len(metadata.episodes))
+            self.assertEqual(1, metadata.format_version)
+
+            # すべてのエピソードを作り直すと最新の出力形式になる
+            self.assertEqual([output], rebuild_library([output], 1))
+            self.assertEqual(FORMAT_VERSION, load_metadata(output).format_version)
+
+            # 最新の出力形式のファイルを更新しても最新のまま
+            site.episodes = 5
+            convert_narou_to_epub("n0000aa", False, True, "", output, False)
+            metadata = load_metadata(output)
+            self.assertEqual(5, len(metadata.episodes))
+            self.assertEqual(FORMAT_VERSION, metadata.format_version)
+            with zipfile.ZipFile(output) as zf:
+                self.assertIn("src/text/5.xhtml", zf.namelist())
+
+    def test_no_changes(self):
+        site = FakeSite(episodes=3, paragraphs=3, images_every=2)
+        with tempfile.TemporaryDirectory() as tmp_dir, serve_fake_site(site):
+            output = os.path.join(tmp_dir, "n0000aa.epub")
+            convert_narou_to_epub("n0000aa", True, True, "", output, False)
+            stat = os.stat(output)
+
+            # 変更がない場合は一時ファイルも作らず、既存のファイルをそのまま残す
+            with patch(
+                "tempfile.NamedTemporaryFile", wraps=tempfile.NamedTemporaryFile
+            ) as named_temporary_file:
+                convert_narou_to_epub("n0000aa", True, True, "", output, False)
+            named_temporary_file.assert_not_called()
+            self.assertEqual(["n0000aa.epub"], os.listdir(tmp_dir))
+            self.assertEqual(stat.st_mtime_ns, os.stat(output).st_mtime_ns)
+
+            # 新しいエピソードがあれば書き直す
+            site.episodes = 4
+            with patch(
+                "tempfile.NamedTemporaryFile", wraps=tempfile.NamedTemporaryFile
+            ) as named_temporary_file:
+                convert_narou_to_epub("n0000aa", True, True, "", output, False)
+            named_temporary_file.assert_called_once()
+            self.assertEqual(["n0000aa.epub"], os.listdir(tmp_dir))
+            self.assertEqual(4, len(load_metadata(output).episodes))
+
+    def test_image_profile_differs(self):
+        site = FakeSite(episodes=2, paragraphs=3, images_every=1)
+        with tempfile.TemporaryDirectory() as tmp_dir, serve_fake_site(site):
+            output = os.path.join(tmp_dir, "n0000aa.epub")
+            self.assertIsNotNone(
+                convert_narou_to_epub("n0000aa", True, True, "", output, False)
+            )
+            with open(output, "rb") as f:
+                data = f.read()
+            requests = site.requests
+
+            # 画像のサイズが異なる挿絵が混ざらないように中止する
+            self.assertIsNone(
+                convert_narou_to_epub(
+                    "n0000aa", True, True, "", output, False, image_profile="small"
+                )
+            )
+            self.assertEqual(requests, site.requests)
+            with open(output, "rb") as f:
+                self.assertEqual(data, f.read())
+            self.assertEqual("original", load_metadata(output).image_profile)
+
+    def test_revalidate(self):
+        site = FakeSite(episodes=5, paragraphs=3, images_every=2, etags=False)
+        with tempfile.TemporaryDirectory() as tmp_dir, serve_fake_site(site):
+            output = os.path.join(tmp_dir, "n0000aa.epub")
+            convert_narou_to_epub("n0000aa", True, True, "", output, False)
+            with open(output, "rb") as f:
+                data = f.read()
+            metadata = load_metadata(output)
+            self.assertFalse(any(e.validators for e in metadata.episodes.values()))
+
+            # 条件付き GET に対応していない場合も、内容が同じなら挿絵は取得しない
+            site.statuses.clear()
+            convert_narou_to_epub(
+                "n0000aa", True, True, "", output, False, revalidate=True
+            )
+            self.assertEqual({200: 6}, site.statuses)
+            with open(output, "rb") as f:
+                self.assertEqual(data, f.read())
+
+            # 内容が同じでも受け取った検証子は記録する
+            site.etags = True
+            site.statuses.clear()
+            convert_narou_to_epub(
+                "n0000aa", True, True, "", output, False, revalidate=True
+            )
+            self.assertEqual({200: 6}, site.statuses)
+            metadata = load_metadata(output)
+            self.assertTrue(all(e.validators for e in metadata.episodes.values()))
+            with open(output, "rb") as f:
+                data = f.read()
+
+            # 検証子が一致すれば 304 が返り、本文も挿絵も取得しない
+            site.statuses.clear()
+            convert_narou_to_epub(
+                "n0000aa", True, True, "", output, False, revalidate=True
+            )
+            self.assertEqual({200: 1, 304: 5}, site.statuses)
+            with open(output, "rb") as f:
+                self.assertEqual(data, f.read())
+
+            # 内容が変わったエピソードは挿絵も取得して書き直す
+            site.paragraph_length = 50
+            site.statuses.clear()
+            convert_narou_to_epub(
+                "n0000aa", True, True, "", output, False, revalidate=True
+            )
+            self.assertEqual({200: 8}, site.statuses)
+            new_metadata = load_metadata(output)
+            for episode_id, episode in new_metadata.episodes.items():
+                self.assertNotEqual(metadata.episodes[episode_id].hash, episode.hash)
+            self.assertEqual(
+                metadata.episodes["2"].images, new_metadata.episodes["2"].images
+            )
+            with zipfile.ZipFile(output) as zf:
+                text = zf.read("src/text/2.xhtml").decode()
+                self.assertIn(tcy(site.paragraph_text(2, 1)), text)
+                self.assertIn(
+                    f"../image/{new_metadata.episodes['2'].images[0].name}", text
+                )
+
+    def test_rerender(self):
+        site = FakeSite(episodes=3, paragraphs=3, images_every=2)
+        with tempfile.TemporaryDirectory() as tmp_dir, serve_fake_site(site):
+            output = os.path.join(tmp_dir, "n0000aa.epub")
+            convert_narou_to_epub("n0000aa", False, True, "", output, False)
+            with zipfile.ZipFile(output) as zf:
+                self.assertIn(
+                    tcy(site.paragraph_text(1, 1)), zf.read("src/text/1.xhtml").decode()
+                )
+            validators = {
+                episode_id: episode.validators
+                for episode_id, episode in load_metadata(output).episodes.items()
+            }
+            self.assertTrue(all(validators.values()))
+            site.statuses.clear()
+
+            # 縦中横をやめる場合は取得し直さずに作り直す
+            self.assertTrue(rerender_epub("n0000aa", False, False, output, False))
+            self.assertEqual({}, site.statuses)
+            metadata = load_metadata(output)
+            self.assertFalse(metadata.tcy)
+            # 取得し直していないので検証子を引き継ぐ
+            self.assertEqual(
+                validators,
+                {
+                    episode_id: episode.validators
+                    for episode_id, episode in metadata.episodes.items()
+                },
+            )
+            with zipfile.ZipFile(output) as zf:
+                self.assertIn(
+                    site.paragraph_text(1, 1), zf.read("src/text/1.xhtml").decode()
+                )
+
+            # 挿絵を入れる場合は挿絵だけを取得する
+            self.assertTrue(rerender_epub("n0000aa", True, False, output, False))
+            self.assertEqual({200: 1}, site.statuses)
+            metadata = load_metadata(output)
+            self.assertTrue(metadata.illustration)
+            image = metadata.episodes["2"].images[0]
+            with zipfile.ZipFile(output) as zf:
+                self.assertIn(
+                    f"../image/{image.name}", zf.read("src/text/2.xhtml").decode()
+                )
+                self.assertIn(f"src/image/{image.name}", zf.namelist())
+                opf = zf.read("src/content.opf").decode()
+                self.assertIn('href="raw/2.json"', opf)
+                self.assertIn('href="raw/index.json"', opf)
+
+            # 挿絵をやめる場合は挿絵を除く
+            self.assertTrue(rerender_epub("n0000aa", False, False, output, False))
+            self.assertEqual({200: 1}, site.statuses)
+            self.assertFalse(load_metadata(output).illustration)
+            with zipfile.ZipFile(output) as zf:
+                self.assertNotIn("<img", zf.read("src/text/2.xhtml").decode())
+                self.assertNotIn(f"src/image/{image.name}", zf.namelist())
@@ -0,0 +1,62 @@
+import os
+import tempfile
+from unittest import TestCase
+
+from nepub.metrics import Counter, Gauge, Histogram, Metric, Registry
+
+
+class TestMetrics(TestCase):
+    def test_render(self):
+        registry = Registry()
+        counter = registry.register(
+            Counter("test_total", "Test counter", ["host", "code"])
+        )
+        gauge = registry.register(Gauge("test_depth", "Test gauge"))
+        histogram = registry.register(
+            Histogram("test_seconds", "Test histogram", ["host"], buckets=[1, 5])
+        )
+        counter.inc(host="example.com", code="200")
+        counter.inc(2, host="example.com", code="200")
+        counter.inc(host='a"b', code="503")
+        gauge.set(3)
+        histogram.observe(0.5, host="example.com")
+        histogram.observe(2.5, host="example.com")
+        self.assertEqual(3, counter.get(host="example.com", code="200"))
+        self.assertEqual(2, histogram.count(host="example.com"))
+        self.assertEqual(
+            """# HELP test_total Test counter
+# TYPE test_total counter
+test_total{host="example.com",code="200"} 3
+test_total{host="a\\"b",code="503"} 1
+# HELP test_depth Test gauge
+# TYPE test_depth gauge
+test_depth 3
+# HELP test_seconds Test histogram
+# TYPE test_seconds histogram
+test_seconds_bucket{host="example.com",le="1"} 1
+test_seconds_bucket{host="example.com",le="5"} 2
+test_seconds_bucket{host="example.com",le="+Inf"} 2
+test_seconds_sum{host="example.com"} 3
+test_seconds_count{host="example.com"} 2
+""",
+            registry.render(),
+        )
+        # ラベルが足りない場合はエラーになる
+        with self.assertRaises(ValueError):
+            counter.inc(host="example.com")
+
+    def test_metric_is_abstract(self):
+        # 種類ごとのクラスが samples を実装する
+        with self.assertRaises(TypeError):
+            Metric("nepub_test", "Test")  # type: ignore[abstract]
+
+    def test_write_textfile(self):
+        registry = Registry()
+        registry.register(Gauge("test_depth", "Test gauge")).set(1)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "nepub.prom")
+            registry.write_textfile(path)
+            with open(path) as f:
+                self.assertEqual(registry.render(), f.read())
+            # 一時ファイルは残らない
+            self.assertEqual(["nepub.prom"], os.listdir(tmp_dir))
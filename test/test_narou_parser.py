@@ -2,6 +2,7 @@ from unittest import TestCase
 from unittest.mock import patch
 
 from nepub.parser.narou import NarouEpisodeParser, NarouIndexParser
+from nepub.type import Chapter, Episode, Image
 
 
 class TestNarouEpisodeParser(TestCase):
@@ -50,12 +51,9 @@ class TestNarouEpisodeParser(TestCase):
 
     @patch("nepub.parser.narou.get_image")
     def test_narou_episode_parser_image(self, get_image):
-        get_image.return_value = {
-            "id": "test_id",
-            "name": "test_name",
-            "type": "image/jpeg",
-            "data": b"test_data",
-        }
+        get_image.return_value = Image(
+            "test_id", "test_name", "image/jpeg", b"test_data"
+        )
         parser = NarouEpisodeParser(include_images=True)
         parser.feed(
             """
@@ -70,6 +68,25 @@ class TestNarouEpisodeParser(TestCase):
             get_image.call_args[0][0],
         )
 
+    @patch("nepub.parser.narou.get_image")
+    def test_narou_episode_parser_image_profile(self, get_image):
+        get_image.return_value = Image(
+            "test_id", "test_name", "image/gif", b"test_data"
+        )
+        parser = NarouEpisodeParser(include_images=True, image_profile="small")
+        parser.feed(
+            """
+            <p id="L1"><a href="//example.com/href" target="_blank"><img src="//12345.mitemin.net/userpageimage/viewimagebig/icode/i12345/" alt="test_alt" border="0" /></a></p>
+            """
+        )
+        self.assertEqual(
+            ['<img alt="test_alt" src="../image/test_name"/>'], parser.paragraphs
+        )
+        self.assertEqual(
+            "https://12345.mitemin.net/userpageimage/viewimage/icode/i12345/",
+            get_image.call_args[0][0],
+        )
+
     def test_narou_episode_parser_tcy(self):
         parser = NarouEpisodeParser(convert_tcy=True)
         parser.feed(
@@ -88,6 +105,66 @@ class TestNarouEpisodeParser(TestCase):
             parser.paragraphs,
         )
 
+    def test_narou_episode_parser_raw(self):
+        html_text = """
+            <h1 class="p-novel__title p-novel__title--rensai">タイトル1</h1>
+            <p id="L1">今日は<ruby>6月<rt>ろくがつ</rt></ruby>28日</p>
+            <p id="L2"><img src="//12345.mitemin.net/userpageimage/viewimagebig/icode/i12345/" alt="test_alt" /></p>
+            <p id="L3"></p>
+            <p id="L4">A&B</p>
+            """
+        parser = NarouEpisodeParser()
+        parser.feed(html_text)
+        raw = parser.raw
+        self.assertEqual(
+            [
+                [
+                    "今日は",
+                    ["ruby"],
+                    "6月",
+                    ["rt"],
+                    "ろくがつ",
+                    ["/rt"],
+                    ["/ruby"],
+                    "28日",
+                ],
+                [
+                    [
+                        "img",
+                        "test_alt",
+                        "//12345.mitemin.net/userpageimage/viewimagebig/icode/i12345/",
+                    ]
+                ],
+                [],
+                ["A&B"],
+            ],
+            raw.paragraphs,
+        )
+        # 中間形式から別のオプションで変換した結果は、そのオプションでパースした結果と一致する
+        tcy_parser = NarouEpisodeParser(convert_tcy=True)
+        tcy_parser.feed(html_text)
+        self.assertEqual(
+            tcy_parser.title, NarouEpisodeParser.render_title(raw.title, True)
+        )
+        self.assertEqual(
+            tcy_parser.paragraphs,
+            NarouEpisodeParser.render_paragraphs(raw.paragraphs, True),
+        )
+        self.assertEqual(
+            [
+                "今日は<ruby>6月<rt>ろくがつ</rt></ruby>28日",
+                '<img alt="test_alt" src="../image/test_name"/>',
+                "A&amp;B",
+            ],
+            NarouEpisodeParser.render_paragraphs(
+                raw.paragraphs,
+                False,
+                {
+                    "//12345.mitemin.net/userpageimage/viewimagebig/icode/i12345/": "test_name"
+                },
+            ),
+        )
+
 
 class TestNarouIndexParser(TestCase):
     def test_narou_index_parser(self):
@@ -126,41 +203,21 @@ class TestNarouIndexParser(TestCase):
         self.assertEqual("2", parser.next_page)
         self.assertEqual(
             [
-                {"name": "default", "episodes": []},
-                {
-                    "name": "チャプター1",
-                    "episodes": [
-                        {
-                            "id": "1",
-                            "title": "",
-                            "created_at": "1999/01/01 00:00",
-                            "updated_at": "",
-                            "paragraphs": [],
-                            "fetched": False,
-                        },
-                        {
-                            "id": "2",
-                            "title": "",
-                            "created_at": "1999/01/02 00:00",
-                            "updated_at": "2000/01/02 00:00",
-                            "paragraphs": [],
-                            "fetched": False,
-                        },
-                    ],
-                },
-                {
-                    "name": "チャプター2",
-                    "episodes": [
-                        {
-                            "id": "3",
-                            "title": "",
-                            "created_at": "1999/01/03 00:00",
-                            "updated_at": "",
-                            "paragraphs": [],
-                            "fetched": False,
-                        }
+                Chapter("default"),
+                Chapter(
+                    "チャプター1",
+                    [
+                        Episode(id="1", created_at="1999/01/01 00:00"),
+                        Episode(
+                            id="2",
+                            created_at="1999/01/02 00:00",
+                            updated_at="2000/01/02 00:00",
+                        ),
                     ],
-                },
+                ),
+                Chapter(
+                    "チャプター2", [Episode(id="3", created_at="1999/01/03 00:00")]
+                ),
             ],
             parser.chapters,
         )
@@ -188,19 +245,12 @@ class TestNarouIndexParser(TestCase):
         self.assertEqual(None, parser.next_page)
         self.assertEqual(
             [
-                {
-                    "name": "default",
-                    "episodes": [
-                        {
-                            "id": "999",
-                            "title": "",
-                            "created_at": "1999/12/31 23:59",
-                            "updated_at": "",
-                            "paragraphs": [],
-                            "fetched": False,
-                        },
+                Chapter(
+                    "default",
+                    [
+                        Episode(id="999", created_at="1999/12/31 23:59"),
                     ],
-                },
+                ),
             ],
             parser.chapters,
         )
@@ -0,0 +1,156 @@
+import time
+from unittest import TestCase
+from unittest.mock import patch
+
+from nepub.novel import (
+    fetch_index,
+    iter_episodes,
+    iter_index,
+    prefetch,
+    resolve_episode_images,
+)
+from nepub.type import Episode, Image
+
+
+def get_episode_page(url: str, validators=None):
+    episode_id = url.rstrip("/").split("/")[-1]
+    return f"""
+        <h1 class="p-novel__title p-novel__title--rensai">タイトル{episode_id}</h1>
+        <p id="L1">段落{episode_id}</p>
+        <p id="L2"><img src="//12345.mitemin.net/userpageimage/viewimagebig/icode/i{episode_id}/" alt="test_alt" /></p>
+        """
+
+
+def get_index_page(url: str):
+    # 1 ページに 2 エピソードずつ、全 5 エピソード
+    page = int(url.split("?p=")[1])
+    rows = []
+    for i in range(page * 2 - 1, min(page * 2, 5) + 1):
+        if i == 3:
+            rows.append('<div class="p-eplist__chapter-title">第二章</div>')
+        rows.append(
+            f'<div class="p-eplist__sublist"><a href="/xxxx/{i}/" class="p-eplist__subtitle">エピソード{i}</a>'
+            f'<div class="p-eplist__update">2000/01/0{i} 00:00</div></div>'
+        )
+    next_page = (
+        f'<a href="/xxxx/?p={page + 1}" class="c-pager__item c-pager__item--next">次へ</a>'
+        if page < 3
+        else ""
+    )
+    return (
+        '<h1 class="p-novel__title">タイトル</h1><div class="p-novel__author">作者：著者</div>'
+        + next_page
+        + "".join(rows)
+    )
+
+
+def get_image(url: str):
+    image_id = url.rstrip("/").split("/")[-1]
+    return Image(image_id, f"{image_id}.jpg", "image/jpeg", b"test_data")
+
+
+def in_chunks(get_page):
+    # 受信しながらパースする場合と同じように、ページを小さなチャンクに分けて返す
+    def stream(url: str, validators=None):
+        page = get_page(url)
+        return iter([page[i : i + 7] for i in range(0, len(page), 7)])
+
+    return stream
+
+
+@patch("nepub.parser.narou.get_image", side_effect=get_image)
+@patch("nepub.novel.get", side_effect=get_episode_page)
+@patch("nepub.novel.stream", side_effect=in_chunks(get_episode_page))
+class TestNovel(TestCase):
+    def test_iter_episodes(self, *_):
+        results = list(
+            iter_episodes(
+                "xxxx", [Episode(str(i)) for i in range(1, 4)], True, True, False
+            )
+        )
+        self.assertEqual(["1", "2", "3"], [episode.id for episode, _ in results])
+        self.assertEqual("タイトル１", results[0][0].title)
+        self.assertEqual(
+            ["段落１", '<img alt="test_alt" src="../image/i1.jpg"/>'],
+            results[0][0].paragraphs,
+        )
+        images = results[0][1]
+        assert images is not None
+        self.assertEqual(["i1"], [image.id for image in images])
+
+    def test_iter_episodes_defer_images(self, mock_stream, mock_get, mock_get_image):
+        # 挿絵を取得せずに返し、resolve_episode_images で取得して本文を変換する
+        results = list(
+            iter_episodes("xxxx", [Episode("1")], True, True, False, defer_images=True)
+        )
+        episode, images = results[0]
+        self.assertIsNone(images)
+        self.assertEqual((), episode.paragraphs)
+        mock_get_image.assert_not_called()
+        images = resolve_episode_images(episode, True)
+        self.assertEqual(["i1"], [image.id for image in images])
+        self.assertEqual(
+            ["段落１", '<img alt="test_alt" src="../image/i1.jpg"/>'],
+            episode.paragraphs,
+        )
+
+    def test_iter_episodes_parallel(self, *_):
+        expected = list(
+            iter_episodes(
+                "xxxx", [Episode(str(i)) for i in range(1, 11)], True, True, False
+            )
+        )
+        results = list(
+            iter_episodes(
+                "xxxx",
+                [Episode(str(i)) for i in range(1, 11)],
+                True,
+                True,
+                False,
+                jobs=3,
+            )
+        )
+        self.assertEqual(expected, results)
+
+    def test_iter_index(self, mock_stream, *_):
+        mock_stream.side_effect = in_chunks(get_index_page)
+        pages = []
+        for index, new_episodes in iter_index("xxxx", False):
+            # ページを取得するたびに新しいエピソードだけが返される
+            pages.append([episode.id for episode in new_episodes])
+            self.assertEqual("タイトル", index.title)
+        self.assertEqual([["1", "2"], ["3", "4"], ["5"]], pages)
+        index = fetch_index("xxxx", False)
+        self.assertEqual(["default", "第二章"], [c.name for c in index.chapters])
+        self.assertEqual(
+            [["1", "2"], ["3", "4", "5"]],
+            [[e.id for e in c.episodes] for c in index.chapters],
+        )
+
+    def test_prefetch(self, *_):
+        self.assertEqual([1, 2, 3], list(prefetch(iter([1, 2, 3]))))
+
+        def fail():
+            yield 1
+            raise ValueError("test")
+
+        items = prefetch(fail())
+        self.assertEqual(1, next(items))
+        with self.assertRaises(ValueError):
+            next(items)
+
+        # 先に進めるのは size 個までで、閉じると別スレッドも止まる
+        produced = []
+
+        def count():
+            for i in range(100):
+                produced.append(i)
+                yield i
+
+        items = prefetch(count(), 2)
+        self.assertEqual(0, next(items))
+        time.sleep(0.3)
+        self.assertLessEqual(len(produced), 4)
+        items.close()
+        time.sleep(0.3)
+        self.assertLessEqual(len(produced), 5)
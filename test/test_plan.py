@@ -0,0 +1,181 @@
+import os
+import tempfile
+from typing import List
+from unittest import TestCase
+from unittest.mock import patch
+
+from nepub.epub import EpubWriter
+from nepub.novel import iter_index
+from nepub.plan import (
+    FETCH,
+    IGNORE,
+    REUSE,
+    REVALIDATE,
+    SKIP,
+    Plan,
+    classify_episode,
+    make_plan,
+)
+from nepub.type import Chapter, Episode, Image, Metadata, MetadataEpisode
+from nepub.util import parse_range
+
+
+def get_index_page(url: str):
+    # 1 ページに全 4 エピソード
+    rows = [
+        f'<div class="p-eplist__sublist"><a href="/xxxx/{i}/" class="p-eplist__subtitle">エピソード{i}</a>'
+        f'<div class="p-eplist__update">2000/01/0{i} 00:00</div></div>'
+        for i in range(1, 5)
+    ]
+    return (
+        '<h1 class="p-novel__title">タイトル</h1><div class="p-novel__author">作者：著者</div>'
+        + "".join(rows)
+    )
+
+
+class CountingList(list):
+    # 要素を取り出した回数を数える (目次のエピソードを何回見たかを数えるために使う)
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.reads = 0
+
+    def __iter__(self):
+        for item in super().__iter__():
+            self.reads += 1
+            yield item
+
+    def __getitem__(self, key):
+        item = super().__getitem__(key)
+        self.reads += len(item) if isinstance(key, slice) else 1
+        return item
+
+
+class FakeIndexParser:
+    # HTML をパースせずに 1 ページあたり 100 エピソードの目次を作る
+    PER_PAGE = 100
+
+    def __init__(self, total: int):
+        self.total = total
+        self.title = "タイトル"
+        self.author = "著者"
+        self.episode_lists: List[CountingList] = []
+        self.reset()
+
+    def reset(self):
+        self.next_page = None
+        self.chapters = [self.new_chapter("default")]
+
+    def new_chapter(self, name: str):
+        episodes = CountingList()
+        self.episode_lists.append(episodes)
+        return Chapter(name, episodes)
+
+    def feed(self, url: str):
+        page = int(url.split("?p=")[1])
+        start = (page - 1) * self.PER_PAGE
+        end = min(page * self.PER_PAGE, self.total)
+        for i in range(start, end):
+            if i % 1000 == 0:
+                self.chapters.append(self.new_chapter(f"第{i // 1000 + 1}章"))
+            self.chapters[-1].episodes.append(
+                Episode(str(i + 1), created_at="2000/01/01 00:00")
+            )
+        if end < self.total:
+            self.next_page = str(page + 1)
+
+    @property
+    def episodes_read(self):
+        return sum(episodes.reads for episodes in self.episode_lists)
+
+
+def plan_synthetic(total: int):
+    # 目次の取得から各エピソードの判定までに、目次のエピソードを取り出した回数を返す
+    metadata = Metadata("xxxx")
+    for i in range(0, total, 2):
+        metadata.episodes[str(i + 1)] = MetadataEpisode(
+            str(i + 1), "", "2000/01/01 00:00", ""
+        )
+    target_range = parse_range(f"1-{total // 2}")
+    index_parser = FakeIndexParser(total)
+    with patch("nepub.novel.get_index_parser", return_value=index_parser), patch(
+        "nepub.novel.stream", side_effect=lambda url, validators=None: [url]
+    ), patch("nepub.novel.emit"):
+        episodes: List[Episode] = []
+        kinds: List[str] = []
+        for _, new_episodes in iter_index("xxxx", False):
+            for episode in new_episodes:
+                kinds.append(
+                    classify_episode(
+                        episode, len(episodes), total, metadata, target_range, False
+                    )
+                )
+                episodes.append(episode)
+    assert len(episodes) == total
+    assert kinds.count(SKIP) + kinds.count(FETCH) == total // 2
+    return index_parser.episodes_read
+
+
+class TestPlan(TestCase):
+    def test_classify_episode(self):
+        metadata = Metadata("xxxx")
+        metadata.episodes["1"] = MetadataEpisode("1", "", "2000/01/01 00:00", "")
+        metadata.episodes["2"] = MetadataEpisode("2", "", "2000/01/01 00:00", "")
+        episode1 = Episode("1", created_at="2000/01/01 00:00")
+        episode2 = Episode("2", created_at="2000/01/02 00:00")
+        episode3 = Episode("3", created_at="2000/01/03 00:00")
+        self.assertEqual(SKIP, classify_episode(episode1, 0, 3, metadata, None, False))
+        self.assertEqual(
+            REVALIDATE, classify_episode(episode1, 0, 3, metadata, None, True)
+        )
+        self.assertEqual(FETCH, classify_episode(episode2, 1, 3, metadata, None, False))
+        self.assertEqual(FETCH, classify_episode(episode3, 2, 3, None, None, False))
+        target_range = parse_range("1")
+        self.assertEqual(
+            REUSE, classify_episode(episode2, 1, 3, metadata, target_range, False)
+        )
+        self.assertEqual(
+            IGNORE, classify_episode(episode3, 2, 3, metadata, target_range, False)
+        )
+
+    @patch(
+        "nepub.novel.stream",
+        side_effect=lambda url, validators=None: [get_index_page(url)],
+    )
+    def test_make_plan(self, _):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            output = os.path.join(tmp_dir, "xxxx.epub")
+            plan = make_plan("xxxx", True, None, output, False, False, 1.0)
+            # 既存のファイルがない場合はすべて取得する
+            self.assertEqual(
+                (1, 4, 4, 0), (plan.index_pages, plan.episodes, plan.fetch, plan.skip)
+            )
+            self.assertIsNone(plan.bytes_new)
+            self.assertEqual((5, 5.0), (plan.requests, plan.seconds))
+
+            with EpubWriter(output, "xxxx", False, True, True) as writer:
+                for i in range(1, 3):
+                    episode = Episode(
+                        str(i), f"エピソード{i}", f"2000/01/0{i} 00:00", "", ["本文"]
+                    )
+                    image = Image(str(i), f"{i}.jpg", "image/jpeg", b"test_data")
+                    writer.add_episode(episode, [image])
+                writer.finish("タイトル", "著者", "", [Chapter("default", [])])
+            plan = make_plan("xxxx", True, None, output, False, False, 1.0)
+            self.assertEqual((2, 2), (plan.fetch, plan.skip))
+            # 新しいエピソードの挿絵は既存のエピソードの平均から推定する
+            self.assertEqual((2, 2), (plan.images_fetch, plan.images_reuse))
+            self.assertLess(0, plan.bytes_reused)
+            self.assertEqual(plan.bytes_reused, plan.bytes_new)
+            self.assertEqual((5, 3.0), (plan.requests, plan.seconds))
+
+            total = Plan("total")
+            total.add(plan)
+            total.add(plan)
+            self.assertEqual((4, 10), (total.fetch, total.requests))
+            self.assertEqual(plan.bytes_reused * 2, total.bytes_new)
+
+    def test_plan_scaling(self):
+        # エピソード数に対して線形に処理できること
+        # (目次のページごとに目次全体をたどると、ページ数 x エピソード数の回数だけ取り出す)
+        for total in (10000, 50000):
+            self.assertEqual(total, plan_synthetic(total))
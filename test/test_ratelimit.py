@@ -0,0 +1,59 @@
+import tempfile
+import threading
+import time
+from unittest import TestCase
+from unittest.mock import patch
+
+from nepub.ratelimit import RateLimiter, SharedRateLimiter
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = 0.0
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds: float):
+        self.slept += seconds
+        self.now += seconds
+
+
+class TestRateLimiter(TestCase):
+    def test_rate_limiter(self):
+        clock = FakeClock()
+        with patch("nepub.ratelimit.time", clock):
+            limiter = RateLimiter(1.0)
+            limiter.wait("example.com")
+            self.assertEqual(0.0, clock.slept)
+            clock.now += 0.25
+            limiter.wait("example.com")
+            self.assertEqual(0.75, clock.slept)
+            # ホストが異なる場合は待たない
+            limiter.wait("example.net")
+            self.assertEqual(0.75, clock.slept)
+
+    def test_shared_rate_limiter(self):
+        clock = FakeClock()
+        with tempfile.TemporaryDirectory() as d, patch("nepub.ratelimit.time", clock):
+            SharedRateLimiter(d, 1.0).wait("example.com")
+            self.assertEqual(0.0, clock.slept)
+            # 別のプロセスや後の実行でも最終リクエスト時刻を共有する
+            clock.now += 0.5
+            SharedRateLimiter(d, 1.0).wait("example.com")
+            self.assertEqual(0.5, clock.slept)
+            SharedRateLimiter(d, 1.0).wait("example.net")
+            self.assertEqual(0.5, clock.slept)
+
+    def test_rate_limiter_hosts_in_parallel(self):
+        # 別のホストへのリクエストは、他のスレッドが待っている間も待たない
+        limiter = RateLimiter(0.5)
+        limiter.wait("example.com")
+        thread = threading.Thread(target=limiter.wait, args=("example.com",))
+        thread.start()
+        time.sleep(0.1)
+        started_at = time.monotonic()
+        limiter.wait("example.net")
+        self.assertLess(time.monotonic() - started_at, 0.2)
+        thread.join()
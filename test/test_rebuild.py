@@ -0,0 +1,50 @@
+import os
+import tempfile
+import zipfile
+from unittest import TestCase
+from unittest.mock import patch
+
+from nepub.epub import FORMAT_VERSION, EpubWriter, load_metadata
+from nepub.rebuild import rebuild_library
+from nepub.type import Chapter, Episode, RawEpisode
+from nepub.util import find_epubs
+
+
+def write_epub(path: str, novel_id: str):
+    episode = Episode(
+        "1",
+        "たいとる1",
+        "2000/01/01 00:00",
+        paragraphs=["古いだんらく"],
+        raw=RawEpisode("たいとる1", [["だんらく1"]]),
+    )
+    with EpubWriter(path, novel_id, False, False, True) as writer:
+        writer.add_episode(episode, [])
+        writer.finish("たいとる", "作者", "", [Chapter("default", [episode])])
+
+
+class TestRebuild(TestCase):
+    @patch("nepub.events.reporter")
+    def test_rebuild_library(self, _):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            old = os.path.join(tmp_dir, "old.epub")
+            new = os.path.join(tmp_dir, "new.epub")
+            with patch("nepub.epub.FORMAT_VERSION", 0):
+                write_epub(old, "old")
+            write_epub(new, "new")
+            self.assertEqual([new, old], find_epubs([tmp_dir]))
+            with open(new, "rb") as f:
+                new_data = f.read()
+
+            # 出力形式が古いファイルだけを保存済みの本文から作り直す
+            self.assertEqual([old], rebuild_library([tmp_dir], 1))
+            self.assertEqual(FORMAT_VERSION, load_metadata(old).format_version)
+            with zipfile.ZipFile(old) as zf:
+                text = zf.read("src/text/1.xhtml").decode()
+                self.assertIn("<p>だんらく１</p>", text)
+                self.assertNotIn("古いだんらく", text)
+            with open(new, "rb") as f:
+                self.assertEqual(new_data, f.read())
+
+            # force の場合はすべて作り直す
+            self.assertEqual([new, old], rebuild_library([tmp_dir], 1, force=True))
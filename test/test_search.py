@@ -0,0 +1,86 @@
+import os
+import tempfile
+from unittest import TestCase
+from unittest.mock import patch
+
+from nepub.__main__ import convert_narou_to_epub
+from nepub.search import SearchIndex, index_epub, plain_text
+from nepub.type import RawEpisode
+
+PAGES = {
+    "index": (
+        '<h1 class="p-novel__title">タイトル</h1><div class="p-novel__author">作者：著者</div>'
+        '<div class="p-eplist__sublist"><a href="/xxxx/1/" class="p-eplist__subtitle">エピソード1</a>'
+        '<div class="p-eplist__update">2000/01/01 00:00</div></div>'
+        '<div class="p-eplist__sublist"><a href="/xxxx/2/" class="p-eplist__subtitle">エピソード2</a>'
+        '<div class="p-eplist__update">{updated_at}</div></div>'
+    ),
+    "1": '<h1 class="p-novel__title">出会い</h1><p id="L1">アリスは<ruby>白兎<rt>しろうさぎ</rt></ruby>を追いかけた。</p>',
+    "2": '<h1 class="p-novel__title">お茶会</h1><p id="L1">{text}</p>',
+}
+
+
+class TestSearch(TestCase):
+    def test_plain_text(self):
+        raw = RawEpisode(
+            "たいとる",
+            [
+                ["あ", ["ruby"], "漢字", ["rt"], "かんじ", ["/rt"], ["/ruby"], "い"],
+                [],
+                ["　う", ["img", "alt", "//example.com/"]],
+            ],
+        )
+        # ルビの読みと空行は除く
+        self.assertEqual("あ漢字い\nう", plain_text(raw))
+
+    def test_convert_and_search(self):
+        pages = {"updated_at": "2000/01/02 00:00", "text": "帽子屋と三月ウサギがいた。"}
+
+        def stream(url: str, validators=None):
+            if "?p=" in url:
+                return [PAGES["index"].format(**pages)]
+            return [PAGES[url.rstrip("/").split("/")[-1]].format(**pages)]
+
+        with tempfile.TemporaryDirectory() as tmp_dir, patch(
+            "nepub.novel.stream", side_effect=stream
+        ), patch("nepub.events.reporter"):
+            output = os.path.join(tmp_dir, "xxxx.epub")
+            search_index = SearchIndex(os.path.join(tmp_dir, "search.db"))
+            convert_narou_to_epub(
+                "xxxx", False, True, "", output, False, search_index=search_index
+            )
+            hits = search_index.search("白兎を追")
+            self.assertEqual(
+                [("xxxx", "1", "タイトル", "出会い")],
+                [(h.novel_id, h.episode_id, h.novel_title, h.title) for h in hits],
+            )
+            self.assertEqual("アリスは[白兎を追]いかけた。", hits[0].snippet)
+            self.assertEqual("https://ncode.syosetu.com/xxxx/1/", hits[0].url)
+            # 3 文字未満の語も検索できる
+            self.assertEqual(["2"], [h.episode_id for h in search_index.search("帽子")])
+            self.assertEqual(
+                ["2"], [h.episode_id for h in search_index.search("お茶会")]
+            )
+
+            # 更新されたエピソードは索引の内容が置き換わる
+            pages = {
+                "updated_at": "2000/01/03 00:00",
+                "text": "女王とクロッケーをした。",
+            }
+            convert_narou_to_epub(
+                "xxxx", False, True, "", output, False, search_index=search_index
+            )
+            self.assertEqual([], search_index.search("帽子屋"))
+            self.assertEqual(
+                ["2"], [h.episode_id for h in search_index.search("クロッケー")]
+            )
+            search_index.close()
+
+            # 作成済みの EPUB から索引を作る
+            search_index = SearchIndex(os.path.join(tmp_dir, "search2.db"))
+            self.assertTrue(index_epub(search_index, output))
+            self.assertEqual(["1"], [h.episode_id for h in search_index.search("白兎")])
+            self.assertEqual(
+                ["2"], [h.episode_id for h in search_index.search("クロッケー")]
+            )
+            search_index.close()
@@ -0,0 +1,140 @@
+import json
+import os
+import tempfile
+import threading
+import urllib.error
+import urllib.request
+from unittest import TestCase
+from unittest.mock import patch
+
+from nepub.server import BuildService, IndexCache, JobConflict, make_server
+from nepub.type import Chapter, Episode, Index
+
+
+def get_page(url: str):
+    if "?p=" in url:
+        return (
+            '<h1 class="p-novel__title">タイトル</h1><div class="p-novel__author">作者：著者</div>'
+            '<div class="p-eplist__sublist"><a href="/xxxx/1/" class="p-eplist__subtitle">エピソード1</a>'
+            '<div class="p-eplist__update">2000/01/01 00:00</div></div>'
+        )
+    return '<h1 class="p-novel__title">エピソード1</h1><p id="L1">本文</p>'
+
+
+class TestServer(TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.service = BuildService(self.tmp_dir.name, 2)
+        self.server = make_server("127.0.0.1", 0, self.service)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.base_url = f"http://127.0.0.1:{self.server.server_port}"
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.service.shutdown()
+        self.tmp_dir.cleanup()
+
+    def request(self, method: str, path: str, headers={}):
+        req = urllib.request.Request(
+            self.base_url + path, method=method, headers=headers
+        )
+        try:
+            with urllib.request.urlopen(req) as res:
+                return res.status, res.headers, res.read()
+        except urllib.error.HTTPError as e:
+            return e.code, e.headers, e.read()
+
+    @patch("nepub.events.reporter")
+    @patch(
+        "nepub.novel.stream", side_effect=lambda url, validators=None: [get_page(url)]
+    )
+    def test_build_and_download(self, get, _):
+        self.assertEqual(404, self.request("GET", "/novels/xxxx.epub")[0])
+        status, _, body = self.request("POST", "/novels/xxxx?wait=1")
+        self.assertEqual((200, "done"), (status, json.loads(body)["status"]))
+        self.assertEqual(2, get.call_count)
+
+        status, headers, body = self.request("GET", "/novels/xxxx.epub")
+        self.assertEqual(200, status)
+        self.assertEqual("application/epub+zip", headers["Content-Type"])
+        etag = headers["ETag"]
+        with open(os.path.join(self.tmp_dir.name, "xxxx.epub"), "rb") as f:
+            self.assertEqual(f.read(), body)
+        status, _, _ = self.request("GET", "/novels/xxxx.epub", {"If-None-Match": etag})
+        self.assertEqual(304, status)
+
+        # 直近に取得した目次を使うので、更新のない小説はサイトにアクセスせずに終わる
+        status, _, body = self.request("POST", "/novels/xxxx?wait=1")
+        self.assertEqual((200, "done"), (status, json.loads(body)["status"]))
+        self.assertEqual(2, get.call_count)
+        status, headers, _ = self.request("GET", "/novels/xxxx.epub")
+        self.assertEqual(etag, headers["ETag"])
+
+        status, headers, body = self.request("GET", "/metrics")
+        self.assertEqual(200, status)
+        self.assertIn(
+            'nepub_episodes_total{novel_id="xxxx",result="fetched"}', body.decode()
+        )
+        self.assertIn('nepub_jobs{status="running"} 0', body.decode())
+
+    def test_coalesce(self):
+        started = threading.Event()
+        release = threading.Event()
+
+        def convert(*args, **kwargs):
+            started.set()
+            release.wait()
+            return Index("タイトル", "著者", [Chapter("default", [Episode("1")])])
+
+        with patch("nepub.server.convert_narou_to_epub", side_effect=convert) as mock:
+            job1 = self.service.submit("xxxx")
+            started.wait()
+            # 処理中の小説の要求は同じジョブにまとめる
+            job2 = self.service.submit("xxxx")
+            self.assertIs(job1, job2)
+            # オプションが異なる要求はまとめずに 409 を返す
+            with self.assertRaises(JobConflict):
+                self.service.submit("xxxx", illustration=True)
+            status, _, body = self.request("POST", "/novels/xxxx?tcy=0")
+            self.assertEqual(409, status)
+            self.assertEqual(job1.id, json.loads(body)["job"]["id"])
+            release.set()
+            job1.completed.wait()
+            self.assertEqual("done", job1.status)
+            self.assertEqual(1, mock.call_count)
+            job3 = self.service.submit("xxxx")
+            job3.completed.wait()
+            self.assertIsNot(job1, job3)
+            # 2 回目は目次のキャッシュを渡す
+            self.assertIsNotNone(mock.call_args.kwargs["cached_index"])
+
+    def test_output_path_per_site(self):
+        def convert(novel_id, illustration, tcy, my_range, output, kakuyomu, **kwargs):
+            with open(output, "w") as f:
+                f.write("kakuyomu" if kakuyomu else "narou")
+            return Index("タイトル", "著者", [Chapter("default", [Episode("1")])])
+
+        with patch("nepub.server.convert_narou_to_epub", side_effect=convert):
+            # なろうとカクヨムで同じ ID の小説は別のファイルに保存する
+            for kakuyomu in (False, True):
+                job = self.service.submit("1234", kakuyomu)
+                job.completed.wait()
+                self.assertEqual("done", job.status)
+        self.assertEqual(
+            ["1234.epub", "kakuyomu-1234.epub"], sorted(os.listdir(self.tmp_dir.name))
+        )
+        self.assertEqual(b"narou", self.request("GET", "/novels/1234.epub")[2])
+        self.assertEqual(
+            b"kakuyomu", self.request("GET", "/novels/1234.epub?kakuyomu=1")[2]
+        )
+
+    def test_index_cache(self):
+        cache = IndexCache(ttl=0.0)
+        cache.put(("xxxx", False), Index("タイトル", "著者", []))
+        self.assertIsNone(cache.get(("xxxx", False)))
+        cache = IndexCache()
+        index = Index("タイトル", "著者", [])
+        cache.put(("xxxx", False), index)
+        self.assertEqual(index, cache.get(("xxxx", False)))
+        self.assertIsNot(index, cache.get(("xxxx", False)))
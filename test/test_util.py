@@ -1,17 +1,76 @@
 from unittest import TestCase
 
-from nepub.util import range_to_episode_nums
+from nepub.type import Episode
+from nepub.util import episode_hash, parse_range
 
 
 class TestUtil(TestCase):
-    def test_range_to_episode_nums(self):
-        self.assertEqual(set(["1", "2", "3"]), range_to_episode_nums("1,2,3"))
-        self.assertEqual(set(["1", "2", "3"]), range_to_episode_nums("1, 2, 3"))
-        self.assertEqual(set(["1", "2", "3"]), range_to_episode_nums("1-3"))
-        self.assertEqual(set(["1", "5", "6", "7"]), range_to_episode_nums("1, 5 - 7"))
+    def test_parse_range(self):
+        def target_nums(my_range: str, total: int):
+            target_range = parse_range(my_range)
+            return [
+                num
+                for num in range(1, total + 1)
+                if target_range.contains(num, total, Episode(str(num)))
+            ]
+
+        self.assertEqual([1, 2, 3], target_nums("1,2,3", 10))
+        self.assertEqual([1, 2, 3], target_nums("1, 2, 3", 10))
+        self.assertEqual([1, 2, 3], target_nums("1-3", 10))
+        self.assertEqual([1, 5, 6, 7], target_nums("1, 5 - 7", 10))
+        self.assertEqual([8, 9, 10], target_nums("8-", 10))
+        self.assertEqual([1, 9, 10], target_nums("1,last:2", 10))
+        self.assertEqual([2, 3, 4, 5, 6], target_nums("2-4,3-6,5", 10))
+        # 開始位置が同じ終わりのない区間と終わりのある区間
+        self.assertEqual([5, 6, 7, 8, 9, 10], target_nums("5-,5", 10))
+        self.assertEqual(list(range(1, 11)), target_nums("1-3,1-", 10))
+        self.assertEqual([10, 11, 12], target_nums("10-,10-20", 12))
+        with self.assertRaisesRegex(Exception, "^range が想定しない形式です"):
+            parse_range("1,,2")
+        with self.assertRaisesRegex(Exception, "^range が想定しない形式です"):
+            parse_range("-1")
         with self.assertRaisesRegex(Exception, "^range が想定しない形式です"):
-            range_to_episode_nums("1,,2")
+            parse_range("3-1")
         with self.assertRaisesRegex(Exception, "^range が想定しない形式です"):
-            range_to_episode_nums("1-")
-        with self.assertRaisesRegex(Exception, "^range に含まれる値が大きすぎます"):
-            range_to_episode_nums("1-99999")
+            parse_range("since:2026/10/01")
+
+    def test_parse_range_large(self):
+        # 範囲を展開しないので大きな値も扱える
+        target_range = parse_range("99990-,1-99999999")
+        self.assertEqual([(1, None)], target_range.intervals)
+        self.assertTrue(target_range.contains(50_000_000, 100_000_000, Episode("x")))
+
+    def test_parse_range_since(self):
+        target_range = parse_range("since:2026-10-01")
+        self.assertTrue(
+            target_range.contains(1, 3, Episode("1", created_at="2026/10/01 00:00"))
+        )
+        self.assertTrue(
+            target_range.contains(
+                2,
+                3,
+                Episode(
+                    "2", created_at="2026/09/01 00:00", updated_at="2026/10/02 00:00"
+                ),
+            )
+        )
+        self.assertTrue(
+            target_range.contains(3, 3, Episode("3", created_at="2026-10-05T00:00:00Z"))
+        )
+        self.assertFalse(
+            target_range.contains(1, 3, Episode("1", created_at="2026/09/30 23:59"))
+        )
+
+    def test_episode_hash(self):
+        self.assertEqual(
+            episode_hash("たいとる", ["だんらく1", "だんらく2"]),
+            episode_hash("たいとる", ["だんらく1", "だんらく2"]),
+        )
+        self.assertNotEqual(
+            episode_hash("たいとる", ["だんらく1", "だんらく2"]),
+            episode_hash("たいとる", ["だんらく1", "だんらく3"]),
+        )
+        self.assertNotEqual(
+            episode_hash("たいとる", ["だんらく1", "だんらく2"]),
+            episode_hash("たいとる", ["だんらく1だんらく2"]),
+        )